@@ -0,0 +1,278 @@
+import fcntl
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+
+# Pages copied per step of the online backup. The live database is only locked while a step runs.
+SNAPSHOT_STEP_PAGES = 1024
+# Seconds between two steps, letting writers in
+SNAPSHOT_STEP_SLEEP = 0.005
+# Times a stepped backup may start over because of concurrent writes before it is taken in one step
+SNAPSHOT_MAX_RESTARTS = 3
+# Bytes read or handed to the zip stream at a time
+CHUNK_SIZE = 1024 * 1024
+# File name prefix of the backups taken by the scheduler
+SCHEDULED_PREFIX = "wgdashboard_scheduled_"
+# Seconds between two checks of the backup schedule
+SCHEDULE_CHECK_INTERVAL = 60.0
+# Seconds a process waits before trying again to become the one running the schedule
+LEADER_RETRY_INTERVAL = 30.0
+
+
+def file_chunks(path):
+    """
+    Read a file in chunks
+    @return: Iterator of bytes
+    """
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _Restarted(Exception):
+    pass
+
+
+def snapshot_chunks(db_path):
+    """
+    Consistent copy of a live database, taken with SQLite's online backup API in small steps so writers are
+    never held up for long. The copy goes to a temporary file next to the database, removed once it was read,
+    so the database is never held in memory. A write between two steps makes SQLite start the copy over: after
+    SNAPSHOT_MAX_RESTARTS of them it is taken in one step instead, holding writers up until it is done.
+    @param db_path: Database file
+    @return: Iterator of bytes, the database file
+    """
+    fd, path = tempfile.mkstemp(prefix=".snapshot-", suffix=".db", dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_path)
+        try:
+            target = sqlite3.connect(path)
+            try:
+                try:
+                    source.backup(target, pages=SNAPSHOT_STEP_PAGES, progress=_restart_limit(),
+                                  sleep=SNAPSHOT_STEP_SLEEP)
+                except _Restarted:
+                    source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        yield from file_chunks(path)
+    finally:
+        os.remove(path)
+
+
+def _restart_limit():
+    """
+    Progress callback of a stepped backup, giving it up once it restarted SNAPSHOT_MAX_RESTARTS times
+    @raise _Restarted: Too many restarts
+    """
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # Every step leaves fewer pages to copy, unless the copy started over
+        if state["remaining"] is not None and remaining >= state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > SNAPSHOT_MAX_RESTARTS:
+                raise _Restarted()
+        state["remaining"] = remaining
+
+    return progress
+
+
+def backup_members(db_path, settings_path, conf_dir):
+    """
+    Content of a dashboard backup: the database snapshot, the settings and every WireGuard configuration
+    @return: Iterator of (file name in the zip, iterator of bytes)
+    """
+    yield "wgdashboard.db", snapshot_chunks(db_path)
+    if os.path.isfile(settings_path):
+        yield "wg-dashboard.ini", file_chunks(settings_path)
+    for name in sorted(os.listdir(conf_dir)):
+        if name.endswith(".conf"):
+            yield name, file_chunks(os.path.join(conf_dir, name))
+
+
+class _Sink(io.RawIOBase):
+    """
+    Unseekable file collecting what zipfile writes, so it can be handed out as it is produced
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(members, comment=b""):
+    """
+    Produce a zip archive while its members are read, without a file on disk or the whole archive in memory
+    @param members: Iterator of (file name, iterator of bytes)
+    @param comment: Archive comment
+    @return: Iterator of bytes
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.comment = comment
+        for name, chunks in members:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o600 << 16
+            with zf.open(info, "w", force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    if sink.chunks:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def write_zip(path, members, comment=b""):
+    """
+    Write a zip archive to a file atomically
+    @param path: Archive path
+    @param members: Iterator of (file name, iterator of bytes)
+    @param comment: Archive comment
+    @return: None
+    """
+    part = path + ".part"
+    try:
+        with open(part, "wb") as f:
+            for chunk in zip_stream(members, comment):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+
+def fingerprint(db_path, settings_path, conf_dir):
+    """
+    Value that changes whenever anything a backup contains changed: the database's file change counter
+    (bumped by every commit) and the size and modification time of the other files
+    @return: bytes
+    """
+    digest = hashlib.sha256()
+    with open(db_path, "rb") as f:
+        digest.update(f.read(100)[24:28])
+    paths = [settings_path] + [os.path.join(conf_dir, name) for name in sorted(os.listdir(conf_dir))
+                               if name.endswith(".conf")]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest().encode()
+
+
+class BackupScheduler:
+    """
+    Takes a backup every `interval` hours into a directory and keeps the newest `retention` of them. A backup is
+    only written when something changed since the previous one, whose fingerprint is kept in the zip comment.
+    Only the dashboard process holding the lock file runs the schedule.
+    """
+
+    def __init__(self, backup_dir, db_path, settings_path, conf_dir, schedule, lock_path):
+        """
+        @param backup_dir: Directory of the backups
+        @param db_path: Database file
+        @param settings_path: Dashboard settings file
+        @param conf_dir: Function returning the WireGuard configuration directory
+        @param schedule: Function returning (interval in hours, 0 to disable; number of backups kept)
+        @param lock_path: Lock file electing the process running the schedule
+        """
+        self.backup_dir = backup_dir
+        self.db_path = db_path
+        self.settings_path = settings_path
+        self.conf_dir = conf_dir
+        self.schedule = schedule
+        self.lock_path = lock_path
+        self._checked_at = 0
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the scheduler thread of this process (after gunicorn forked the worker)
+        @return: None
+        """
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._serve, name="backup-scheduler", daemon=True).start()
+
+    def _serve(self):
+        lock_file = open(self.lock_path, "a")
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(LEADER_RETRY_INTERVAL)
+        while True:
+            try:
+                self.run_pending()
+            except (OSError, ValueError, sqlite3.Error, zipfile.BadZipFile):
+                pass
+            time.sleep(SCHEDULE_CHECK_INTERVAL)
+
+    def scheduled(self):
+        """
+        Backups taken by the scheduler, newest first
+        @return: list of paths
+        """
+        if not os.path.isdir(self.backup_dir):
+            return []
+        return [os.path.join(self.backup_dir, name) for name in sorted(os.listdir(self.backup_dir), reverse=True)
+                if name.startswith(SCHEDULED_PREFIX) and name.endswith(".zip")]
+
+    def run_pending(self, now=None):
+        """
+        Take a backup if one is due and anything changed, then delete the ones past retention
+        @return: Path of the new backup, or None
+        """
+        interval, retention = self.schedule()
+        if interval <= 0:
+            return None
+        now = time.time() if now is None else now
+        existing = self.scheduled()
+        last = max(os.path.getmtime(existing[0]) if existing else 0, self._checked_at)
+        if now - last < interval * 3600:
+            return None
+        self._checked_at = now
+        created = None
+        conf_dir = self.conf_dir()
+        current = fingerprint(self.db_path, self.settings_path, conf_dir)
+        if not existing or zipfile.ZipFile(existing[0]).comment != current:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            created = os.path.join(self.backup_dir,
+                                   SCHEDULED_PREFIX + time.strftime("%Y-%m-%d_%H%M%S", time.localtime(now)) + ".zip")
+            write_zip(created, backup_members(self.db_path, self.settings_path, conf_dir), current)
+            existing.insert(0, created)
+        for path in existing[max(retention, 1):]:
+            os.remove(path)
+        return created
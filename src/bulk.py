@@ -0,0 +1,249 @@
+import ipaddress
+import itertools
+import subprocess
+import time
+
+import ip_allocator
+from command import wg, wg_set_peers
+from command_runner import wg_quick
+
+# Peers applied per `wg set` call. Bounds the command line length and the number of open PSK pipes.
+CHUNK_SIZE = 256
+
+PEER_COLUMNS = ("id", "private_key", "DNS", "endpoint_allowed_ip", "name", "total_receive", "total_sent",
+                "total_data", "endpoint", "status", "latest_handshake", "allowed_ip", "cumu_receive", "cumu_sent",
+                "cumu_data", "mtu", "keepalive", "remote_endpoint", "preshared_key", "end_active", "ends_at",
+                "bandwidth", "timer_on", "created_at")
+
+
+def insert_peers_sql(config_name):
+    """
+    INSERT statement taking one row per peer in PEER_COLUMNS order
+    @param config_name: Name of WG interface
+    @return: str
+    """
+    return f"INSERT INTO {config_name} ({', '.join(PEER_COLUMNS)}) VALUES ({', '.join('?' * len(PEER_COLUMNS))})"
+
+
+def host_routes(addresses):
+    """
+    Single host allowed IPs as written by `wg-quick save`, e.g. 10.0.0.2/32,fd00::2/128
+    @param addresses: Addresses of one peer
+    @return: str
+    """
+    addresses = [ipaddress.ip_address(address) for address in addresses]
+    return ",".join(f"{address}/{address.max_prefixlen}" for address in addresses)
+
+
+def provision_peers(cur, config_name, conf_address, keys, amount, options, chunk_size=CHUNK_SIZE):
+    """
+    Create peers in chunks: allocate addresses, apply the chunk to the kernel in one `wg set` call with PSKs
+    passed through pipes, insert the rows with executemany and commit. The configuration file is saved once
+    at the end. Only one chunk of keys is held in memory at a time.
+
+    Generator: yields {"created", "total"} after every chunk, then a final dict that also has "status" and "msg".
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param conf_address: `Address` of the interface
+    @param keys: Iterable of dicts with "publicKey", "privateKey" and "presharedKey"
+    @param amount: Number of peers to create
+    @param options: dict with "DNS", "endpoint_allowed_ip", "MTU", "keep_alive", "remote_endpoint",
+                    "enable_preshared_key" and optionally "bandwidth" (bytes) and "ends_at" (timestamp)
+    @param chunk_size: Peers per kernel call
+    """
+    keys = iter(keys)
+    sql = insert_peers_sql(config_name)
+    prefix = f"{config_name}_{time.strftime('%m%d%Y%H%M%S')}_Peer_#_"
+    ends_at = options.get("ends_at")
+    created = 0
+    error = None
+    try:
+        while created < amount and error is None:
+            chunk = list(itertools.islice(keys, min(chunk_size, amount - created)))
+            if not chunk:
+                break
+            peer_ids = [key["publicKey"] for key in chunk]
+            ips = ip_allocator.reserve(cur, config_name, conf_address, len(chunk), peer_ids=peer_ids)
+            if len(ips) < len(chunk):
+                ip_allocator.release(cur, config_name, peer_ids[len(ips):])
+                chunk = chunk[:len(ips)]
+                error = f"Cannot create more than {created + len(ips)} peers."
+            if not chunk:
+                break
+            routes = [host_routes(addresses) for addresses in ips]
+            psks = [key.get("presharedKey", "") if options["enable_preshared_key"] else "" for key in chunk]
+            try:
+                wg_set_peers(config_name, [{"public_key": key["publicKey"], "allowed_ips": route, "preshared_key": psk}
+                                           for key, route, psk in zip(chunk, routes, psks)])
+            except subprocess.CalledProcessError as exc:
+                ip_allocator.release(cur, config_name, peer_ids)
+                cur.connection.commit()
+                error = exc.output.decode("UTF-8", "replace").strip()
+                break
+            now = time.time()
+            cur.executemany(sql, [
+                (key["publicKey"], key["privateKey"], options["DNS"], options["endpoint_allowed_ip"],
+                 prefix + str(created + i + 1), 0, 0, 0, "N/A", "stopped", "N/A", route, 0, 0, 0,
+                 options["MTU"], options["keep_alive"], options["remote_endpoint"], psk, 1, ends_at,
+                 options.get("bandwidth", 0), int(ends_at is not None), now)
+                for i, (key, route, psk) in enumerate(zip(chunk, routes, psks))])
+            ip_allocator.adopt_revision(cur, config_name)
+            cur.connection.commit()
+            created += len(chunk)
+            yield {"created": created, "total": amount}
+    finally:
+        if created:
+            wg_quick("save", config_name, wait=None)
+    yield {"created": created, "total": amount, "status": error is None, "msg": error or ""}
+
+
+def expired_peer_ids(cur, config_name, now=None):
+    """
+    Peers that were deactivated or whose end time passed
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: list of peer ids
+    """
+    now = time.time() if now is None else now
+    return [row[0] for row in cur.execute(
+        f"SELECT id FROM {config_name} WHERE end_active = 0 OR (ends_at IS NOT NULL AND ends_at <= ?)", (now,))]
+
+
+def remove_peers(cur, config_name, peer_ids, chunk_size=CHUNK_SIZE):
+    """
+    Remove peers in chunks: one `wg set` call per chunk, then a parameterized batched delete of the rows and
+    their address reservations, committed per chunk. A chunk the kernel refused is left untouched in the
+    database. The configuration file is saved once at the end.
+
+    Generator: yields {"removed", "total"} after every chunk, then a final dict that also has "status", "msg"
+    and "outcomes", mapping each peer id to "removed", "not_found" or the error of its chunk.
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param peer_ids: Peer ids (public keys)
+    @param chunk_size: Peers per kernel call
+    """
+    peer_ids = list(dict.fromkeys(peer_ids))
+    outcomes = {}
+    removed = 0
+    error = None
+    try:
+        for start in range(0, len(peer_ids), chunk_size):
+            chunk = peer_ids[start:start + chunk_size]
+            known = {row[0] for row in cur.execute(
+                f"SELECT id FROM {config_name} WHERE id IN ({', '.join('?' * len(chunk))})", chunk)}
+            try:
+                wg_set_peers(config_name, [{"public_key": peer_id, "remove": True} for peer_id in chunk])
+            except subprocess.CalledProcessError as exc:
+                error = exc.output.decode("UTF-8", "replace").strip()
+                outcomes.update(dict.fromkeys(chunk, error))
+                continue
+            cur.executemany(f"DELETE FROM {config_name} WHERE id = ?", [(peer_id,) for peer_id in chunk])
+            ip_allocator.release(cur, config_name, chunk)
+            cur.connection.commit()
+            for peer_id in chunk:
+                outcomes[peer_id] = "removed" if peer_id in known else "not_found"
+            removed += len(chunk)
+            yield {"removed": removed, "total": len(peer_ids)}
+    finally:
+        if removed:
+            wg_quick("save", config_name, wait=None)
+    yield {"removed": removed, "total": len(peer_ids), "status": error is None, "msg": error or "",
+           "outcomes": outcomes}
+
+
+def kernel_peers(config_name):
+    """
+    Peers currently on the interface, from `wg show <interface> dump`
+    @param config_name: Name of WG interface
+    @return: dict of peer id -> (preshared key or "", set of allowed networks)
+    @raise subprocess.CalledProcessError: Interface is down
+    """
+    peers = {}
+    for line in wg("show", config_name, "dump").decode("UTF-8").splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) < 4:
+            continue
+        networks = set(ip_allocator.parse_networks(fields[3]))
+        peers[fields[0]] = ("" if fields[1] == "(none)" else fields[1], networks)
+    return peers
+
+
+def join_networks(networks):
+    """
+    Allowed IPs value for a set of networks, IPv4 first
+    @return: str
+    """
+    return ",".join(map(str, sorted(networks, key=lambda network: (network.version, network))))
+
+
+def reconcile_peers(cur, config_name, defaults, prune=False, dry_run=False, chunk_size=CHUNK_SIZE):
+    """
+    Make the interface and the database agree. Active peers missing from the interface, or with other allowed
+    IPs or preshared key, are applied again; inactive peers still on the interface are removed. Peers on the
+    interface the database does not know are added to it like the dashboard does when it reads the
+    configuration file, or removed from the interface with prune.
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param defaults: dict with the default "DNS", "endpoint_allowed_ip", "MTU", "keep_alive" and "remote_endpoint"
+    @param prune: Remove unknown peers from the interface instead of adding them to the database
+    @param dry_run: Only count the differences
+    @param chunk_size: Peers per kernel call
+    @return: dict with "applied", "removed", "adopted", "pruned", "status" and "msg"
+    """
+    try:
+        kernel = kernel_peers(config_name)
+    except subprocess.CalledProcessError as exc:
+        return {"applied": 0, "removed": 0, "adopted": 0, "pruned": 0, "status": False,
+                "msg": exc.output.decode("UTF-8", "replace").strip()}
+    changes = []
+    applied = removed = 0
+    known = set()
+    for peer_id, allowed_ip, preshared_key, end_active in cur.execute(
+            f"SELECT id, allowed_ip, preshared_key, end_active FROM {config_name}"):
+        known.add(peer_id)
+        if not end_active:
+            if peer_id in kernel:
+                changes.append({"public_key": peer_id, "remove": True})
+                removed += 1
+            continue
+        networks = set(ip_allocator.parse_networks(allowed_ip))
+        current = kernel.get(peer_id)
+        if current is None or current[1] != networks or (preshared_key and current[0] != preshared_key):
+            changes.append({"public_key": peer_id, "allowed_ips": join_networks(networks),
+                            "preshared_key": preshared_key or ""})
+            applied += 1
+    unknown = [peer_id for peer_id in kernel if peer_id not in known]
+    if prune:
+        changes.extend({"public_key": peer_id, "remove": True} for peer_id in unknown)
+    result = {"applied": applied, "removed": removed, "adopted": 0 if prune else len(unknown),
+              "pruned": len(unknown) if prune else 0, "status": True, "msg": ""}
+    if dry_run:
+        return result
+
+    if not prune and unknown:
+        now = time.time()
+        cur.executemany(insert_peers_sql(config_name), [(
+            peer_id, "", defaults["DNS"], defaults["endpoint_allowed_ip"], "", 0, 0, 0, "N/A", "stopped", "N/A",
+            join_networks(kernel[peer_id][1]) or "(None)", 0, 0, 0, defaults["MTU"], defaults["keep_alive"],
+            defaults["remote_endpoint"], kernel[peer_id][0], 1, None, 0, 0, now) for peer_id in unknown])
+        cur.connection.commit()
+    try:
+        for start in range(0, len(changes), chunk_size):
+            wg_set_peers(config_name, changes[start:start + chunk_size])
+    except subprocess.CalledProcessError as exc:
+        result.update(status=False, msg=exc.output.decode("UTF-8", "replace").strip())
+    finally:
+        if changes:
+            wg_quick("save", config_name, wait=None)
+    return result
+
+
+def run_to_end(steps):
+    """
+    Consume a generator of progress steps and return the last one
+    @return: dict
+    """
+    result = None
+    for result in steps:
+        pass
+    return result
@@ -0,0 +1,349 @@
+import argparse
+import contextlib
+import json
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from flask import g
+
+import bulk
+import dashboard
+import enforcement
+import ip_allocator
+import keygen
+import peer_batch
+import peer_changes
+import peer_io
+import prefix_trie
+from command import wg_set_peers
+from command_runner import wg_quick
+from util import check_DNS, check_Allowed_IPs
+
+LIST_COLUMNS = ("id", "name", "allowed_ip", "status", "end_active", "usage_gb", "bandwidth_gb", "ends_at")
+
+
+@contextlib.contextmanager
+def dashboard_context():
+    """
+    App context with g.db / g.cur, like a request, so the dashboard helpers work without the web server
+    """
+    dashboard.init_dashboard()
+    dashboard.load_settings()
+    with dashboard.app.app_context():
+        g.db = dashboard.connect_db()
+        g.cur = g.db.cursor()
+        try:
+            ip_allocator.create_allocation_tables(g.cur)
+            enforcement.create_limit_tables(g.cur)
+            peer_changes.create_change_tables(g.cur)
+            prefix_trie.create_index_tables(g.cur)
+            for config_name in dashboard.get_config_names():
+                dashboard.create_conf_table(config_name)
+            g.db.commit()
+            yield
+            g.db.commit()
+        finally:
+            g.db.close()
+
+
+def check_configuration(config_name):
+    if config_name not in dashboard.get_config_names():
+        sys.exit(f"Configuration {config_name} does not exist.")
+
+
+def progress(done, total, label):
+    if sys.stderr.isatty():
+        print(f"\r{label} {done}/{total}", end="", file=sys.stderr, flush=True)
+
+
+def report(msg):
+    print(("\n" if sys.stderr.isatty() else "") + msg, file=sys.stderr)
+
+
+def parse_time(value):
+    """
+    Parse a UNIX timestamp, "YYYY-MM-DD" or "YYYY-MM-DD HH:MM" (local time)
+    @return: float
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"{value} is not a timestamp, YYYY-MM-DD or YYYY-MM-DD HH:MM")
+
+
+def read_ids(args):
+    """
+    Peer ids given as arguments, or one per line in --file ("-" for stdin)
+    @return: list of str
+    """
+    ids = list(args.ids)
+    if args.file:
+        with (contextlib.nullcontext(sys.stdin) if args.file == "-" else open(args.file)) as f:
+            ids.extend(line.strip() for line in f if line.strip())
+    return ids
+
+
+def cmd_list(args):
+    if not args.config_name:
+        for config_name in dashboard.get_config_names():
+            total, active = g.cur.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(end_active), 0) FROM {config_name}").fetchone()
+            print(f"{config_name}\t{dashboard.get_conf_status(config_name)}\t{total} peers\t{active} active")
+        return 0
+    check_configuration(args.config_name)
+    rows = g.cur.execute(f"SELECT id, name, allowed_ip, status, end_active, "
+                         f"cumu_data + total_receive + total_sent, bandwidth, ends_at FROM {args.config_name}")
+    if not args.json:
+        print("\t".join(LIST_COLUMNS))
+    for row in rows:
+        peer = dict(zip(LIST_COLUMNS, row))
+        peer["usage_gb"] = round(peer["usage_gb"] or 0, 4)
+        peer["bandwidth_gb"] = round((peer["bandwidth_gb"] or 0) / pow(1024, 3), 4)
+        if args.json:
+            print(json.dumps(peer))
+        else:
+            if peer["ends_at"] is not None:
+                peer["ends_at"] = datetime.fromtimestamp(float(peer["ends_at"])).isoformat(" ", "minutes")
+            print("\t".join("" if value is None else str(value) for value in peer.values()))
+    return 0
+
+
+def cmd_add_bulk(args):
+    check_configuration(args.config_name)
+    defaults = dashboard.get_peer_defaults()
+    options = {
+        "DNS": args.dns or defaults["DNS"],
+        "endpoint_allowed_ip": args.endpoint_allowed_ip or defaults["endpoint_allowed_ip"],
+        "MTU": args.mtu or defaults["MTU"],
+        "keep_alive": args.keep_alive or defaults["keep_alive"],
+        "remote_endpoint": defaults["remote_endpoint"],
+        "enable_preshared_key": not args.no_preshared_key
+    }
+    if args.amount < 1:
+        sys.exit("Amount must be an integer larger than 0.")
+    if not check_DNS(options["DNS"]):
+        sys.exit("DNS format is incorrect. Example: 1.1.1.1")
+    if not check_Allowed_IPs(options["endpoint_allowed_ip"]):
+        sys.exit("Endpoint Allowed IPs format is incorrect.")
+    if not str(options["MTU"]).isdigit() or not str(options["keep_alive"]).isdigit():
+        sys.exit("MTU and Persistent Keepalive must be numbers.")
+    conf_address = dashboard.read_conf_file_interface(args.config_name).get("Address")
+    if not conf_address:
+        sys.exit("Configuration must have an IP address.")
+
+    keys = keygen.generate_keys(args.amount, options["enable_preshared_key"])
+    for step in bulk.provision_peers(g.cur, args.config_name, conf_address, keys, args.amount, options):
+        progress(step["created"], step["total"], "Created")
+    report(f"Created {step['created']} of {step['total']} peers.")
+    if not step["status"]:
+        print(step["msg"], file=sys.stderr)
+    return 0 if step["status"] else 1
+
+
+def cmd_remove(args):
+    check_configuration(args.config_name)
+    ids = bulk.expired_peer_ids(g.cur, args.config_name) if args.expired else read_ids(args)
+    if not ids:
+        print("No peers to remove.", file=sys.stderr)
+        return 0
+    for step in bulk.remove_peers(g.cur, args.config_name, ids):
+        progress(step["removed"], step["total"], "Removed")
+    not_found = sum(outcome == "not_found" for outcome in step["outcomes"].values())
+    report(f"Removed {step['removed'] - not_found} peers, {not_found} not found.")
+    if not step["status"]:
+        print(step["msg"], file=sys.stderr)
+    return 0 if step["status"] else 1
+
+
+def cmd_set_quota(args):
+    check_configuration(args.config_name)
+    ids = [row[0] for row in g.cur.execute(f"SELECT id FROM {args.config_name}")] if args.all else read_ids(args)
+    fields = {}
+    if args.bandwidth is not None:
+        fields["bandwidth"] = args.bandwidth
+    if args.no_expiry:
+        fields["ends_at"] = None
+    elif args.days is not None:
+        fields["ends_at"] = time.time() + args.days * 86400
+    elif args.ends_at is not None:
+        fields["ends_at"] = args.ends_at
+    if not fields:
+        sys.exit("Nothing to set: give --bandwidth, --days, --ends-at or --no-expiry.")
+
+    results = peer_batch.apply_batch(g.cur, args.config_name, "", [dict(fields, op="update", id=peer_id)
+                                                                    for peer_id in ids], {})
+    for result in results:
+        if result["status"] != "success":
+            print(f"{result['id']}: {result['msg']}", file=sys.stderr)
+    updated = [result["id"] for result in results if result["status"] == "success"]
+    reactivated = reactivate_peers(args.config_name, updated)
+    print(f"Updated {len(updated)} peers, {reactivated} reactivated.", file=sys.stderr)
+    return 0 if len(updated) == len(results) else 1
+
+
+def reactivate_peers(config_name, peer_ids):
+    """
+    Put back on the interface the inactive peers whose new limits allow it, as saving peer settings does
+    @return: int, number of peers reactivated
+    """
+    now = time.time()
+    peers = []
+    for start in range(0, len(peer_ids), peer_batch.LOOKUP_CHUNK):
+        chunk = peer_ids[start:start + peer_batch.LOOKUP_CHUNK]
+        for peer_id, allowed_ip, preshared_key, ends_at, bandwidth, total_sent in g.cur.execute(
+                f"SELECT id, allowed_ip, preshared_key, ends_at, bandwidth, total_sent FROM {config_name} "
+                f"WHERE end_active = 0 AND id IN ({', '.join('?' * len(chunk))})", chunk):
+            if (ends_at is None or float(ends_at) > now) and \
+                    (not bandwidth or bandwidth > (total_sent or 0) * pow(1024, 3)):
+                peers.append({"public_key": peer_id, "allowed_ips": allowed_ip, "preshared_key": preshared_key})
+    if not peers:
+        return 0
+    try:
+        for start in range(0, len(peers), bulk.CHUNK_SIZE):
+            wg_set_peers(config_name, peers[start:start + bulk.CHUNK_SIZE])
+    except subprocess.CalledProcessError as exc:
+        print(exc.output.decode("UTF-8", "replace").strip(), file=sys.stderr)
+        return 0
+    g.cur.executemany(f"UPDATE {config_name} SET end_active = 1 WHERE id = ?",
+                      [(peer["public_key"],) for peer in peers])
+    g.db.commit()
+    wg_quick("save", config_name, wait=None)
+    return len(peers)
+
+
+def cmd_export(args):
+    check_configuration(args.config_name)
+    with (contextlib.nullcontext(sys.stdout) if args.output == "-" else
+          open(args.output, "w", encoding="utf-8", newline="")) as out:
+        for block in peer_io.export_peers(g.db.cursor(), args.config_name, args.format):
+            out.write(block)
+    return 0
+
+
+def cmd_import(args):
+    check_configuration(args.config_name)
+    fmt = args.format or args.file.rsplit(".", 1)[-1].lower()
+    if fmt not in peer_io.FORMATS:
+        sys.exit("Format must be csv or jsonl.")
+    with (contextlib.nullcontext(sys.stdin) if args.file == "-" else
+          open(args.file, encoding="utf-8", newline="")) as stream:
+        for step in peer_io.import_peers(g.cur, args.config_name, peer_io.read_records(stream, fmt),
+                                         dashboard.get_peer_defaults()):
+            progress(step["imported"], step["imported"] + step["failed"], "Imported")
+    report(f"Imported {step['imported']} peers, {step['failed']} failed.")
+    for error in step["errors"]:
+        print(f"line {error['line']}: {error['msg']}", file=sys.stderr)
+    if not step["status"]:
+        print(step["msg"], file=sys.stderr)
+    return 0 if step["status"] and not step["failed"] else 1
+
+
+def cmd_recalc_usage(args):
+    config_names = args.config_names or dashboard.get_config_names()
+    for config_name in config_names:
+        check_configuration(config_name)
+        if dashboard.get_latest_handshake(config_name) == "stopped":
+            print(f"{config_name}: stopped", file=sys.stderr)
+            continue
+        dashboard.get_transfer(config_name)
+        g.db.commit()
+        print(f"{config_name}: updated", file=sys.stderr)
+    return 0
+
+
+def cmd_reconcile(args):
+    status = 0
+    for config_name in args.config_names or dashboard.get_config_names():
+        check_configuration(config_name)
+        result = bulk.reconcile_peers(g.cur, config_name, dashboard.get_peer_defaults(), args.prune, args.dry_run)
+        if not result["status"]:
+            print(f"{config_name}: {result['msg']}", file=sys.stderr)
+            status = 1
+            continue
+        print(f"{config_name}: {result['applied']} applied, {result['removed']} removed, "
+              f"{result['adopted']} adopted, {result['pruned']} pruned{' (dry run)' if args.dry_run else ''}",
+              file=sys.stderr)
+    return status
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="wgd.sh", description="Manage peers without the web server: the commands work on the dashboard "
+                                   "database and the WireGuard interfaces directly.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("list", help="List configurations, or the peers of one")
+    command.add_argument("config_name", nargs="?")
+    command.add_argument("--json", action="store_true", help="One JSON object per peer")
+    command.set_defaults(func=cmd_list)
+
+    command = commands.add_parser("add-bulk", help="Create peers with generated keys and allocated addresses")
+    command.add_argument("config_name")
+    command.add_argument("amount", type=int)
+    command.add_argument("--dns")
+    command.add_argument("--endpoint-allowed-ip")
+    command.add_argument("--mtu")
+    command.add_argument("--keep-alive")
+    command.add_argument("--no-preshared-key", action="store_true")
+    command.set_defaults(func=cmd_add_bulk)
+
+    command = commands.add_parser("remove", help="Remove peers")
+    command.add_argument("config_name")
+    command.add_argument("ids", nargs="*", help="Public keys")
+    command.add_argument("--file", help="File with one public key per line, - for stdin")
+    command.add_argument("--expired", action="store_true", help="Remove deactivated and expired peers")
+    command.set_defaults(func=cmd_remove)
+
+    command = commands.add_parser("set-quota", help="Set the data quota and expiry of peers")
+    command.add_argument("config_name")
+    command.add_argument("ids", nargs="*", help="Public keys")
+    command.add_argument("--file", help="File with one public key per line, - for stdin")
+    command.add_argument("--all", action="store_true", help="Every peer of the configuration")
+    command.add_argument("--bandwidth", type=float, help="Quota in GB, 0 for unlimited")
+    expiry = command.add_mutually_exclusive_group()
+    expiry.add_argument("--days", type=float, help="Expire this many days from now")
+    expiry.add_argument("--ends-at", type=parse_time, help="Expire at a timestamp, YYYY-MM-DD or YYYY-MM-DD HH:MM")
+    expiry.add_argument("--no-expiry", action="store_true")
+    command.set_defaults(func=cmd_set_quota)
+
+    command = commands.add_parser("export", help="Export peers as CSV or JSON lines")
+    command.add_argument("config_name")
+    command.add_argument("--format", choices=sorted(peer_io.FORMATS), default="csv")
+    command.add_argument("-o", "--output", default="-", help="Output file, - for stdout")
+    command.set_defaults(func=cmd_export)
+
+    command = commands.add_parser("import", help="Import peers from a CSV or JSON lines export")
+    command.add_argument("config_name")
+    command.add_argument("file", help="Input file, - for stdin")
+    command.add_argument("--format", choices=sorted(peer_io.FORMATS), help="Default: from the file extension")
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser("recalc-usage", help="Update handshakes and data usage from the interfaces")
+    command.add_argument("config_names", nargs="*")
+    command.set_defaults(func=cmd_recalc_usage)
+
+    command = commands.add_parser("reconcile", help="Make the interfaces match the database")
+    command.add_argument("config_names", nargs="*")
+    command.add_argument("--prune", action="store_true",
+                         help="Remove peers unknown to the database instead of adding them to it")
+    command.add_argument("--dry-run", action="store_true", help="Only report the differences")
+    command.set_defaults(func=cmd_reconcile)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    with dashboard_context():
+        return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
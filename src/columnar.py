@@ -0,0 +1,73 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns with few distinct values, sent as indexes into a list of their values
+DICTIONARY_COLUMNS = ("DNS", "endpoint_allowed_ip", "status", "mtu", "keepalive", "remote_endpoint")
+
+
+def encode(fields, rows):
+    """
+    Columnar form of table rows: the field names once, then one array per column. The values of the
+    DICTIONARY_COLUMNS are indexes into dictionaries[field].
+    @param fields: Column names
+    @param rows: list of tuples in fields order
+    @return: {"fields", "count", "columns", "dictionaries"}
+    """
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in fields]
+    dictionaries = {}
+    for i, field in enumerate(fields):
+        if field in DICTIONARY_COLUMNS:
+            index = {}
+            columns[i] = [index.setdefault(value, len(index)) for value in columns[i]]
+            dictionaries[field] = list(index)
+    return {"fields": list(fields), "count": len(rows), "columns": columns, "dictionaries": dictionaries}
+
+
+class RowEncoder:
+    """
+    Columnar form built one batch of rows at a time, for responses produced while the rows are read: "rows"
+    (one array per row) replaces "columns", and the dictionaries are complete once every row is encoded
+    """
+
+    def __init__(self, fields):
+        """
+        @param fields: Column names
+        """
+        self.fields = list(fields)
+        self.count = 0
+        self._indexes = {i: {} for i, field in enumerate(self.fields) if field in DICTIONARY_COLUMNS}
+
+    def encode(self, rows):
+        """
+        Encode a batch of rows
+        @param rows: list of tuples in fields order
+        @return: bytes, the rows as comma separated JSON arrays
+        """
+        encoded = []
+        for row in rows:
+            row = list(row)
+            for i, index in self._indexes.items():
+                row[i] = index.setdefault(row[i], len(index))
+            encoded.append(row)
+        self.count += len(rows)
+        return dumps(encoded)[1:-1]
+
+    def dictionaries(self):
+        """
+        @return: dict of field -> values, the dictionaries of the rows encoded so far
+        """
+        return {self.fields[i]: list(index) for i, index in self._indexes.items()}
+
+
+def dumps(data):
+    """
+    Serialize to JSON with orjson when it is installed, else with the json module
+    @return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
@@ -0,0 +1,158 @@
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Binaries used for every WireGuard call. Point WGD_WG_BIN / WGD_WG_QUICK_BIN at a scripted
+# fake to exercise or benchmark the dashboard on a machine without WireGuard installed.
+WG_BIN = os.getenv('WGD_WG_BIN', 'wg')
+WG_QUICK_BIN = os.getenv('WGD_WG_QUICK_BIN', 'wg-quick')
+
+# Timeouts in seconds
+WG_TIMEOUT = float(os.getenv('WGD_WG_TIMEOUT', '10'))
+WG_QUICK_TIMEOUT = float(os.getenv('WGD_WG_QUICK_TIMEOUT', '30'))
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def command_name(argv):
+    """
+    Short name used to group latency statistics, e.g. "wg show" or "wg-quick up"
+    @param argv: Command arguments
+    @type argv: list
+    @return: str
+    """
+    name = os.path.basename(argv[0])
+    if name == os.path.basename(WG_BIN):
+        name = "wg"
+    elif name == os.path.basename(WG_QUICK_BIN):
+        name = "wg-quick"
+    if len(argv) > 1:
+        name += " " + argv[1]
+    return name
+
+
+def record_latency(name, elapsed, failed=False):
+    """
+    Record the duration of one command
+    @param name: Command name
+    @param elapsed: Duration in seconds
+    @param failed: Whether the command failed or timed out
+    @return: None
+    """
+    with _stats_lock:
+        stat = _stats.setdefault(name, {"count": 0, "failed": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        stat["count"] += 1
+        stat["failed"] += int(failed)
+        stat["total"] += elapsed
+        stat["last"] = elapsed
+        if elapsed > stat["max"]:
+            stat["max"] = elapsed
+
+
+def command_stats():
+    """
+    Get per-command latency statistics of this process
+    @return: dict
+    """
+    with _stats_lock:
+        return {name: dict(stat, avg=stat["total"] / stat["count"]) for name, stat in _stats.items()}
+
+
+def reset_command_stats():
+    """
+    Clear latency statistics
+    @return: None
+    """
+    with _stats_lock:
+        _stats.clear()
+
+
+def run(argv, input=None, pass_fds=(), timeout=WG_TIMEOUT):
+    """
+    Run a command without a shell
+    @param argv: Command arguments
+    @type argv: list
+    @param input: Data written to the command's stdin (str or bytes)
+    @param pass_fds: File descriptors kept open in the child, see secret_files()
+    @param timeout: Seconds before the command is killed
+    @return: Combined stdout and stderr
+    @rtype: bytes
+    @raise subprocess.CalledProcessError: Command failed, was not found or timed out
+    """
+    if isinstance(input, str):
+        input = input.encode()
+    name = command_name(argv)
+    failed = True
+    tic = time.perf_counter()
+    try:
+        result = subprocess.run(argv, input=input, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                pass_fds=pass_fds, timeout=timeout, check=True)
+        failed = False
+        return result.stdout
+    except subprocess.TimeoutExpired as exc:
+        output = (exc.output or b"") + f"{name} timed out after {timeout:g} seconds".encode()
+        raise subprocess.CalledProcessError(-1, argv, output=output) from exc
+    except FileNotFoundError as exc:
+        raise subprocess.CalledProcessError(127, argv, output=f"{argv[0]}: command not found".encode()) from exc
+    finally:
+        record_latency(name, time.perf_counter() - tic, failed)
+
+
+def wg(*args, input=None, pass_fds=(), timeout=WG_TIMEOUT):
+    """
+    Run `wg` with the given arguments. `wg-quick` goes through command_runner.wg_quick instead, which
+    serializes the commands of an interface.
+    @return: bytes
+    """
+    return run([WG_BIN, *args], input=input, pass_fds=pass_fds, timeout=timeout)
+
+
+@contextmanager
+def secret_files(secrets):
+    """
+    Expose secrets (e.g. preshared keys) to a child process through pipes instead of files on disk.
+    Yields a list of /dev/fd paths, one per secret, and the fds to hand to run(pass_fds=...).
+    @param secrets: List of secret strings
+    @type secrets: list
+    """
+    fds = []
+    try:
+        for secret in secrets:
+            read_fd, write_fd = os.pipe()
+            fds.append(read_fd)
+            try:
+                os.write(write_fd, secret.encode())
+            finally:
+                os.close(write_fd)
+        yield [f"/dev/fd/{fd}" for fd in fds], fds
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def wg_set_peers(config_name, peers, timeout=WG_TIMEOUT):
+    """
+    Apply several peers in a single `wg set` call. Preshared keys are passed through pipes.
+    @param config_name: Name of WG interface
+    @param peers: List of dicts with "public_key" and optionally "allowed_ips", "preshared_key" or "remove"
+    @type peers: list
+    @return: bytes
+    """
+    argv = ["set", config_name]
+    preshared_keys = [peer["preshared_key"] for peer in peers
+                      if peer.get("preshared_key") and not peer.get("remove")]
+    with secret_files(preshared_keys) as (psk_paths, psk_fds):
+        psk_paths = iter(psk_paths)
+        for peer in peers:
+            argv.extend(["peer", peer["public_key"]])
+            if peer.get("remove"):
+                argv.append("remove")
+                continue
+            if peer.get("preshared_key"):
+                argv.extend(["preshared-key", next(psk_paths)])
+            if "allowed_ips" in peer:
+                argv.extend(["allowed-ips", peer["allowed_ips"]])
+        return wg(*argv, pass_fds=psk_fds, timeout=timeout)
@@ -0,0 +1,177 @@
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+
+from command import WG_QUICK_BIN, WG_TIMEOUT, WG_QUICK_TIMEOUT, command_name, record_latency
+
+# Maximum number of commands running at the same time in this process
+MAX_CONCURRENT_COMMANDS = int(os.getenv('WGD_MAX_CONCURRENT_COMMANDS', '4'))
+
+
+class CommandBusy(subprocess.CalledProcessError):
+    """
+    Raised when an interface already has a command in flight, or a command outlived the wait of its caller
+    """
+
+
+class CommandRunner:
+    """
+    Runs commands on a private asyncio loop so that request threads only wait as long as they choose to.
+    Commands touching the same interface are serialized, and the total number of running commands is capped.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_COMMANDS):
+        self.max_concurrent = max_concurrent
+        self._loop = None
+        self._semaphore = None
+        self._interface_locks = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        """
+        Start the event loop thread on first use (after gunicorn forked the worker)
+        @return: asyncio.AbstractEventLoop
+        """
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def serve():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_concurrent)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                threading.Thread(target=serve, name="command-runner", daemon=True).start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    @property
+    def loop(self):
+        return self._ensure_loop()
+
+    def busy(self, interface):
+        """
+        Check if a command for the interface is queued or running
+        @param interface: Name of WG interface
+        @return: bool
+        """
+        with self._lock:
+            return self._pending.get(interface, 0) > 0
+
+    async def _execute(self, argv, input, timeout):
+        name = command_name(argv)
+        tic = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            *argv, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.CalledProcessError(-1, argv, output=f"{name} timed out after {timeout:g} seconds".encode())
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            record_latency(name, time.perf_counter() - tic, failed=proc.returncode != 0)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, argv, output=output)
+        return output
+
+    async def _run(self, argv, interface, input, timeout):
+        try:
+            if interface is None:
+                async with self._semaphore:
+                    return await self._execute(argv, input, timeout)
+            lock = self._interface_locks.setdefault(interface, asyncio.Lock())
+            async with lock:
+                async with self._semaphore:
+                    return await self._execute(argv, input, timeout)
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, argv, output=f"{argv[0]}: command not found".encode())
+
+    def _release(self, interface):
+        with self._lock:
+            self._pending[interface] -= 1
+
+    def submit(self, argv, interface=None, input=None, timeout=WG_TIMEOUT):
+        """
+        Schedule a command without waiting for it
+        @param argv: Command arguments
+        @param interface: Commands with the same interface run one at a time
+        @param input: Data written to stdin
+        @param timeout: Seconds before the command is killed
+        @return: concurrent.futures.Future resolving to the command output
+        """
+        if isinstance(input, str):
+            input = input.encode()
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._run(argv, interface, input, timeout), loop)
+        if interface is not None:
+            with self._lock:
+                self._pending[interface] = self._pending.get(interface, 0) + 1
+            future.add_done_callback(lambda _: self._release(interface))
+        return future
+
+    def run(self, argv, interface=None, input=None, timeout=WG_TIMEOUT, wait=None, exclusive=False):
+        """
+        Sync bridge for Flask routes: run a command and wait for its output
+        @param argv: Command arguments
+        @param interface: Commands with the same interface run one at a time
+        @param input: Data written to stdin
+        @param timeout: Seconds before the command is killed
+        @param wait: Seconds to wait before giving the thread back; the command keeps running until timeout
+        @param exclusive: Refuse instead of queueing when the interface already has a command in flight
+        @return: bytes
+        @raise subprocess.CalledProcessError: Command failed or timed out
+        @raise CommandBusy: Interface busy (exclusive) or command still running after wait
+        """
+        name = command_name(argv)
+        if exclusive and interface is not None and self.busy(interface):
+            raise CommandBusy(-1, argv, output=f"Another command is already running on {interface}.".encode())
+        future = self.submit(argv, interface, input, timeout)
+        try:
+            return future.result(wait)
+        except concurrent.futures.TimeoutError:
+            raise CommandBusy(-1, argv, output=f"{name} is still running in the background.".encode())
+        except concurrent.futures.CancelledError:
+            raise subprocess.CalledProcessError(-1, argv, output=f"{name} was cancelled.".encode())
+
+    def cancel_all(self):
+        """
+        Cancel every queued or running command of this process
+        @return: None
+        """
+        if self._loop is None:
+            return
+
+        def cancel():
+            for task in asyncio.all_tasks(self._loop):
+                task.cancel()
+
+        self._loop.call_soon_threadsafe(cancel)
+
+
+runner = CommandRunner()
+
+
+def wg_quick(action, config_name, wait=None, exclusive=False):
+    """
+    Run `wg-quick <action> <config_name>` serialized per interface
+    @param action: up, down, save or strip
+    @param config_name: Name of WG interface
+    @param wait: Seconds the calling thread waits for the result, None until the command is done
+    @param exclusive: Fail fast if the interface already has a command in flight
+    @return: bytes
+    """
+    return runner.run([WG_QUICK_BIN, action, config_name], interface=config_name, timeout=WG_QUICK_TIMEOUT,
+                      wait=wait, exclusive=exclusive)
@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import os
+import sys
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent as they are
+MIN_SIZE = 1024
+# Levels for responses compressed per request; precompressed files use the highest ones
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/html", "text/plain", "text/css",
+                      "application/javascript", "text/javascript", "application/manifest+json", "image/svg+xml")
+# Static files worth precompressing; images, woff and woff2 are compressed already
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".json", ".map", ".svg", ".ttf", ".eot", ".html", ".txt")
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+_hashes = {}
+
+
+def choose_encoding(accept_encodings):
+    """
+    Pick the best content coding the client accepts
+    @param accept_encodings: werkzeug Accept of the Accept-Encoding header
+    @return: "br", "gzip" or None
+    """
+    for encoding in accepted_encodings(accept_encodings):
+        if encoding != "br" or brotli is not None:
+            return encoding
+    return None
+
+
+def accepted_encodings(accept_encodings):
+    """
+    Every content coding the client accepts, best first, for picking a precompressed file
+    @return: list
+    """
+    return [encoding for encoding in ("br", "gzip") if accept_encodings.quality(encoding) > 0]
+
+
+def compress(data, encoding):
+    """
+    @param data: bytes
+    @param encoding: "br" or "gzip"
+    @return: bytes
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress a streamed body as it is produced. Every chunk is flushed, so progress streams stay live.
+    @param chunks: Iterator of bytes or str
+    @param encoding: "br" or "gzip"
+    @return: Iterator of bytes
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for chunk in chunks:
+            data = process(chunk.encode() if isinstance(chunk, str) else chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def content_hash(path):
+    """
+    Short hash of a file's content, for URLs that change whenever the file does
+    @return: str, or None when there is no such file
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = _hashes.get(path)
+    if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+        with open(path, "rb") as f:
+            cached = ((stat.st_mtime_ns, stat.st_size), hashlib.sha256(f.read()).hexdigest()[:12])
+        _hashes[path] = cached
+    return cached[1]
+
+
+def precompressed(path, encodings):
+    """
+    Precompressed variant of a static file, when it is up to date
+    @param path: Static file
+    @param encodings: Codings the client accepts, best first
+    @return: (encoding, path of the variant), or None
+    """
+    for encoding in encodings:
+        variant = path + SUFFIXES[encoding]
+        try:
+            if os.stat(variant).st_mtime >= os.stat(path).st_mtime:
+                return encoding, variant
+        except OSError:
+            continue
+    return None
+
+
+def precompress(directory):
+    """
+    Write a .gz (and, with the brotli module, a .br) next to every compressible file of a directory tree
+    that has none or an outdated one
+    @param directory: Static directory
+    @return: Number of files written
+    """
+    written = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding in ("gzip", "br"):
+                if encoding == "br" and brotli is None:
+                    continue
+                variant = path + SUFFIXES[encoding]
+                if os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+                    continue
+                tmp = variant + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(brotli.compress(data, quality=11) if encoding == "br" else gzip.compress(data, 9, mtime=0))
+                os.replace(tmp, variant)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    # Run at install and update: python3 compression.py static
+    print(f"{precompress(sys.argv[1] if len(sys.argv) > 1 else 'static')} precompressed files written")
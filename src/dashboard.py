@@ -1,18 +1,21 @@
-import psutil
 import os
 import secrets
+import signal
 import subprocess
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from glob import glob
 from operator import itemgetter
 from pathlib import Path
 from threading import Thread
 import sqlite3
 import configparser
+import contextlib
 import hashlib
+import io
 import ipaddress
 import json
+import mimetypes
 import re
 import urllib.parse
 import urllib.request
@@ -20,13 +23,36 @@ import urllib.error
 import zipfile
 import ifcfg
 import pytz
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify, g, send_file
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify, g, send_file, \
+    send_from_directory, Response, stream_with_context, abort
+from werkzeug.security import safe_join
 from flask_qrcode import QRcode
 from icmplib import ping, traceroute
 
 # Import other python files
 from util import regex_match, check_DNS, check_Allowed_IPs, check_remote_endpoint, \
     check_IP_with_range, clean_IP_with_range
+from command import wg, wg_set_peers, command_stats
+from command_runner import wg_quick
+import backups
+import bulk
+import columnar
+import compression
+import dashboard_settings
+import database
+import enforcement
+import interface_status
+import interface_summary
+import ip_allocator
+import jobs
+import keygen
+import peer_batch
+import peer_changes
+import peer_io
+import peer_stream
+import prefix_trie
+import singleflight
+import system_stats
 
 # Dashboard Version
 DASHBOARD_VERSION = 'v3.0.8'
@@ -43,10 +69,19 @@ if not os.path.isdir(DB_PATH):
 
 DB_FILE_PATH = os.path.join(configuration_path, 'db', 'wgdashboard.db')
 DASHBOARD_CONF = os.path.join(configuration_path, 'wg-dashboard.ini')
+settings_store = dashboard_settings.SettingsStore(DASHBOARD_CONF)
+# Backups produced by background jobs
+BACKUP_PATH = os.path.join(DB_PATH, 'backups')
 
 # Upgrade Required
 UPDATE = None
 
+# Modification time of wg-dashboard.ini when this process last loaded it
+SETTINGS_MTIME = None
+
+# PID of the gunicorn master (set by gunicorn.conf.py), None when dashboard.py serves by itself
+SERVER_PID = None
+
 # Flask App Configuration
 app = Flask("WGDashboard")
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 5206928
@@ -69,75 +104,18 @@ def format_bytes(bytes):
     else:
         return f"{bytes / (1024 ** 3):.2f}GB"
 
-######### total-ram-func #########
-def get_total_ram():
-    with open('/proc/meminfo') as meminfo_file:
-        for line in meminfo_file:
-            if line.startswith('MemTotal:'):
-                total_ram_kb = int(line.split()[1])
-                return total_ram_kb
-                
-######### used_ram-func #########
-def get_used_ram():
-    with open('/proc/meminfo') as meminfo_file:
-        meminfo = meminfo_file.read()
-    lines = meminfo.split('\n')
-
-    for line in lines:
-        if line.startswith('MemTotal:'):
-            total_ram_kb = int(line.split()[1])
-        elif line.startswith('MemFree:'):
-            free_ram_kb = int(line.split()[1])
-        elif line.startswith('Buffers:'):
-            buffers_kb = int(line.split()[1])
-        elif line.startswith('Cached:'):
-            cached_kb = int(line.split()[1])
-
-    used_ram_kb = total_ram_kb - free_ram_kb - buffers_kb - cached_kb
-    return used_ram_kb
-
-######### cpu_capacity-func ######### 
-def get_cpu_capacity():
-    cpuinfo_path = '/proc/cpuinfo'
-    if not os.path.exists(cpuinfo_path):
-        return None
-
-    with open(cpuinfo_path, 'r') as cpuinfo_file:
-        cpuinfo = cpuinfo_file.read()
-
-    processor_lines = [line for line in cpuinfo.split('\n') if line.startswith('processor')]
-    return len(processor_lines)
-
-######### cpu_usage-func #########    
-def get_cpu_usage():
-    with open('/proc/stat') as stat_file:
-        lines = stat_file.readlines()
-
-    for line in lines:
-        if line.startswith("cpu "):
-            fields = line.strip().split()
-            user, nice, system, idle, iowait, irq, softirq = map(int, fields[1:8])
-            total = user + nice + system + idle + iowait + irq + softirq
-            usage = 100.0 * (total - idle) / total
-            return usage
-
-######### get_hard_info-func #########   
-def get_hard_info():
-    # Get the disk partitions
-    partitions = psutil.disk_partitions()
-
-    for partition in partitions:
-        # Get the disk usage statistics
-        usage = psutil.disk_usage(partition.mountpoint)
-
-        #print(f"Device: {partition.device}")
-        #print(f"Mountpoint: {partition.mountpoint}")
-        #print(f"Total Size: {usage.total / (1024 ** 3):.2f} GB")
-        #print(f"Free Space: {usage.free / (1024 ** 3):.2f} GB")
-        #print(f"Used Space: {usage.used / (1024 ** 3):.2f} GB")
-        #print(f"Percentage Used: {usage.percent}%\n")
-    
-        return f"{format_bytes(usage.used)} / {format_bytes(usage.total)}"
+def format_system_stats(sample):
+    """
+    Format a sample of system_sampler for the index page
+    @param sample: dict, or None before the first sample
+    @return: dict of used_ram, total_ram, cpu_usage, cpu_capacity, hard_info
+    """
+    if sample is None:
+        return {"used_ram": "-", "total_ram": "-", "cpu_usage": "-", "cpu_capacity": "-", "hard_info": "-"}
+    cpu_usage = "-" if sample['cpu_percent'] is None else f"{sample['cpu_percent']:.2f}%"
+    return {"used_ram": format_bytes(sample['ram_used']), "total_ram": format_bytes(sample['ram_total']),
+            "cpu_usage": cpu_usage, "cpu_capacity": sample['cpu_count'] or 0,
+            "hard_info": f"{format_bytes(sample['disk_used'])} / {format_bytes(sample['disk_total'])}"}
 
 def connect_db():
     """
@@ -146,22 +124,62 @@ def connect_db():
     """
     return sqlite3.connect(DB_FILE_PATH)
 
+def get_settings():
+    """
+    Get dashboard configuration, parsed once and again only after wg-dashboard.ini changed
+    @return: dashboard_settings.Settings
+    """
+    return settings_store.current()
+
 def get_dashboard_conf():
     """
-    Get dashboard configuration
+    Get dashboard configuration to edit and save with set_dashboard_conf
     @return: configparser.ConfigParser
     """
-    r_config = configparser.ConfigParser(strict=False)
-    r_config.read(DASHBOARD_CONF)
-    return r_config
+    return get_settings().to_parser()
 
 def set_dashboard_conf(config):
     """
-    Write to configuration
+    Write to configuration, atomically, and use it from now on
     @param config: Input configuration
     """
-    with open(DASHBOARD_CONF, "w", encoding='utf-8') as conf_object:
-        config.write(conf_object)
+    settings_store.write(config)
+
+def get_settings_mtime():
+    """
+    Modification time of the dashboard configuration
+    @return: int (ns) or None
+    """
+    try:
+        return os.stat(DASHBOARD_CONF).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def load_settings():
+    """
+    Load wg-dashboard.ini in place: swap WG_CONF_PATH and drop the caches built from the previous settings
+    or database. Every process calls it before a request once the file changed, and on SIGHUP.
+    @return: None
+    """
+    global WG_CONF_PATH, SETTINGS_MTIME
+    SETTINGS_MTIME = get_settings_mtime()
+    WG_CONF_PATH = get_settings().wg_conf_path
+    ip_allocator.clear_cache()
+    prefix_trie.clear_cache()
+    interface_summary.clear_cache()
+    enforcement_engine.reset()
+
+def reload_settings_everywhere():
+    """
+    Make every dashboard process load the settings again before its next request, e.g. after a restore
+    replaced them and the database
+    @return: None
+    """
+    os.utime(DASHBOARD_CONF)
+    load_settings()
+
+def handle_sighup(signum, frame):
+    load_settings()
 
 # Get all keys from a configuration
 def get_conf_peer_key(config_name):
@@ -174,40 +192,12 @@ def get_conf_peer_key(config_name):
     """
 
     try:
-        peers_keys = subprocess.check_output(f"wg show {config_name} peers",
-                                             shell=True, stderr=subprocess.STDOUT)
+        peers_keys = wg("show", config_name, "peers")
         peers_keys = peers_keys.decode("UTF-8").split()
         return peers_keys
     except subprocess.CalledProcessError:
         return config_name + " در حال اجرا نیست. آن را فعال کنید."
 
-def get_conf_running_peer_number(config_name):
-    """
-    Get number of running peers on wireguard interface.
-    @param config_name: Name of WG interface
-    @type config_name: str
-    @return: Number of running peers, or test if configuration not running
-    @rtype: int, str
-    """
-
-    running = 0
-    # Get latest handshakes
-    try:
-        data_usage = subprocess.check_output(f"wg show {config_name} latest-handshakes",
-                                             shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        return "stopped"
-    data_usage = data_usage.decode("UTF-8").split()
-    count = 0
-    now = datetime.now()
-    time_delta = timedelta(minutes=2)
-    for _ in range(int(len(data_usage) / 2)):
-        minus = now - datetime.fromtimestamp(int(data_usage[count + 1]))
-        if minus < time_delta:
-            running += 1
-        count += 2
-    return running
-
 def read_conf_file_interface(config_name):
     """
     Get interface settings.
@@ -282,8 +272,7 @@ def get_latest_handshake(config_name):
     @return: str
     """
     try:
-        data_usage = subprocess.check_output(f"wg show {config_name} latest-handshakes",
-                                             shell=True, stderr=subprocess.STDOUT).decode("UTF-8")
+        data_usage = wg("show", config_name, "latest-handshakes").decode("UTF-8")
     except subprocess.CalledProcessError:
         return "stopped"
 
@@ -353,7 +342,7 @@ def get_transfer(config_name):
     @return: str
     """
     try:
-        data_usage = subprocess.check_output(f"wg show {config_name} transfer", shell=True, stderr=subprocess.STDOUT)
+        data_usage = wg("show", config_name, "transfer")
     except subprocess.CalledProcessError:
         return "stopped"
 
@@ -373,9 +362,6 @@ def get_transfer(config_name):
     if len(peers) > 0:
         for peer in peers:
             total_receive, total_sent, cumu_receive, cumu_sent, status, bandwidth, end_active, ends_at, key = peer
-            ends_at = ends_at or None
-            end_active = bool(True or end_active)
-            status = peer[4]
 
             transfer = transfers.get(key, {})
             cur_total_sent = round(int(transfer.get('up', 0)) / pow(1024, 3), 4)
@@ -390,13 +376,7 @@ def get_transfer(config_name):
                     cumulative_sent = cumu_sent + total_sent
                     update_transfer(config_name, key, 0, 0, cumulative_receive, cumulative_sent, end_active, status)
 
-                if end_active:
-                    end_active = (ends_at is None or time.time() < int(ends_at)) and (bandwidth == 0 or bandwidth >= total_sent * pow(1024, 3))
-
-                    if not end_active:
-                        subprocess.check_output(f"wg set {config_name} peer {key} remove", shell=True, stderr=subprocess.STDOUT)
-                        status = "stopped"
-
+                # Expiry and quota are enforced by enforcement_engine
                 update_transfer(config_name, key, total_receive, total_sent, cumu_receive, cumu_sent, end_active, status)
 
     return "completed"
@@ -409,8 +389,7 @@ def get_endpoint(config_name):
     """
     # Get endpoint
     try:
-        data_usage = subprocess.check_output(f"wg show {config_name} endpoints",
-                                             shell=True, stderr=subprocess.STDOUT)
+        data_usage = wg("show", config_name, "endpoints")
     except subprocess.CalledProcessError:
         return "stopped"
     data_usage = data_usage.decode("UTF-8").split()
@@ -439,7 +418,7 @@ def get_all_peers_data(config_name):
     @return: None
     """
     conf_peer_data = read_conf_file(config_name)
-    config = get_dashboard_conf()
+    config = get_settings()
     failed_index = []
     for i in range(len(conf_peer_data['Peers'])):
         if "PublicKey" in conf_peer_data['Peers'][i].keys():
@@ -500,53 +479,134 @@ def get_all_peers_data(config_name):
     get_allowed_ip(conf_peer_data, config_name)
 
 
-def get_peers(config_name, search="", sort_t="status"):
+def get_peers(config_name, search="", sort_t="status", peer_ids=None, columns=False):
     """
-    Get all peers.
+    Get all peers, as stored by the last get_all_peers_data.
     @param config_name: Name of WG interface
     @type config_name: str
     @param search: Search string
     @type search: str
     @param sort_t: Sorting tag
     @type sort_t: str
-    @return: list
+    @param peer_ids: Only get these peers
+    @type peer_ids: list
+    @param columns: Return them in columnar form (see columnar.encode), with ends_at as a timestamp
+    @type columns: bool
+    @return: list, or dict with columns
     """
     tic = time.perf_counter()
     col = g.cur.execute("PRAGMA table_info(" + config_name + ")").fetchall()
     col = [a[1] for a in col]
-    get_all_peers_data(config_name)
-    if len(search) == 0:
-        data = g.cur.execute("SELECT * FROM " + config_name).fetchall()
-        result = [{col[i]: data[k][i] for i in range(len(col))} for k in range(len(data))]
+    sql = "SELECT * FROM " + config_name + " WHERE 1"
+    args = []
+    if len(search) > 0:
+        sql += " AND name LIKE '%' || ? || '%'"
+        args.append(search)
+    if peer_ids is None:
+        data = g.cur.execute(sql, args).fetchall()
     else:
-        sql = "SELECT * FROM " + config_name + " WHERE name LIKE '%" + search + "%'"
-        data = g.cur.execute(sql).fetchall()
-        result = [{col[i]: data[k][i] for i in range(len(col))} for k in range(len(data))]
+        data = []
+        for start in range(0, len(peer_ids), peer_batch.LOOKUP_CHUNK):
+            chunk = peer_ids[start:start + peer_batch.LOOKUP_CHUNK]
+            data += g.cur.execute(f"{sql} AND id IN ({', '.join('?' * len(chunk))})", args + chunk).fetchall()
+    key = col.index(sort_t)
     if sort_t == "allowed_ip":
-        result = sorted(result, key=lambda d: ipaddress.ip_network(
-            "0.0.0.0/0" if d[sort_t].split(",")[0] == "(None)" else d[sort_t].split(",")[0]))
+        data = sorted(data, key=lambda d: ipaddress.ip_network(
+            "0.0.0.0/0" if d[key].split(",")[0] == "(None)" else d[key].split(",")[0]))
     else:
-        result = sorted(result, key=lambda d: d[sort_t])
+        data = sorted(data, key=itemgetter(key))
     toc = time.perf_counter()
     print(f"Finish fetching peers in {toc - tic:0.4f} seconds")
+    if columns:
+        return columnar.encode(col, data)
+    result = [{col[i]: data[k][i] for i in range(len(col))} for k in range(len(data))]
+    return list(map(cast_peer_data, result))
 
-    def cast_data(item):
-        ends_at = item.get('ends_at')
-        end_active = item.get('end_active')
+def cast_peer_data(item):
+    """
+    Peer dict as returned by get_peers: ends_at as an ISO date and end_active as a bool
+    @param item: dict of a peer row
+    @return: dict
+    """
+    ends_at = item.get('ends_at')
+    end_active = item.get('end_active')
 
-        if ends_at is not None:
-            item['ends_at'] = datetime.fromtimestamp(ends_at).isoformat()
-        else:
-            item['ends_at'] = None
+    if ends_at is not None:
+        item['ends_at'] = datetime.fromtimestamp(ends_at).isoformat()
+    else:
+        item['ends_at'] = None
 
-        if end_active is not None:
-            item['end_active'] = bool(end_active)
-        else:
-            item['end_active'] = False
+    if end_active is not None:
+        item['end_active'] = bool(end_active)
+    else:
+        item['end_active'] = False
 
-        return item
+    return item
 
-    return list(map(cast_data, result))
+def iter_peers(config_name, search="", sort_t="status", batch_size=peer_batch.LOOKUP_CHUNK):
+    """
+    Peers in the order of get_peers, read in batches. Only the order (rowids) is kept in memory, and each batch
+    is its own short read, so writers are not held up while the batches are sent to a slow client.
+    @param config_name: Name of WG interface
+    @param search: Search string
+    @param sort_t: Sorting tag
+    @param batch_size: Rows per batch
+    @return: (column names, iterator of lists of row tuples)
+    """
+    col = [a[1] for a in g.db.execute("PRAGMA table_info(" + config_name + ")").fetchall()]
+    sql = "SELECT rowid, " + sort_t + " FROM " + config_name
+    args = []
+    if len(search) > 0:
+        sql += " WHERE name LIKE '%' || ? || '%'"
+        args.append(search)
+    order = g.db.execute(sql, args).fetchall()
+    if sort_t == "allowed_ip":
+        order.sort(key=lambda d: ipaddress.ip_network(
+            "0.0.0.0/0" if d[1].split(",")[0] == "(None)" else d[1].split(",")[0]))
+    else:
+        order.sort(key=itemgetter(1))
+    rowids = [row[0] for row in order]
+    del order
+
+    def batches():
+        for start in range(0, len(rowids), batch_size):
+            chunk = rowids[start:start + batch_size]
+            rows = {row[0]: row[1:] for row in g.db.execute(
+                f"SELECT rowid, * FROM {config_name} WHERE rowid IN ({', '.join('?' * len(chunk))})", chunk)}
+            # Peers deleted since the order was read are skipped
+            yield [rows[rowid] for rowid in chunk if rowid in rows]
+
+    return col, batches()
+
+def stream_conf_data(conf_data, config_name, search, columns=False):
+    """
+    JSON of the header from get_conf_header with every peer, produced while the peers are read with iter_peers
+    @param conf_data: Header from get_conf_header
+    @param config_name: Name of WG interface
+    @param search: Search string
+    @param columns: Peers in columnar form (columnar.RowEncoder), as "peer_columns", instead of "peer_data"
+    @return: Iterator of bytes
+    """
+    col, batches = iter_peers(config_name, search, conf_data["sort_tag"])
+    head = columnar.dumps(dict(conf_data, delta=False))
+    if columns:
+        encoder = columnar.RowEncoder(col)
+        yield head[:-1] + b',"peer_columns":{"fields":' + columnar.dumps(col) + b',"rows":['
+        separator = b""
+        for rows in batches:
+            if rows:
+                yield separator + encoder.encode(rows)
+                separator = b","
+        yield b'],"count":' + str(encoder.count).encode() + b',"dictionaries":' + \
+            columnar.dumps(encoder.dictionaries()) + b'}}'
+        return
+    yield head[:-1] + b',"peer_data":['
+    separator = b""
+    for rows in batches:
+        if rows:
+            yield separator + b",".join(columnar.dumps(cast_peer_data(dict(zip(col, row)))) for row in rows)
+            separator = b","
+    yield b']}'
 
 def get_conf_pub_key(config_name):
     """
@@ -561,7 +621,7 @@ def get_conf_pub_key(config_name):
         conf = configparser.ConfigParser(strict=False)
         conf.read(WG_CONF_PATH + "/" + config_name + ".conf")
         pri = conf.get("Interface", "PrivateKey")
-        pub = subprocess.check_output(f"echo '{pri}' | wg pubkey", shell=True, stderr=subprocess.STDOUT)
+        pub = wg("pubkey", input=pri)
         conf.clear()
         return pub.decode().strip("\n")
     except configparser.NoSectionError:
@@ -583,39 +643,18 @@ def get_conf_listen_port(config_name):
         port = conf.get("Interface", "ListenPort")
     except (configparser.NoSectionError, configparser.NoOptionError):
         if get_conf_status(config_name) == "running":
-            port = subprocess.check_output(f"wg show {config_name} listen-port",
-                                           shell=True, stderr=subprocess.STDOUT)
+            port = wg("show", config_name, "listen-port")
             port = port.decode("UTF-8")
     conf.clear()
     return port
 
-def get_conf_total_data(config_name):
-    """
-    Get configuration's total amount of data
-    @param config_name: Configuration name
-    @return: list
-    """
-    data = g.cur.execute("SELECT total_sent, total_receive, cumu_sent, cumu_receive FROM " + config_name)
-    upload_total = 0
-    download_total = 0
-    for i in data.fetchall():
-        upload_total += i[0]
-        download_total += i[1]
-        upload_total += i[2]
-        download_total += i[3]
-    total = round(upload_total + download_total, 4)
-    upload_total = round(upload_total, 4)
-    download_total = round(download_total, 4)
-    return [total, upload_total, download_total]
-
 def get_conf_status(config_name):
     """
     Check if the configuration is running or not
     @param config_name:
     @return: Return a string indicate the running status
     """
-    ifconfig = dict(ifcfg.interfaces().items())
-    return "running" if config_name in ifconfig.keys() else "stopped"
+    return conf_status.get(config_name)
 
 def get_config_names():
     """
@@ -627,38 +666,68 @@ def get_config_names():
     config_names = [Path(file).stem for file in config_files]
     return config_names
 
+def create_conf_table(conf_name):
+    """
+    Create the peer table of a WireGuard configuration and its triggers
+    @param conf_name: Name of WG interface
+    @return: None
+    """
+    create_table = f"""CREATE TABLE IF NOT EXISTS {conf_name} (id VARCHAR NOT NULL, private_key VARCHAR NULL, DNS VARCHAR NULL, endpoint_allowed_ip VARCHAR NULL, name VARCHAR NULL, total_receive FLOAT NULL, total_sent FLOAT NULL, total_data FLOAT NULL, endpoint VARCHAR NULL, status VARCHAR NULL, latest_handshake VARCHAR NULL, allowed_ip VARCHAR NULL, cumu_receive FLOAT NULL, cumu_sent FLOAT NULL, cumu_data FLOAT NULL, mtu INT NULL, keepalive INT NULL, remote_endpoint VARCHAR NULL, preshared_key VARCHAR NULL, end_active TINYINT(1) DEFAULT 1, timer_on TINYINT(1) DEFAULT 0, ends_at BIGINT(15) NULL, created_at BIGINT(15) NULL, bandwidth BIGINT DEFAULT 0, PRIMARY KEY (id))"""
+
+    g.cur.execute(create_table)
+    ip_allocator.install_revision_triggers(g.cur, conf_name)
+    enforcement.install_limit_triggers(g.cur, conf_name)
+    peer_changes.install_change_triggers(g.cur, conf_name)
+    prefix_trie.install_index_triggers(g.cur, conf_name)
+
 def get_conf_list():
-    """Get all WireGuard interfaces with status.
+    """Get all WireGuard interfaces with status and their cached summary, shared by concurrent requests.
 
-    @return: Return a list of dicts with interfaces and their statuses
+    @return: Return a list of dicts, see load_conf_list
     @rtype: list
     """
+    return conf_flights.do(("conf_list", WG_CONF_PATH), load_conf_list)
 
-    configs = []
-    config_names = get_config_names()
-
-    for conf_name in config_names:
-        create_table = f"""CREATE TABLE IF NOT EXISTS {conf_name} (id VARCHAR NOT NULL, private_key VARCHAR NULL, DNS VARCHAR NULL, endpoint_allowed_ip VARCHAR NULL, name VARCHAR NULL, total_receive FLOAT NULL, total_sent FLOAT NULL, total_data FLOAT NULL, endpoint VARCHAR NULL, status VARCHAR NULL, latest_handshake VARCHAR NULL, allowed_ip VARCHAR NULL, cumu_receive FLOAT NULL, cumu_sent FLOAT NULL, cumu_data FLOAT NULL, mtu INT NULL, keepalive INT NULL, remote_endpoint VARCHAR NULL, preshared_key VARCHAR NULL, end_active TINYINT(1) DEFAULT 1, timer_on TINYINT(1) DEFAULT 0, ends_at BIGINT(15) NULL, created_at BIGINT(15) NULL, bandwidth BIGINT DEFAULT 0, PRIMARY KEY (id))"""
+def load_conf_list():
+    """Read all WireGuard interfaces with status and their cached summary.
 
-        g.cur.execute(create_table)
+    @return: Return a list of dicts with interfaces, their statuses, public keys, listen ports, peer counts
+             and transfer totals
+    @rtype: list
+    """
 
+    configs = []
+    config_names = get_config_names()
+    new_names = interface_summary.unprepared(config_names)
+    if new_names:
+        ip_allocator.create_allocation_tables(g.cur)
+        enforcement.create_limit_tables(g.cur)
+        peer_changes.create_change_tables(g.cur)
+        prefix_trie.create_index_tables(g.cur)
+        for conf_name in new_names:
+            create_conf_table(conf_name)
+        interface_summary.mark_prepared(new_names)
+
+    for conf_name in sorted(config_names):
         status = get_conf_status(conf_name)
-        checked = 'checked' if status == "running" else ""
-
-        temp = {
+        summary = interface_summary.get_summary(g.cur, conf_name, os.path.join(WG_CONF_PATH, conf_name + ".conf"),
+                                                status, read_interface_keys)
+        configs.append({
             "conf": conf_name,
             "status": status,
-            "public_key": get_conf_pub_key(conf_name),
-            "checked": checked
-        }
-
-        configs.append(temp)
-
-    if len(configs) > 0:
-        configs = sorted(configs, key=itemgetter('conf'))
-
+            "checked": 'checked' if status == "running" else "",
+            **summary
+        })
     return configs
 
+def read_interface_keys(config_name):
+    """
+    Read the public key and listen port of an interface, for interface_summary
+    @param config_name: Name of WG interface
+    @return: (str, str)
+    """
+    return get_conf_pub_key(config_name), get_conf_listen_port(config_name)
+
 def gen_public_key(private_key):
     """Generate the public key.
 
@@ -668,17 +737,10 @@ def gen_public_key(private_key):
     @rtype: dict
     """
 
-    with open('private_key.txt', 'w', encoding='utf-8') as file_object:
-        file_object.write(private_key)
     try:
-        subprocess.check_output("wg pubkey < private_key.txt > public_key.txt", shell=True)
-        with open('public_key.txt', encoding='utf-8') as file_object:
-            public_key = file_object.readline().strip()
-        os.remove('private_key.txt')
-        os.remove('public_key.txt')
+        public_key = wg("pubkey", input=private_key).decode("UTF-8").strip()
         return {"status": 'success', "msg": "", "data": public_key}
     except subprocess.CalledProcessError:
-        os.remove('private_key.txt')
         return {"status": 'failed', "msg": "تعداد کلید یا قالب آن صحیح نیست.", "data": ""}
 
 def f_check_key_match(private_key, public_key, config_name):
@@ -705,6 +767,21 @@ def f_check_key_match(private_key, public_key, config_name):
         else:
             return {'status': 'success'}
 
+def get_peer_defaults():
+    """
+    Default settings of new peers
+    @return: dict with "DNS", "endpoint_allowed_ip", "MTU", "keep_alive" and "remote_endpoint"
+    """
+    config = get_settings()
+    defaults = {
+        "DNS": config.get("Peers", "peer_global_DNS"),
+        "endpoint_allowed_ip": config.get("Peers", "peer_endpoint_allowed_ip"),
+        "MTU": config.get("Peers", "peer_MTU"),
+        "keep_alive": config.get("Peers", "peer_keep_alive"),
+        "remote_endpoint": config.get("Peers", "remote_endpoint")
+    }
+    return defaults
+
 def check_repeat_allowed_ip(public_key, ip, config_name):
     """
     Check if there are repeated IPs
@@ -717,49 +794,95 @@ def check_repeat_allowed_ip(public_key, ip, config_name):
     if peer[0] != 1:
         return {'status': 'failed', 'msg': 'کاربر وجود ندارد.'}
     else:
-        existed_ip = g.cur.execute("SELECT COUNT(*) FROM " +
-                                   config_name + " WHERE id != ? AND allowed_ip LIKE '" + ip + "/%'", (public_key,)) \
-            .fetchone()
-        if existed_ip[0] != 0:
+        existed_ip = prefix_trie.get_index(g.cur, config_name).conflicts(ip, exclude=public_key)
+        if existed_ip:
             return {'status': 'failed', 'msg': "Allowed IP قبلاً توسط کاربر دیگری استفاده شده است."}
         else:
             return {'status': 'success'}
 
-def f_available_ips(config_name):
+def f_available_ips(config_name, after=None, limit=256, prefix=None):
     """
-    Get a list of available IPs
+    Get a page of available IPs
     @param config_name: Configuration Name
-    @return: list
+    @param after: Continue after this IP
+    @param limit: Page size
+    @param prefix: Only return IPs inside this network, e.g. 10.0.5.0/24
+    @return: dict with "ips", "next" and "total"
     """
     config_interface = read_conf_file_interface(config_name)
     if "Address" in config_interface:
-        existed = []
-        conf_address = config_interface['Address']
-        address = conf_address.split(',')
-        for i in address:
-            add, sub = i.split("/")
-            existed.append(ipaddress.ip_address(add))
-        peers = g.cur.execute("SELECT allowed_ip FROM " + config_name).fetchall()
-        for i in peers:
-            add = i[0].split(",")
-            for k in add:
-                a, s = k.split("/")
-                existed.append(ipaddress.ip_address(a.strip()))
-        available = list(ipaddress.ip_network(address[0], False).hosts())
-        for i in existed:
-            try:
-                available.remove(i)
-            except ValueError:
-                pass
-        available = [str(i) for i in available]
-        return available
+        allocator = ip_allocator.get_allocator(g.cur, config_name, config_interface['Address'])
+        return allocator.page(after, limit, prefix)
     else:
-        return []
+        return {"ips": [], "next": None, "total": 0}
 
 """
 Flask Functions
 """
 
+@app.url_defaults
+def static_url_hash(endpoint, values):
+    """
+    Add the content hash of static files to their URLs, so they can be cached forever
+    @param endpoint: Endpoint of the URL
+    @param values: URL values
+    @return: None
+    """
+    if endpoint == 'static' and 'filename' in values:
+        file_hash = compression.content_hash(os.path.join(app.static_folder, values['filename']))
+        if file_hash is not None:
+            values['v'] = file_hash
+
+def serve_static(filename):
+    """
+    Serve a static file, or its precompressed variant (see compression.py) when the browser accepts it
+    @param filename: Path in the static folder
+    @return: Response
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    variant = compression.precompressed(path, compression.accepted_encodings(request.accept_encodings))
+    if variant is None:
+        response = send_from_directory(app.static_folder, filename)
+    else:
+        response = send_file(variant[1], mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                             conditional=True)
+        response.headers['Content-Encoding'] = variant[0]
+    response.vary.add('Accept-Encoding')
+    if request.args.get('v') is not None and request.args.get('v') == compression.content_hash(path):
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress text responses of at least compression.MIN_SIZE bytes with the best coding the browser accepts.
+    Streamed responses are compressed as they are produced.
+    @param response: Response
+    @return: Response
+    """
+    if request.method == 'HEAD' or response.status_code != 200 or response.direct_passthrough or \
+            'Content-Encoding' in response.headers or response.mimetype not in compression.COMPRESSIBLE_TYPES:
+        return response
+    encoding = compression.choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compression.compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    elif response.content_length is not None and response.content_length >= compression.MIN_SIZE:
+        response.set_data(compression.compress(response.get_data(), encoding))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.teardown_request
 def close_DB(exception):
     """
@@ -780,54 +903,27 @@ def auth_req():
     if getattr(g, 'db', None) is None:
         g.db = connect_db()
         g.cur = g.db.cursor()
-    conf = get_dashboard_conf()
-    req = conf.get("Server", "auth_req")
-    session['update'] = UPDATE
-    session['dashboard_version'] = DASHBOARD_VERSION
-    session['admin_ip'] =     request.remote_addr
-    
-    total_ram_kb = get_total_ram()
-    if total_ram_kb >= 1024**2:
-        total_ram = total_ram_kb / (1024**2)  # Convert to gigabytes
-        t_unit = "GB"
-    else:
-        total_ram = total_ram_kb / 1024  # Convert to megabytes
-        t_unit = "MB"
-    session['total_ram'] =  f"{total_ram:.2f}{t_unit}"
- 
- 
-    used_ram_kb = get_used_ram()
-    if used_ram_kb >= 1024**2:
-        used_ram = used_ram_kb / (1024**2)  # Convert to gigabytes
-        u_unit = "GB"
-    else:
-        used_ram = used_ram_kb / 1024  # Convert to megabytes
-        u_unit = "MB"
-    session['used_ram'] = f"{used_ram:.2f}{u_unit}"
-    
-    cpu_capacity = get_cpu_capacity()
-    if cpu_capacity is not None:
-        session['cpu_capacity'] = f"{cpu_capacity}"
-    else:
-        session['cpu_capacity'] = 0
-    
-    cpu_usage = get_cpu_usage()
-    session['cpu_usage'] = f"{cpu_usage:.2f}%"
-
-    session['hard_info'] = get_hard_info()
-
-    if req == "true":
+    if get_settings_mtime() != SETTINGS_MTIME:
+        load_settings()
+    # Only changed values are written: an unchanged session sends no Set-Cookie
+    for key, value in (('update', UPDATE), ('dashboard_version', DASHBOARD_VERSION),
+                       ('admin_ip', request.remote_addr)):
+        if session.get(key) != value:
+            session[key] = value
+
+    if get_settings().auth_required:
         if '/static/' not in request.path and \
                 request.endpoint != "signin" and \
                 request.endpoint != "signout" and \
                 request.endpoint != "auth" and \
                 "username" not in session:
             print("کاربر وارد نشده است - تلاش برای دسترسی:" + str(request.endpoint))
+            if request.path.startswith('/api/'):
+                return jsonify({"error": "Sign in through /auth first."}), 401
             if request.endpoint != "index":
                 session['message'] = "لطفا ابتدا وارد شوید."
             else:
                 session['message'] = ""
-            conf.clear()
             redirectURL = str(request.url)
             redirectURL = redirectURL.replace("http://", "")
             redirectURL = redirectURL.replace("https://", "")
@@ -835,9 +931,7 @@ def auth_req():
     else:
         if request.endpoint in ['signin', 'signout', 'auth', 'settings', 'update_acct', 'update_pwd',
                                 'update_app_ip_port', 'update_wg_conf_path']:
-            conf.clear()
             return redirect(url_for("index"))
-    conf.clear()
     return None
 
 """
@@ -875,14 +969,12 @@ def auth():
     @return: json object indicating verifying
     """
     data = request.get_json()
-    config = get_dashboard_conf()
+    config = get_settings()
     password = hashlib.sha256(data['password'].encode())
     if password.hexdigest() == config["Account"]["password"] \
             and data['username'] == config["Account"]["username"]:
         session['username'] = data['username']
-        config.clear()
         return jsonify({"status": True, "msg": ""})
-    config.clear()
     return jsonify({"status": False, "msg": "نام کاربری یا کلمه عبور اشتباه است."})
 
 """
@@ -900,7 +992,29 @@ def index():
         msg = session["switch_msg"]
         session.pop("switch_msg")
 
-    return render_template('index.html', conf=get_conf_list(), msg=msg)
+    return render_index(get_conf_list(), msg)
+
+def render_index(conf_list, msg=""):
+    """
+    Render the index page with the interfaces and the latest system stats
+    @param conf_list: Interfaces, see get_conf_list
+    @param msg: Message shown above the interfaces
+    @return: Template
+    """
+    system_sampler.start()
+    return render_template('index.html', conf=conf_list, msg=msg,
+                           stats=format_system_stats(system_sampler.latest()),
+                           stats_interval=system_stats.SAMPLE_INTERVAL)
+
+@app.route('/system_stats', methods=['GET'])
+def get_system_stats():
+    """
+    CPU, RAM and disk usage of the server, with the recent samples for sparklines
+    @return: JSON {"latest", "history", "interval"}
+    """
+    system_sampler.start()
+    return jsonify({"latest": system_sampler.latest(), "history": system_sampler.history(),
+                    "interval": system_sampler.interval})
 
 # Setting Page
 @app.route('/settings', methods=['GET'])
@@ -911,7 +1025,7 @@ def settings():
     """
     message = ""
     status = ""
-    config = get_dashboard_conf()
+    config = get_settings()
     if "message" in session and "message_status" in session:
         message = session['message']
         status = session['message_status']
@@ -1065,11 +1179,13 @@ def update_app_ip_port():
     """
 
     config = get_dashboard_conf()
+    bind = (config.get("Server", "app_ip"), config.get("Server", "app_port"))
     config.set("Server", "app_ip", request.form['app_ip'])
     config.set("Server", "app_port", request.form['app_port'])
     set_dashboard_conf(config)
     config.clear()
-    subprocess.Popen('bash wgd.sh restart', shell=True)
+    if bind != (request.form['app_ip'], request.form['app_port']):
+        rebind_dashboard()
     return ""
 
 # Update WireGuard configuration file path
@@ -1084,9 +1200,10 @@ def update_wg_conf_path():
     config.set("Server", "wg_conf_path", request.form['wg_conf_path'])
     set_dashboard_conf(config)
     config.clear()
+    load_settings()
     session['message'] = "به روز رسانی مسیر پیکربندی وایرگارد با موفقیت انجام شد!"
     session['message_status'] = "success"
-    subprocess.Popen('bash wgd.sh restart', shell=True)
+    return ""
 
 @app.route('/update_dashboard_sort', methods=['POST'])
 def update_dashbaord_sort():
@@ -1135,7 +1252,7 @@ def configuration(config_name):
     @return: Template
     """
 
-    config = get_dashboard_conf()
+    config = get_settings()
     conf_data = {
         "name": config_name,
         "status": get_conf_status(config_name),
@@ -1147,53 +1264,51 @@ def configuration(config_name):
         conf_data['checked'] = "checked"
     config_list = get_conf_list()
     if config_name not in [conf['conf'] for conf in config_list]:
-        return render_template('index.html', conf=get_conf_list())
+        return render_index(config_list)
 
     refresh_interval = int(config.get("Server", "dashboard_refresh_interval"))
     dns_address = config.get("Peers", "peer_global_DNS")
     allowed_ip = config.get("Peers", "peer_endpoint_allowed_ip")
     peer_mtu = config.get("Peers", "peer_MTU")
     peer_keep_alive = config.get("Peers", "peer_keep_alive")
-    config.clear()
-    return render_template('configuration.html', conf=get_conf_list(), conf_data=conf_data,
+    stream_hub.start()
+    return render_template('configuration.html', conf=config_list, conf_data=conf_data,
                            dashboard_refresh_interval=refresh_interval,
+                           stream_port=config.getint("Server", "stream_port", fallback=0),
                            DNS=dns_address,
                            endpoint_allowed_ip=allowed_ip,
                            title=config_name,
                            mtu=peer_mtu,
                            keep_alive=peer_keep_alive)
 
-# Get configuration details
-@app.route('/get_config/<config_name>', methods=['GET'])
-def get_conf(config_name):
+def get_conf_header(config_name, search):
     """
-    Get configuration setting of wireguard interface.
+    Everything about an interface but its peers: status, totals, the dashboard settings and the generation of
+    the peers. The keys, port and totals come from interface_summary, so requests do not run `wg` for them.
     @param config_name: Name of WG interface
-    @type config_name: str
-    @return: TODO
+    @param search: Search string
+    @return: (dict, ETag of the interface's state)
     """
-
     config_interface = read_conf_file_interface(config_name)
-    search = request.args.get('search')
-    if len(search) == 0:
-        search = ""
-    search = urllib.parse.unquote(search)
-    config = get_dashboard_conf()
-    sort = config.get("Server", "dashboard_sort")
-    peer_display_mode = config.get("Peers", "peer_display_mode")
-    wg_ip = config.get("Peers", "remote_endpoint")
+    config = get_settings()
+    status = get_conf_status(config_name)
+    summary = interface_summary.get_summary(g.cur, config_name, os.path.join(WG_CONF_PATH, config_name + ".conf"),
+                                            status, read_interface_keys)
+    sort = config.dashboard_sort
+    peer_display_mode = config.peer_display_mode
+    wg_ip = config.remote_endpoint
     if "Address" not in config_interface:
         conf_address = "N/A"
     else:
         conf_address = config_interface['Address']
     conf_data = {
-        "peer_data": get_peers(config_name, search, sort),
+        "generation": peer_changes.get_generation(g.cur, config_name)[0],
         "name": config_name,
-        "status": get_conf_status(config_name),
-        "total_data_usage": get_conf_total_data(config_name),
-        "public_key": get_conf_pub_key(config_name),
-        "listen_port": get_conf_listen_port(config_name),
-        "running_peer": get_conf_running_peer_number(config_name),
+        "status": status,
+        "total_data_usage": [summary["total_data"], summary["upload_total"], summary["download_total"]],
+        "public_key": summary["public_key"],
+        "listen_port": summary["listen_port"],
+        "running_peer": summary["running_peers"] if status == "running" else "stopped",
         "conf_address": conf_address,
         "wg_ip": wg_ip,
         "sort_tag": sort,
@@ -1204,8 +1319,88 @@ def get_conf(config_name):
         conf_data['checked'] = "nope"
     else:
         conf_data['checked'] = "checked"
-    config.clear()
-    return jsonify(conf_data)
+    etag = hashlib.sha1(json.dumps([conf_data, search], sort_keys=True).encode()).hexdigest()
+    return conf_data, etag
+
+def add_conf_peers(conf_data, config_name, search, since=None, columns=False):
+    """
+    Add the peers to the header from get_conf_header: every peer, or with since only the peers that changed
+    after that generation, and in "removed" the ids of the peers that are gone
+    @param conf_data: Header from get_conf_header
+    @param config_name: Name of WG interface
+    @param search: Search string
+    @param since: Generation the caller has
+    @param columns: Add them in columnar form as "peer_columns" instead of "peer_data"
+    @return: conf_data
+    """
+    field = "peer_columns" if columns else "peer_data"
+    changes = peer_changes.changes_since(g.cur, config_name, since) if since is not None else None
+    if changes is None:
+        conf_data[field] = get_peers(config_name, search, conf_data["sort_tag"], columns=columns)
+        conf_data["delta"] = False
+    else:
+        changed, removed = changes
+        conf_data[field] = get_peers(config_name, search, conf_data["sort_tag"], changed, columns)
+        # Changed peers that no longer match the search are gone from the caller's list too
+        if columns:
+            matching = set(conf_data[field]["columns"][conf_data[field]["fields"].index("id")])
+        else:
+            matching = {peer["id"] for peer in conf_data[field]}
+        conf_data["removed"] = removed + [peer_id for peer_id in changed if peer_id not in matching]
+        conf_data["delta"] = True
+    return conf_data
+
+# Get configuration details
+@app.route('/get_config/<config_name>', methods=['GET'])
+def get_conf(config_name):
+    """
+    Get configuration setting of wireguard interface. The response has an ETag and the generation of the peers;
+    with If-None-Match it is 304 when nothing changed, and with ?since=<generation> peer_data only has the peers
+    that changed since that generation, and "removed" the ids of the peers that are gone. With ?format=columns
+    the peers are in columnar form, in peer_columns. With ?stream=1 a list of every peer is encoded while it is
+    read, see stream_conf_data.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: TODO
+    """
+
+    search = request.args.get('search')
+    if len(search) == 0:
+        search = ""
+    search = urllib.parse.unquote(search)
+    since = request.args.get('since', type=int)
+    conf_flights.do(("poll", WG_CONF_PATH, config_name), lambda: poll_conf(config_name))
+    conf_data, etag = get_conf_header(config_name, search)
+    columns = request.args.get('format') == "columns"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.args.get('stream') == "1" and (
+            since is None or peer_changes.changes_since(g.cur, config_name, since) is None):
+        # Identical views share one list while it is encoded and streamed, and for a second once it is complete
+        body = conf_flights.stream(("peers", config_name, etag, None, columns),
+                                   lambda: stream_conf_data(conf_data, config_name, search, columns))
+        response = Response(stream_with_context(body), mimetype='application/json')
+    else:
+        def encode():
+            if columns:
+                return columnar.dumps(add_conf_peers(conf_data, config_name, search, since, True))
+            return jsonify(add_conf_peers(conf_data, config_name, search, since)).get_data()
+        response = Response(conf_flights.do(("peers", config_name, etag, since, columns), encode),
+                            mimetype='application/json')
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+def poll_conf(config_name):
+    """
+    Refresh the peers of an interface from WireGuard, for conf_flights: concurrent requests share one poll
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    get_all_peers_data(config_name)
+    peer_changes.forget_removed(g.cur, config_name)
+    # Release the write lock before the peers are sent, and let the requests that shared the poll read its result
+    g.db.commit()
 
 # Turn on / off a configuration
 @app.route('/switch/<config_name>', methods=['GET'])
@@ -1218,20 +1413,19 @@ def switch(config_name):
     """
 
     status = get_conf_status(config_name)
-    if status == "running":
-        try:
-            check = subprocess.check_output("wg-quick down " + config_name,
-                                            shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            session["switch_msg"] = exc.output.strip().decode("utf-8")
-            return redirect('/')
-    elif status == "stopped":
-        try:
-            subprocess.check_output("wg-quick up " + config_name,
-                                    shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            session["switch_msg"] = exc.output.strip().decode("utf-8")
-            return redirect('/')
+    if request.args.get('job') == 'true':
+        action = "down" if status == "running" else "up"
+        return jsonify({"job": job_runner.submit(g.cur, "wg_quick", config_name, {"action": action})})
+    try:
+        # Wait until it is done: only a busy interface is refused, and a slow `up` is not reported as failed
+        wg_quick("down" if status == "running" else "up", config_name, wait=None, exclusive=True)
+    except subprocess.CalledProcessError as exc:
+        session["switch_msg"] = exc.output.strip().decode("utf-8")
+        return redirect('/')
+    finally:
+        conf_status.invalidate()
+        interface_summary.invalidate(config_name)
+        conf_flights.forget()
     return redirect(request.referrer)
 
 @app.route('/add_peer_bulk/<config_name>', methods=['POST'])
@@ -1242,7 +1436,6 @@ def add_peer_bulk(config_name):
     @return: String
     """
     data = request.get_json()
-    keys = data['keys']
     endpoint_allowed_ip = data['endpoint_allowed_ip']
     dns_addresses = data['DNS']
     enable_preshared_key = data["enable_preshared_key"]
@@ -1269,57 +1462,38 @@ def add_peer_bulk(config_name):
     if len(data['keep_alive']) == 0 or not data['keep_alive'].isdigit():
         return "Persistent Keepalive format is not correct."
     
-    ips = f_available_ips(config_name)
-    num_available_ips = len(ips)
+    num_available_ips = f_available_ips(config_name, limit=0)['total']
     
     if amount > num_available_ips:
         return f"Cannot create more than {num_available_ips} peers."
     
-    wg_command = ["wg", "set", config_name]
-    sql_commands = []
+    options = {
+        "DNS": dns_addresses,
+        "endpoint_allowed_ip": endpoint_allowed_ip,
+        "MTU": data['MTU'],
+        "keep_alive": data['keep_alive'],
+        "remote_endpoint": get_settings().remote_endpoint,
+        "enable_preshared_key": enable_preshared_key
+    }
+    if request.args.get('job') == 'true':
+        params = {"conf_address": config_interface['Address'], "amount": amount, "options": options}
+        if 'keys' in data:
+            params['keys'] = data['keys'][:amount]
+        return jsonify({"job": job_runner.submit(g.cur, "add_peers", config_name, params, total=amount)})
     
-    for i in range(amount):
-        if not ips: 
-            break
-        
-        keys[i]['name'] = f"{config_name}_{datetime.now().strftime('%m%d%Y%H%M%S')}_Peer_#_{(i + 1)}"
-        keys[i]['allowed_ips'] = ips.pop(0)
-        
-        if enable_preshared_key:
-            keys[i]['psk_file'] = f"{keys[i]['name']}.txt"
-            
-            with open(keys[i]['psk_file'], "w") as f:
-                f.write(keys[i]['presharedKey'])
-            
-            wg_command.extend(["peer", keys[i]['publicKey'], "preshared-key", keys[i]['psk_file']])
-        else:
-            keys[i]['psk_file'] = ""
-            wg_command.extend(["peer", keys[i]['publicKey']])
-        
-        wg_command.extend(["allowed-ips", keys[i]['allowed_ips']])
-        
-        update = f"UPDATE {config_name} SET name = '{keys[i]['name']}', private_key = '{keys[i]['privateKey']}', " \
-                 f"DNS = '{dns_addresses}', created_at = {time.time()}, " \
-                 f"endpoint_allowed_ip = '{endpoint_allowed_ip}' WHERE id = '{keys[i]['publicKey']}'"
-        
-        sql_commands.append(update)
+    # Keys are generated here unless the client sent its own
+    keys = data['keys'] if 'keys' in data else keygen.generate_keys(amount, enable_preshared_key)
+    steps = bulk.provision_peers(g.cur, config_name, config_interface['Address'], keys, amount, options)
     
-    try:
-        subprocess.check_output(" ".join(wg_command), shell=True, stderr=subprocess.STDOUT)
-        subprocess.check_output("wg-quick save " + config_name, shell=True, stderr=subprocess.STDOUT)
-        get_all_peers_data(config_name)
+    if request.args.get('stream') == 'true':
+        def generate():
+            for step in steps:
+                yield json.dumps(step) + "\n"
         
-        if enable_preshared_key:
-            for i in keys:
-                os.remove(i['psk_file'])
-        
-        for command in sql_commands:
-            g.cur.execute(command)
-        
-        return "true"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
     
-    except subprocess.CalledProcessError as exc:
-        return exc.output.strip()
+    result = bulk.run_to_end(steps)
+    return "true" if result['status'] else result['msg']
 
 @app.route('/add_peer/<config_name>', methods=['POST'])
 def add_peer(config_name):
@@ -1347,10 +1521,8 @@ def add_peer(config_name):
         return config_name + " در حال اجرا نیست. آن را فعال کنید."
     if public_key in keys:
         return "کلید عمومی از قبل وجود دارد."
-    check_dup_ip = g.cur.execute(
-        "SELECT COUNT(*) FROM " + config_name + " WHERE allowed_ip LIKE '" + allowed_ips + "/%'", ) \
-        .fetchone()
-    if check_dup_ip[0] != 0:
+    check_dup_ip = prefix_trie.get_index(g.cur, config_name).conflicts(allowed_ips)
+    if check_dup_ip:
         return "Allowed IPs قبلاً توسط کاربر دیگری استفاده شده است."
     if not check_DNS(dns_addresses):
         return "فرمت DNS نادرست است. مثال: 1.1.1.1"
@@ -1362,19 +1534,11 @@ def add_peer(config_name):
         return "فرمت Persistent Keepalive درست نیست."
     try:
         if enable_preshared_key:
-            now = str(datetime.now().strftime("%m%d%Y%H%M%S"))
-            f_name = now + "_tmp_psk.txt"
-            f = open(f_name, "w+")
-            f.write(preshared_key)
-            f.close()
-            status = subprocess.check_output(
-                f"wg set {config_name} peer {public_key} allowed-ips {allowed_ips} preshared-key {f_name}",
-                shell=True, stderr=subprocess.STDOUT)
-            os.remove(f_name)
+            wg("set", config_name, "peer", public_key, "allowed-ips", allowed_ips, "preshared-key", "/dev/stdin",
+               input=preshared_key)
         elif not enable_preshared_key:
-            status = subprocess.check_output(f"wg set {config_name} peer {public_key} allowed-ips {allowed_ips}",
-                                             shell=True, stderr=subprocess.STDOUT)
-        status = subprocess.check_output("wg-quick save " + config_name, shell=True, stderr=subprocess.STDOUT)
+            wg("set", config_name, "peer", public_key, "allowed-ips", allowed_ips)
+        wg_quick("save", config_name, wait=None)
         get_all_peers_data(config_name)
         sql = "UPDATE " + config_name + " SET name = ?, private_key = ?, DNS = ?, endpoint_allowed_ip = ?, bandwidth = ?, ends_at = ?, timer_on = ?, created_at = ? WHERE id = ?"
         g.cur.execute(sql, (
@@ -1390,38 +1554,103 @@ def remove_peer(config_name):
     Remove peer.
     @param config_name: Name of WG interface
     @type config_name: str
-    @return: Return result of action or recommendations
-    @rtype: str
+    @return: Return recommendations, the job removing the peers, or a JSON object with "status", "msg", the
+             counts of peers "removed", "not_found" and "failed", and the "outcomes" of every peer
+    @rtype: str | Response
     """
 
     if get_conf_status(config_name) == "stopped":
         return "Your need to turn on " + config_name + " first."
 
     data = request.get_json()
-    delete_keys = data['peer_ids']
+    if data.get('action') == "delete_expired":
+        delete_keys = bulk.expired_peer_ids(g.cur, config_name)
+    else:
+        delete_keys = data['peer_ids']
     keys = get_conf_peer_key(config_name)
 
     if not isinstance(keys, list):
         return config_name + " در حال اجرا نیست. آن را فعال کنید."
 
-    sql_command = []
-    wg_command = ["wg", "set", config_name]
-
-    for delete_key in delete_keys:
-        sql_command.append("DELETE FROM " + config_name + " WHERE id = '" + delete_key + "';")
-        wg_command.append("peer")
-        wg_command.append(delete_key)
-        wg_command.append("remove")
+    if request.args.get('job') == 'true':
+        return jsonify({"job": job_runner.submit(g.cur, "remove_peers", config_name, {"peer_ids": delete_keys},
+                                                 total=len(delete_keys))})
+
+    result = bulk.run_to_end(bulk.remove_peers(g.cur, config_name, delete_keys))
+    outcomes = result['outcomes']
+    removed = sum(outcome == "removed" for outcome in outcomes.values())
+    not_found = sum(outcome == "not_found" for outcome in outcomes.values())
+    return jsonify({
+        "status": result['status'],
+        "msg": result['msg'],
+        "removed": removed,
+        "not_found": not_found,
+        "failed": len(outcomes) - removed - not_found,
+        "outcomes": outcomes
+    })
+
+@app.route('/api/v1/<config_name>/peers:batch', methods=['POST'])
+def peers_batch(config_name):
+    """
+    Apply a batch of create / update / disable / delete peer operations with one kernel change and one
+    configuration save. Body: {"operations": [...], "atomic": false}
+    @param config_name: Name of WG interface
+    @return: JSON object with per-operation results
+    """
+    if config_name not in get_config_names():
+        return jsonify({"error": "Configuration does not exist."}), 404
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or len(operations) == 0:
+        return jsonify({"error": "operations must be a non-empty list."}), 400
+    if len(operations) > peer_batch.MAX_OPERATIONS:
+        return jsonify({"error": f"At most {peer_batch.MAX_OPERATIONS} operations per batch."}), 413
+
+    conf_address = read_conf_file_interface(config_name).get('Address', '')
+    results = peer_batch.apply_batch(g.cur, config_name, conf_address, operations, get_peer_defaults(),
+                                     atomic=bool(data.get('atomic')))
+    return jsonify({
+        "applied": sum(result['status'] == "success" for result in results),
+        "failed": sum(result['status'] != "success" for result in results),
+        "results": results
+    })
+
+@app.route('/export/<config_name>', methods=['GET'])
+def export_peers(config_name):
+    """
+    Stream every peer of a configuration as CSV or JSON lines.
+    @param config_name: Name of WG interface
+    @return: text/csv or application/x-ndjson
+    """
+    fmt = request.args.get('format', 'csv')
+    if config_name not in get_config_names() or fmt not in peer_io.FORMATS:
+        return "Unknown configuration or format.", 404
+    blocks = peer_io.export_peers(g.db.cursor(), config_name, fmt)
+    return Response(stream_with_context(blocks), mimetype=peer_io.FORMATS[fmt], headers={
+        "Content-Disposition": f"attachment; filename={config_name}_peers.{fmt}"
+    })
 
-    try:
-        remove_wg = subprocess.check_output(" ".join(wg_command), shell=True, stderr=subprocess.STDOUT)
-        save_wg = subprocess.check_output(f"wg-quick save {config_name}", shell=True, stderr=subprocess.STDOUT)
-        g.cur.executescript(' '.join(sql_command))
-        g.db.commit()
-    except subprocess.CalledProcessError as exc:
-        return exc.output.strip()
+@app.route('/import/<config_name>', methods=['POST'])
+def import_peers(config_name):
+    """
+    Import peers from an uploaded CSV or JSON lines file (as produced by /export), inserting new peers and
+    overwriting existing ones.
+    @param config_name: Name of WG interface
+    @return: JSON summary
+    """
+    if config_name not in get_config_names():
+        return jsonify({"status": False, "msg": "Configuration does not exist."}), 404
+    if 'file' not in request.files:
+        return jsonify({"status": False, "msg": "No file uploaded."}), 400
+    file = request.files['file']
+    fmt = request.args.get('format') or file.filename.rsplit('.', 1)[-1].lower()
+    if fmt not in peer_io.FORMATS:
+        return jsonify({"status": False, "msg": "Format must be csv or jsonl."}), 400
+    if get_conf_status(config_name) == "stopped":
+        return jsonify({"status": False, "msg": config_name + " در حال اجرا نیست. آن را فعال کنید."})
 
-    return "true"
+    records = peer_io.read_records(io.TextIOWrapper(file.stream, encoding='utf-8', newline=''), fmt)
+    return jsonify(bulk.run_to_end(peer_io.import_peers(g.cur, config_name, records, get_peer_defaults())))
 
 @app.route('/save_peer_setting/<config_name>', methods=['POST'])
 def save_peer_setting(config_name):
@@ -1471,42 +1700,36 @@ def save_peer_setting(config_name):
             return jsonify(check_ip)
         try:
             if end_active:
-                tmp_file = 'tmp_edit_psk.txt'
-                tmp_psk = open(tmp_file, "w+")
-                tmp_psk.write(preshared_key)
-                tmp_psk.close()
+                wg_cmd = ['set', config_name, 'peer', id, 'preshared-key', '/dev/stdin']
 
-                wg_cmd = ['wg', 'set', config_name, 'peer', id, 'preshared-key', tmp_file]
-
-                change_psk = subprocess.check_output(f"wg set {config_name} peer {id} preshared-key tmp_edit_psk.txt",
-                                                     shell=True, stderr=subprocess.STDOUT)
+                change_psk = wg(*wg_cmd, input=preshared_key)
                 if change_psk.decode("UTF-8") != "":
                     return jsonify({"status": "failed", "msg": change_psk.decode("UTF-8")})
 
-                if allowed_ip == "":
-                    allowed_ip = '""'
-
                 allowed_ip = allowed_ip.replace(" ", "")
                 wg_cmd.append('allowed-ips')
                 wg_cmd.append(allowed_ip)
-                output = subprocess.check_output(" ".join(wg_cmd), shell=True, stderr=subprocess.STDOUT)
+                output = wg(*wg_cmd, input=preshared_key)
 
                 if output.decode("UTF-8") != "":
                     return jsonify({"status": "failed", "msg": output.decode("UTF-8")})
             else:
-                output = subprocess.check_output(f"wg set {config_name} peer {id} remove", shell=True,
-                                                 stderr=subprocess.STDOUT).decode('UTF-8')
+                output = wg("set", config_name, "peer", id, "remove").decode('UTF-8')
 
                 if output:
                     return jsonify({"status": "failed", "msg": output})
 
-            subprocess.check_output(f'wg-quick save {config_name}', shell=True, stderr=subprocess.STDOUT)
+            wg_quick("save", config_name, wait=None)
+            interface_summary.invalidate(config_name)
 
             sql = "UPDATE " + config_name + " SET name = ?, bandwidth = ?, private_key = ?, DNS = ?, endpoint_allowed_ip = ?, mtu = ?, keepalive = ?, preshared_key = ?, end_active = ?, ends_at = ? WHERE id = ?"
 
             g.cur.execute(sql, (name, bandwidth, private_key, dns_addresses, endpoint_allowed_ip, data["MTU"],
                                 data["keep_alive"], preshared_key, int(end_active),
                                 ends_at, id))
+            if end_active:
+                # Record the new addresses now rather than at the next poll, so the old reservation is released
+                g.cur.execute("UPDATE " + config_name + " SET allowed_ip = ? WHERE id = ?", (allowed_ip, id))
 
             return jsonify({"status": "success", "msg": ""})
         except subprocess.CalledProcessError as exc:
@@ -1541,7 +1764,16 @@ def get_peer_name(config_name):
 # Return available IPs
 @app.route('/available_ips/<config_name>', methods=['GET'])
 def available_ips(config_name):
-    return jsonify(f_available_ips(config_name))
+    """
+    Get a page of available IPs
+    @param config_name: Configuration Name
+    @return: JSON object with "ips", "next" (cursor for the following page) and "total"
+    """
+    limit = min(request.args.get('limit', 256, type=int), 4096)
+    try:
+        return jsonify(f_available_ips(config_name, request.args.get('after'), limit, request.args.get('prefix')))
+    except ValueError:
+        return jsonify({"ips": [], "next": None, "total": 0})
 
 # Check if both key match
 @app.route('/check_key_match/<config_name>', methods=['POST'])
@@ -1569,7 +1801,7 @@ def generate_qrcode(config_name):
     get_peer = g.cur.execute(
         "SELECT private_key, allowed_ip, DNS, mtu, endpoint_allowed_ip, keepalive, preshared_key FROM "
         + config_name + " WHERE id = ?", (peer_id,)).fetchall()
-    config = get_dashboard_conf()
+    config = get_settings()
     if len(get_peer) == 1:
         peer = get_peer[0]
         if peer[0] != "":
@@ -1597,14 +1829,25 @@ def generate_qrcode(config_name):
 @app.route('/download_all/<config_name>', methods=['GET'])
 def download_all(config_name):
     """
-    Download all configuration
+    Download all configuration. Concurrent downloads of the same peers share one encoding.
     @param config_name: Configuration Name
     @return: JSON Object
     """
+    key = ("download_all", config_name, peer_changes.get_generation(g.cur, config_name)[0],
+           interface_summary.file_key(os.path.join(WG_CONF_PATH, config_name + ".conf")),
+           get_settings().remote_endpoint, get_conf_status(config_name))
+    return Response(conf_flights.do(key, lambda: build_download_all(config_name)), mimetype='application/json')
+
+def build_download_all(config_name):
+    """
+    Encode the configuration of every peer that has a private key
+    @param config_name: Configuration Name
+    @return: bytes, JSON
+    """
     get_peer = g.cur.execute(
         "SELECT private_key, allowed_ip, DNS, mtu, endpoint_allowed_ip, keepalive, preshared_key, name FROM "
         + config_name + " WHERE private_key != ''").fetchall()
-    config = get_dashboard_conf()
+    config = get_settings()
     data = []
     public_key = get_conf_pub_key(config_name)
     listen_port = get_conf_listen_port(config_name)
@@ -1641,7 +1884,7 @@ def download_all(config_name):
                       public_key + "\nAllowedIPs = " + endpoint_allowed_ip + "\nEndpoint = " + \
                       endpoint + "\nPersistentKeepalive = " + str(keepalive) + psk
         data.append({"filename": f"{filename}.conf", "content": return_data})
-    return jsonify({"status": True, "peers": data, "filename": f"{config_name}.zip"})
+    return jsonify({"status": True, "peers": data, "filename": f"{config_name}.zip"}).get_data()
 
 # Download configuration file
 @app.route('/download/<config_name>', methods=['GET'])
@@ -1655,7 +1898,7 @@ def download(config_name):
     get_peer = g.cur.execute(
         "SELECT private_key, allowed_ip, DNS, mtu, endpoint_allowed_ip, keepalive, preshared_key, name FROM "
         + config_name + " WHERE id = ?", (peer_id,)).fetchall()
-    config = get_dashboard_conf()
+    config = get_settings()
     if len(get_peer) == 1:
         peer = get_peer[0]
         if peer[0] != "":
@@ -1796,29 +2039,219 @@ def traceroute_ip():
     except Exception:
         return "Error"
 
-@app.route('/backup', methods=['GET'])
-def backup():
-    files_to_zip = [os.path.abspath(i) for i in [
-        DB_FILE_PATH, DASHBOARD_CONF
-    ]]
+# Latency of wg / wg-quick calls made by this worker
+@app.route('/command_stats', methods=['GET'])
+def get_command_stats():
+    """
+    Get per-command latency statistics.
+    @return: JSON object
+    """
+    return jsonify(command_stats())
 
-    conf_files_path = WG_CONF_PATH
-    conf_files_to_zip = [os.path.join(conf_files_path, f) for f in os.listdir(conf_files_path) if f.endswith('.conf')]
-    files_to_zip.extend(conf_files_to_zip)
+def create_backup(zip_path):
+    """
+    Zip a consistent snapshot of the database, the dashboard settings and every WireGuard configuration
+    @param zip_path: Path of the zip file to write
+    @return: None
+    """
+    backups.write_zip(zip_path, backups.backup_members(DB_FILE_PATH, DASHBOARD_CONF, WG_CONF_PATH))
 
-    now = datetime.now()
-    zip_file_name = now.strftime("%Y-%m-%d%H%M%S") + '.zip'
+def get_backup_schedule():
+    """
+    Scheduled backup settings
+    @return: (interval in hours, 0 when disabled; number of backups kept)
+    """
+    config = get_settings()
+    schedule = (config.getfloat("Server", "backup_interval", fallback=0),
+                config.getint("Server", "backup_retention", fallback=7))
+    return schedule
+
+def stage_backup_member(zf, info, dest):
+    """
+    Stream a zip member to a staging file next to its destination, so it can be moved in place atomically
+    @param zf: zipfile.ZipFile
+    @param info: zipfile.ZipInfo
+    @param dest: Destination path
+    @return: Path of the staging file
+    @raise zipfile.BadZipFile: CRC mismatch
+    """
+    import shutil
+    import tempfile
 
-    with zipfile.ZipFile(zip_file_name, 'w') as myzip:
-        for file in files_to_zip:
-            myzip.write(file)
+    fd, tmp = tempfile.mkstemp(prefix='.restore-', dir=os.path.dirname(os.path.abspath(dest)))
+    with os.fdopen(fd, 'wb') as out, zf.open(info) as member:
+        shutil.copyfileobj(member, out, 1024 * 1024)
+    return tmp
 
-    response = send_file(zip_file_name, as_attachment=True, download_name='wgdashboard_backup_' + now.strftime("%Y-%m-%d_%H%M%S") + '.zip')
+def check_backup_database(path):
+    """
+    Check the integrity and the schema of a database from a backup, and create the tables and triggers the
+    dashboard maintains so it is ready before it is swapped in
+    @param path: Staged database file
+    @return: None
+    @raise ValueError: The database is corrupted or is not a dashboard database
+    """
+    try:
+        db = sqlite3.connect(path)
+        try:
+            if db.execute("PRAGMA integrity_check").fetchall() != [("ok",)]:
+                raise ValueError('دیتابیس بکاپ خراب است')
+            cur = db.cursor()
+            ip_allocator.create_allocation_tables(cur)
+            enforcement.create_limit_tables(cur)
+            peer_changes.create_change_tables(cur)
+            prefix_trie.create_index_tables(cur)
+            jobs.create_jobs_table(cur)
+            for (table,) in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                columns = {row[1] for row in cur.execute(f'PRAGMA table_info("{table}")')}
+                if "allowed_ip" not in columns:
+                    continue
+                if not columns.issuperset(bulk.PEER_COLUMNS):
+                    raise ValueError(f'جدول {table} در دیتابیس بکاپ ناقص است')
+                ip_allocator.install_revision_triggers(cur, table)
+                enforcement.install_limit_triggers(cur, table)
+                peer_changes.install_change_triggers(cur, table)
+                prefix_trie.install_index_triggers(cur, table)
+            db.commit()
+        finally:
+            db.close()
+    except sqlite3.DatabaseError:
+        raise ValueError('فایل دیتابیس بکاپ معتبر نیست')
+
+def check_backup_text(path, name):
+    """
+    Check the syntax of the settings or a WireGuard configuration from a backup
+    @param path: Staged file
+    @param name: File name in the backup
+    @return: None
+    @raise ValueError: The file can not be parsed
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        if name == 'wg-dashboard.ini':
+            config = configparser.ConfigParser(strict=False)
+            config.read_string(text)
+            valid = config.has_section("Server")
+        else:
+            valid = "[Interface]" in (line.strip() for line in text.splitlines())
+    except (UnicodeDecodeError, configparser.Error):
+        valid = False
+    if not valid:
+        raise ValueError(f'فایل {name} در بکاپ معتبر نیست')
+
+def restore_backup(zip_path):
+    """
+    Restore wgdashboard.db, wg-dashboard.ini and all .conf wireguard configs from a backup zip file, without
+    extracting it: each member is streamed to a staging file next to its destination and validated. Only when
+    all of them pass are they moved in place with atomic renames, the database while holding an exclusive lock
+    on the live one. Every process then reloads its settings, caches and database connections.
+    @param zip_path: Path of the uploaded zip file
+    @return: list of restored items
+    @raise ValueError: The zip is not a backup, or a member is invalid
+    @raise zipfile.BadZipFile: The zip is corrupted
+    """
+    staged = {}
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir():
+                    continue
+                if name == 'wgdashboard.db':
+                    dest, label = DB_FILE_PATH, 'دیتابیس'
+                elif name == 'wg-dashboard.ini':
+                    dest, label = DASHBOARD_CONF, 'تنظیمات پنل'
+                elif name.endswith('.conf') and re.fullmatch(r'[a-zA-Z0-9_=+.-]{1,15}', name[:-5]):
+                    dest, label = os.path.join(WG_CONF_PATH, name), name
+                else:
+                    continue
+                if dest not in staged:
+                    staged[dest] = (stage_backup_member(zf, info, dest), name, label)
+
+        # اعتبارسنجی: حداقل یکی از فایل‌های اصلی باید وجود داشته باشد
+        if not staged:
+            raise ValueError('فایل بکاپ معتبر نیست')
+        for dest, (tmp, name, label) in staged.items():
+            if dest == DB_FILE_PATH:
+                check_backup_database(tmp)
+            else:
+                check_backup_text(tmp, name)
 
-    os.remove(zip_file_name)
+        for dest, (tmp, name, label) in staged.items():
+            if dest == DB_FILE_PATH:
+                database.swap_in(tmp, dest)
+            else:
+                os.replace(tmp, dest)
+                if name.endswith('.conf'):
+                    interface_summary.invalidate(name[:-5])
+    finally:
+        for tmp, name, label in staged.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    reload_settings_everywhere()
+    return [label for tmp, name, label in staged.values()]
 
-    return response
+def restart_dashboard_later():
+    """
+    Restart the dashboard in the background, e.g. after a restore
+    @return: None
+    """
+    def delayed_restart():
+        time.sleep(2)
+        # اول systemd رو امتحان می‌کنه، بعد wgd.sh
+        ret = subprocess.call(['systemctl', 'restart', 'wg-dashboard'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if ret != 0:
+            wgd_sh = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wgd.sh')
+            subprocess.call(['bash', wgd_sh, 'restart'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+    Thread(target=delayed_restart, daemon=True).start()
+
+def rebind_dashboard():
+    """
+    Move the dashboard to the address in the settings. Gunicorn does it on SIGHUP by starting workers on the
+    new address and stopping the old ones gracefully; the standalone server has to restart.
+    @return: None
+    """
+    if SERVER_PID is not None:
+        os.kill(SERVER_PID, signal.SIGHUP)
+    else:
+        restart_dashboard_later()
+
+@app.route('/backup', methods=['GET'])
+def backup():
+    now = datetime.now()
+
+    if request.args.get('job') == 'true':
+        return jsonify({"job": job_runner.submit(g.cur, "backup", params={"time": now.strftime("%Y-%m-%d_%H%M%S")})})
+
+    # Streamed while the snapshot is zipped: nothing is written to disk
+    members = backups.backup_members(DB_FILE_PATH, DASHBOARD_CONF, WG_CONF_PATH)
+    return Response(backups.zip_stream(members), mimetype='application/zip', headers={
+        "Content-Disposition": "attachment; filename=wgdashboard_backup_" + now.strftime("%Y-%m-%d_%H%M%S") + ".zip"
+    })
+
+@app.route('/backups', methods=['GET'])
+def list_scheduled_backups():
+    """
+    Backups taken by the schedule, newest first.
+    @return: JSON list
+    """
+    return jsonify([{"name": os.path.basename(path), "size": os.path.getsize(path),
+                     "time": os.path.getmtime(path)} for path in backup_scheduler.scheduled()])
+
+@app.route('/backups/<name>', methods=['GET'])
+def download_scheduled_backup(name):
+    """
+    Download a backup taken by the schedule.
+    @param name: File name
+    @return: File
+    """
+    if name not in [os.path.basename(path) for path in backup_scheduler.scheduled()]:
+        return "Backup not found.", 404
+    return send_file(os.path.join(os.path.abspath(BACKUP_PATH), name), as_attachment=True, download_name=name)
 
 @app.route('/restore', methods=['POST'])
 def restore():
@@ -1839,67 +2272,24 @@ def restore():
     import tempfile, shutil
 
     tmp_dir = tempfile.mkdtemp(prefix='wgd_restore_')
-    try:
-        tmp_zip = os.path.join(tmp_dir, 'backup.zip')
-        file.save(tmp_zip)
-
-        with zipfile.ZipFile(tmp_zip, 'r') as zf:
-            names = zf.namelist()
-
-            # اعتبارسنجی: حداقل یکی از فایل‌های اصلی باید وجود داشته باشد
-            has_db   = any(n.endswith('wgdashboard.db') for n in names)
-            has_ini  = any(n.endswith('wg-dashboard.ini') for n in names)
-            has_conf = any(n.endswith('.conf') for n in names)
+    tmp_zip = os.path.join(tmp_dir, 'backup.zip')
+    file.save(tmp_zip)
 
-            if not (has_db or has_ini or has_conf):
-                return jsonify({'status': False, 'message': 'فایل بکاپ معتبر نیست'})
+    if request.args.get('job') == 'true':
+        # The job owns the upload from now on
+        return jsonify({'status': True, 'job': job_runner.submit(g.cur, "restore", params={"tmp_dir": tmp_dir})})
 
-            zf.extractall(tmp_dir)
-
-        restored = []
-
-        # بازیابی دیتابیس
-        for root, dirs, files_list in os.walk(tmp_dir):
-            for fname in files_list:
-                src = os.path.join(root, fname)
-
-                if fname == 'wgdashboard.db':
-                    os.makedirs(os.path.dirname(DB_FILE_PATH), exist_ok=True)
-                    shutil.copy2(src, DB_FILE_PATH)
-                    restored.append('دیتابیس')
-
-                elif fname == 'wg-dashboard.ini':
-                    shutil.copy2(src, DASHBOARD_CONF)
-                    restored.append('تنظیمات پنل')
-
-                elif fname.endswith('.conf') and fname != 'backup.zip':
-                    dest = os.path.join(WG_CONF_PATH, fname)
-                    shutil.copy2(src, dest)
-                    restored.append(fname)
-
-        if not restored:
-            return jsonify({'status': False, 'message': 'هیچ فایلی بازیابی نشد'})
-
-        # ریستارت اتوماتیک پنل بعد از ریستور موفق
-        def delayed_restart():
-            import time
-            time.sleep(2)
-            # اول systemd رو امتحان می‌کنه، بعد wgd.sh
-            ret = subprocess.call(['systemctl', 'restart', 'wg-dashboard'],
-                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            if ret != 0:
-                wgd_sh = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wgd.sh')
-                subprocess.call(['bash', wgd_sh, 'restart'],
-                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        Thread(target=delayed_restart, daemon=True).start()
+    try:
+        restored = restore_backup(tmp_zip)
 
         return jsonify({
             'status': True,
-            'message': 'بازیابی با موفقیت انجام شد. پنل در حال ری‌استارت است...',
+            'message': 'بازیابی با موفقیت انجام شد.',
             'restored': restored
         })
 
+    except ValueError as e:
+        return jsonify({'status': False, 'message': str(e)})
     except zipfile.BadZipFile:
         return jsonify({'status': False, 'message': 'فایل ZIP خراب است'})
     except Exception as e:
@@ -1907,6 +2297,213 @@ def restore():
     finally:
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
+"""
+Background Jobs
+"""
+
+@contextlib.contextmanager
+def job_context(job):
+    """
+    Run a job handler in an app context whose g.db / g.cur are the job's, so dashboard helpers work in it
+    @param job: jobs.Job
+    """
+    with app.app_context():
+        g.db = job.db
+        g.cur = job.cur
+        yield
+
+job_runner = jobs.JobRunner(connect_db, context=job_context)
+enforcement_engine = enforcement.EnforcementEngine(connect_db, get_config_names,
+                                                   os.path.join(DB_PATH, 'enforcement.lock'))
+backup_scheduler = backups.BackupScheduler(BACKUP_PATH, DB_FILE_PATH, DASHBOARD_CONF, lambda: WG_CONF_PATH,
+                                           get_backup_schedule, os.path.join(DB_PATH, 'backup.lock'))
+conf_status = interface_status.InterfaceStatus()
+# Computations shared by concurrent identical requests
+conf_flights = singleflight.Group()
+
+def collect_streams(channels):
+    """
+    Refresh the interfaces watched by open streams, then build the event of every (search, generation) they are at
+    @param channels: dict of config name -> set of (search, generation)
+    @return: dict of (config name, search, generation) -> (generation, ETag, payload)
+    """
+    snapshots = {}
+    with app.app_context():
+        g.db = connect_db()
+        g.cur = g.db.cursor()
+        try:
+            config_names = get_config_names()
+            for config_name, keys in channels.items():
+                if config_name not in config_names:
+                    continue
+                get_all_peers_data(config_name)
+                peer_changes.forget_removed(g.cur, config_name)
+                g.db.commit()
+                for search, since in keys:
+                    conf_data, etag = get_conf_header(config_name, search)
+                    snapshots[(config_name, search, since)] = (
+                        conf_data["generation"], etag, add_conf_peers(conf_data, config_name, search, since, True))
+        finally:
+            g.db.close()
+    return snapshots
+
+def get_stream_interval():
+    """
+    Seconds between two collections of the streamed interfaces: the refresh interval of the dashboard
+    @return: float
+    """
+    return get_settings().refresh_interval
+
+def admit_stream(config_name, headers):
+    """
+    Check a stream request of stream_hub: the interface must exist and, when sign in is required, the session
+    cookie must be of a signed in user
+    @param config_name: Name of WG interface
+    @param headers: Request headers with lower case names
+    @return: None, or the HTTP status refusing the stream
+    """
+    if config_name not in get_config_names():
+        return "404 Not Found"
+    if get_settings().auth_required:
+        with app.test_request_context(headers={"Cookie": headers.get("cookie", "")}):
+            if "username" not in session:
+                return "401 Unauthorized"
+    return None
+
+def get_stream_address():
+    """
+    Address stream_hub listens on: the dashboard's IP and the stream port, 0 when streams are off
+    @return: (host, port)
+    """
+    config = get_settings()
+    return config.get("Server", "app_ip"), config.getint("Server", "stream_port", fallback=0)
+
+stream_hub = peer_stream.StreamHub(collect_streams, get_stream_interval, admit_stream, get_stream_address)
+system_sampler = system_stats.SystemSampler()
+
+def remove_backup_file(result):
+    os.remove(os.path.join(BACKUP_PATH, result['file']))
+
+@job_runner.handler("add_peers")
+def add_peers_job(job):
+    params = job.params
+    options = params['options']
+    keys = params['keys'] if 'keys' in params else keygen.generate_keys(params['amount'],
+                                                                          options['enable_preshared_key'])
+    for step in bulk.provision_peers(g.cur, job.config_name, params['conf_address'], keys, params['amount'],
+                                     options):
+        job.progress(step['created'], step['total'])
+    if not step['status']:
+        raise jobs.JobError(step['msg'])
+    return step
+
+@job_runner.handler("remove_peers")
+def remove_peers_job(job):
+    for step in bulk.remove_peers(g.cur, job.config_name, job.params['peer_ids']):
+        job.progress(step['removed'], step['total'])
+    if not step['status']:
+        raise jobs.JobError(step['msg'])
+    return step
+
+@job_runner.handler("wg_quick")
+def wg_quick_job(job):
+    try:
+        wg_quick(job.params['action'], job.config_name, wait=None)
+    finally:
+        conf_status.invalidate()
+        interface_summary.invalidate(job.config_name)
+        conf_flights.forget()
+    return {"status": get_conf_status(job.config_name)}
+
+@job_runner.handler("backup", cleanup=remove_backup_file)
+def backup_job(job):
+    os.makedirs(BACKUP_PATH, exist_ok=True)
+    # Named after the job, so concurrent backups never collide
+    name = job.id + '.zip'
+    create_backup(os.path.join(BACKUP_PATH, name))
+    return {"file": name, "name": 'wgdashboard_backup_' + job.params['time'] + '.zip'}
+
+@job_runner.handler("restore")
+def restore_job(job):
+    import shutil
+
+    tmp_dir = job.params['tmp_dir']
+    try:
+        restored = restore_backup(os.path.join(tmp_dir, 'backup.zip'))
+    except ValueError as e:
+        raise jobs.JobError(str(e))
+    except zipfile.BadZipFile:
+        raise jobs.JobError('فایل ZIP خراب است')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'message': 'بازیابی با موفقیت انجام شد.', 'restored': restored}
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Most recent background jobs.
+    @return: JSON list
+    """
+    return jsonify(job_runner.recent(g.cur))
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status and progress of a background job.
+    @param job_id: Job id
+    @return: JSON object
+    """
+    job = job_runner.get(g.cur, job_id)
+    if job is None:
+        return jsonify({"status": "unknown", "error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """
+    Stream a line of JSON every time the job's progress or status changes, until it finishes.
+    @param job_id: Job id
+    @return: application/x-ndjson
+    """
+    def generate():
+        last = None
+        while True:
+            job = job_runner.get(g.cur, job_id)
+            if job is None:
+                yield json.dumps({"status": "unknown", "error": "Job not found"}) + "\n"
+                return
+            state = (job['status'], job['progress'], job['total'], job['message'])
+            if state != last:
+                last = state
+                yield json.dumps(job) + "\n"
+            if job['status'] in jobs.FINISHED:
+                return
+            time.sleep(jobs.PROGRESS_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Cancel a background job.
+    @param job_id: Job id
+    @return: "true" or "false"
+    """
+    return "true" if job_runner.cancel(g.cur, job_id) else "false"
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def download_job_result(job_id):
+    """
+    Download the file produced by a finished backup job.
+    @param job_id: Job id
+    @return: File
+    """
+    job = job_runner.get(g.cur, job_id)
+    if job is None or job['status'] != "done" or not job['result'] or 'file' not in job['result']:
+        return "Job has no file to download.", 404
+    return send_file(os.path.join(os.path.abspath(BACKUP_PATH), job['result']['file']), as_attachment=True,
+                     download_name=job['result'].get('name', job['result']['file']))
+
 """
 Dashboard Initialization
 """
@@ -1929,6 +2526,9 @@ def init_dashboard():
         config['Server']['app_ip'] = '0.0.0.0'
     if 'app_port' not in config['Server']:
         config['Server']['app_port'] = '10086'
+    # Server-Sent Events of the configuration pages are served on a port of their own, 0 turns them off
+    if 'stream_port' not in config['Server']:
+        config['Server']['stream_port'] = str(int(config['Server']['app_port']) + 1)
     if 'auth_req' not in config['Server']:
         config['Server']['auth_req'] = 'true'
     if 'version' not in config['Server'] or config['Server']['version'] != DASHBOARD_VERSION:
@@ -1937,6 +2537,10 @@ def init_dashboard():
         config['Server']['dashboard_refresh_interval'] = '10000'
     if 'dashboard_sort' not in config['Server']:
         config['Server']['dashboard_sort'] = 'status'
+    if 'backup_interval' not in config['Server']:
+        config['Server']['backup_interval'] = '0'
+    if 'backup_retention' not in config['Server']:
+        config['Server']['backup_retention'] = '7'
     # Default dashboard peers setting
     if "Peers" not in config:
         config['Peers'] = {}
@@ -1962,7 +2566,7 @@ def check_update():
     @return: Return text with result
     @rtype: str
     """
-    config = get_dashboard_conf()
+    config = get_settings()
     try:
         data = urllib.request.urlopen("https://api.github.com/repos/amirmbn/WireGuard-Dashboard.git").read()
         output = json.loads(data)
@@ -1995,9 +2599,12 @@ def run_dashboard():
     app_ip = config.get("Server", "app_ip")
     # global app_port
     app_port = config.get("Server", "app_port")
-    global WG_CONF_PATH
-    WG_CONF_PATH = config.get("Server", "wg_conf_path")
     config.clear()
+    load_settings()
+    job_runner.start()
+    enforcement_engine.start()
+    backup_scheduler.start()
+    system_sampler.start()
     return app
 
 """
@@ -2037,6 +2644,11 @@ if __name__ == "__main__":
     app_ip = config.get("Server", "app_ip")
     # global app_port
     app_port = config.get("Server", "app_port")
-    WG_CONF_PATH = config.get("Server", "wg_conf_path")
     config.clear()
+    load_settings()
+    signal.signal(signal.SIGHUP, handle_sighup)
+    job_runner.start()
+    enforcement_engine.start()
+    backup_scheduler.start()
+    system_sampler.start()
     app.run(host=app_ip, debug=False, port=app_port)
@@ -0,0 +1,161 @@
+import configparser
+import os
+import shutil
+import threading
+import types
+
+_UNSET = object()
+
+
+class Settings:
+    """
+    Immutable snapshot of wg-dashboard.ini. Reading it costs no file access; changes go through
+    SettingsStore.write with a ConfigParser from to_parser().
+    """
+
+    def __init__(self, sections, key=None):
+        """
+        @param sections: dict of section -> dict of option -> raw value
+        @param key: Identity of the file the snapshot was read from, see SettingsStore
+        """
+        self._sections = types.MappingProxyType(
+            {section: types.MappingProxyType({option.lower(): value for option, value in options.items()})
+             for section, options in sections.items()})
+        self.key = key
+
+    @classmethod
+    def from_parser(cls, parser, key=None):
+        """
+        @param parser: configparser.ConfigParser
+        @return: Settings
+        """
+        return cls({section: dict(parser.items(section, raw=True)) for section in parser.sections()}, key)
+
+    def to_parser(self):
+        """
+        A ConfigParser holding these settings, to edit and pass to SettingsStore.write
+        @return: configparser.ConfigParser
+        """
+        parser = configparser.ConfigParser(strict=False)
+        parser.read_dict({section: dict(options) for section, options in self._sections.items()})
+        return parser
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def get(self, section, option, fallback=_UNSET):
+        """
+        @return: str
+        @raise configparser.NoSectionError, configparser.NoOptionError: Missing and no fallback
+        """
+        try:
+            return self._sections[section][option.lower()]
+        except KeyError:
+            if fallback is not _UNSET:
+                return fallback
+            if section not in self._sections:
+                raise configparser.NoSectionError(section) from None
+            raise configparser.NoOptionError(option, section) from None
+
+    def _convert(self, section, option, fallback, convert):
+        if fallback is not _UNSET and option.lower() not in self._sections.get(section, {}):
+            return fallback
+        return convert(self.get(section, option))
+
+    def getint(self, section, option, fallback=_UNSET):
+        return self._convert(section, option, fallback, int)
+
+    def getfloat(self, section, option, fallback=_UNSET):
+        return self._convert(section, option, fallback, float)
+
+    def getboolean(self, section, option, fallback=_UNSET):
+        def convert(value):
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(f"Not a boolean: {value}")
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        return self._convert(section, option, fallback, convert)
+
+    @property
+    def auth_required(self):
+        return self.get("Server", "auth_req") == "true"
+
+    @property
+    def wg_conf_path(self):
+        return self.get("Server", "wg_conf_path")
+
+    @property
+    def dashboard_sort(self):
+        return self.get("Server", "dashboard_sort")
+
+    @property
+    def refresh_interval(self):
+        """
+        @return: float, seconds between two refreshes of the dashboard
+        """
+        return int(self.get("Server", "dashboard_refresh_interval")) / 1000
+
+    @property
+    def peer_display_mode(self):
+        return self.get("Peers", "peer_display_mode")
+
+    @property
+    def remote_endpoint(self):
+        return self.get("Peers", "remote_endpoint")
+
+
+class SettingsStore:
+    """
+    Keeps the Settings of a file loaded once: current() parses the file again only when it was replaced or
+    modified, and write() replaces it atomically and swaps the snapshot in.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Path of wg-dashboard.ini
+        """
+        self.path = path
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def _key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def current(self):
+        """
+        @return: Settings, loaded again if the file changed since it was last read
+        """
+        key = self._key()
+        settings = self._settings
+        if settings is not None and settings.key == key:
+            return settings
+        with self._lock:
+            if self._settings is None or self._settings.key != key:
+                parser = configparser.ConfigParser(strict=False)
+                parser.read(self.path)
+                self._settings = Settings.from_parser(parser, key)
+            return self._settings
+
+    def write(self, parser):
+        """
+        Replace the file with a ConfigParser's content, atomically, and use it from now on
+        @param parser: configparser.ConfigParser
+        @return: Settings
+        """
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with self._lock:
+            with open(tmp, "w", encoding='utf-8') as f:
+                parser.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, tmp)
+            os.replace(tmp, self.path)
+            self._settings = Settings.from_parser(parser, self._key())
+            return self._settings
@@ -0,0 +1,48 @@
+import os
+import sqlite3
+
+# Seconds to wait for the writers of the live database before replacing it
+SWAP_TIMEOUT = 30
+
+
+def file_id(db):
+    """
+    Identity of the file currently at the path of a connection's database. It changes when the file is
+    replaced (restore), while the connection keeps using the old one.
+    @param db: sqlite3.Connection
+    @return: (st_dev, st_ino) or None
+    """
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def swap_in(path, target, timeout=SWAP_TIMEOUT):
+    """
+    Atomically replace the database file at target with the one at path. An exclusive lock on the live database
+    is held across the rename, so no connection is in the middle of a write when the file changes.
+    @param path: New database file, on the same filesystem as target
+    @param target: Live database file
+    @param timeout: Seconds to wait for the lock
+    @return: None
+    @raise sqlite3.OperationalError: The live database stayed locked
+    """
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+    live = sqlite3.connect(target, timeout=timeout, isolation_level=None)
+    try:
+        live.execute("BEGIN EXCLUSIVE")
+        try:
+            os.replace(path, target)
+        finally:
+            live.execute("ROLLBACK")
+    finally:
+        live.close()
+    directory = os.open(os.path.dirname(os.path.abspath(target)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -0,0 +1,294 @@
+import fcntl
+import heapq
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+import database
+from command import wg, wg_set_peers
+from command_runner import wg_quick
+
+# Seconds between two traffic samples of interfaces that have peers with a quota
+QUOTA_SAMPLE_INTERVAL = float(os.getenv('WGD_QUOTA_SAMPLE_INTERVAL', '10'))
+# Seconds between two checks for edited limits
+REFRESH_INTERVAL = 5.0
+# Seconds a process waits before trying again to become the enforcing process
+LEADER_RETRY_INTERVAL = 30.0
+
+
+def create_limit_tables(cur):
+    """
+    Create the table counting changes to the limits of every interface's peers
+    @param cur: sqlite3.Cursor
+    @return: None
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS limit_revision (config_name VARCHAR NOT NULL PRIMARY KEY, "
+                "revision INTEGER NOT NULL DEFAULT 0)")
+
+
+def install_limit_triggers(cur, config_name):
+    """
+    Bump the limit revision of an interface whenever a peer is added, removed, or its expiry, quota or
+    activity changes
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    bump = (f"INSERT INTO limit_revision VALUES ('{config_name}', 1) "
+            f"ON CONFLICT(config_name) DO UPDATE SET revision = revision + 1;")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_insert_limits AFTER INSERT ON {config_name} "
+                f"BEGIN {bump} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_delete_limits AFTER DELETE ON {config_name} "
+                f"BEGIN {bump} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_update_limits "
+                f"AFTER UPDATE OF ends_at, bandwidth, end_active ON {config_name} "
+                f"WHEN OLD.ends_at IS NOT NEW.ends_at OR OLD.bandwidth IS NOT NEW.bandwidth "
+                f"OR OLD.end_active IS NOT NEW.end_active BEGIN {bump} END")
+
+
+class InterfaceLimits:
+    """
+    Limits of the active peers of one interface
+    """
+
+    def __init__(self):
+        self.revision = None
+        # peer id -> (ends_at, bandwidth in bytes)
+        self.limits = {}
+        # peer id -> bytes left before the quota is exceeded
+        self.remaining = {}
+        # peer id -> transmit counter at the last sample
+        self.counters = {}
+
+
+class EnforcementEngine:
+    """
+    Enforces expiry (ends_at) and quotas (bandwidth) without page views. Upcoming deadlines sit in a min-heap,
+    so a deadline costs O(log n) when it is armed and when it fires. Quotas are per-peer thresholds lowered
+    by the transmit deltas of each traffic sample. Violators of an interface are removed with one `wg set`
+    call and one `wg-quick save`.
+
+    Only one dashboard process enforces at a time: the one holding the lock file.
+    """
+
+    def __init__(self, connect, config_names, lock_path):
+        """
+        @param connect: Function returning a new sqlite3.Connection to the dashboard database
+        @param config_names: Function returning the names of the WG interfaces
+        @param lock_path: Lock file electing the enforcing process
+        """
+        self.connect = connect
+        self.config_names = config_names
+        self.lock_path = lock_path
+        self.interfaces = {}
+        self.deadlines = []
+        self._wake = threading.Event()
+        self._reset = threading.Event()
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the engine thread of this process (after gunicorn forked the worker)
+        @return: None
+        """
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._serve, name="enforcement", daemon=True).start()
+
+    def reset(self):
+        """
+        Forget the loaded limits and deadlines, e.g. after the database was restored. They are loaded again
+        on the next pass.
+        @return: None
+        """
+        self._reset.set()
+        self._wake.set()
+
+    def _serve(self):
+        lock_file = open(self.lock_path, "a")
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(LEADER_RETRY_INTERVAL)
+        db = None
+        try:
+            db, opened = self._open()
+            next_sample = 0
+            while True:
+                try:
+                    if database.file_id(db) != opened:
+                        # The database was replaced (restore): load everything from the new file
+                        db.close()
+                        db, opened = self._open()
+                        self._reset.set()
+                    if self._reset.is_set():
+                        self._reset.clear()
+                        self.interfaces.clear()
+                        self.deadlines = []
+                    self.refresh(db)
+                    now = time.time()
+                    violators = self.due(now)
+                    if now >= next_sample:
+                        next_sample = now + QUOTA_SAMPLE_INTERVAL
+                        for config_name, peer_ids in self.sample().items():
+                            violators.setdefault(config_name, set()).update(peer_ids)
+                    for config_name, peer_ids in violators.items():
+                        self.enforce(db, config_name, peer_ids)
+                except Exception as exc:
+                    # Keep enforcing: start over from the database on the next pass
+                    print(f"Enforcement pass failed: {exc!r}")
+                    self._reset.set()
+                    try:
+                        db.rollback()
+                    except sqlite3.Error:
+                        pass
+                timeout = min(REFRESH_INTERVAL, max(next_sample - time.time(), 0))
+                if self.deadlines:
+                    timeout = min(timeout, max(self.deadlines[0][0] - time.time(), 0))
+                self._wake.wait(timeout)
+                self._wake.clear()
+        finally:
+            # Let another process take over
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            if db is not None:
+                db.close()
+
+    def _open(self):
+        db = self.connect()
+        create_limit_tables(db.cursor())
+        db.commit()
+        return db, database.file_id(db)
+
+    def refresh(self, db):
+        """
+        Reload the limits of interfaces whose limit revision changed, arming deadlines of changed peers
+        @param db: sqlite3.Connection
+        @return: None
+        """
+        revisions = dict(db.execute("SELECT config_name, revision FROM limit_revision").fetchall())
+        names = self.config_names()
+        for config_name in list(self.interfaces):
+            if config_name not in names:
+                del self.interfaces[config_name]
+        for config_name in names:
+            state = self.interfaces.get(config_name)
+            if state is None:
+                try:
+                    install_limit_triggers(db.cursor(), config_name)
+                    db.commit()
+                except sqlite3.OperationalError:
+                    # Peer table not created yet
+                    db.rollback()
+                    continue
+                state = self.interfaces[config_name] = InterfaceLimits()
+            revision = revisions.get(config_name, 0)
+            if state.revision == revision:
+                continue
+            rows = db.execute(f"SELECT id, ends_at, bandwidth, total_sent, timer_on FROM {config_name} "
+                              f"WHERE end_active = 1").fetchall()
+            self._load(db, config_name, state, rows)
+            state.revision = revision
+
+    def _load(self, db, config_name, state, rows):
+        limits = {}
+        timers = []
+        for peer_id, ends_at, bandwidth, total_sent, timer_on in rows:
+            ends_at = float(ends_at) if ends_at else None
+            bandwidth = int(bandwidth or 0)
+            if ends_at is None and bandwidth <= 0:
+                continue
+            limits[peer_id] = (ends_at, bandwidth)
+            previous = state.limits.get(peer_id)
+            if previous is None or previous[0] != ends_at:
+                if ends_at is not None:
+                    heapq.heappush(self.deadlines, (ends_at, config_name, peer_id))
+            if previous is None or previous[1] != bandwidth:
+                state.remaining.pop(peer_id, None)
+                if bandwidth > 0:
+                    state.remaining[peer_id] = bandwidth - int((total_sent or 0) * pow(1024, 3))
+            if int(timer_on or 0) != int(ends_at is not None):
+                timers.append((int(ends_at is not None), peer_id))
+        for peer_id in set(state.remaining) - {k for k, v in limits.items() if v[1] > 0}:
+            del state.remaining[peer_id]
+        state.limits = limits
+        if timers:
+            db.executemany(f"UPDATE {config_name} SET timer_on = ? WHERE id = ?", timers)
+            db.commit()
+
+    def due(self, now):
+        """
+        Pop the deadlines that passed. Entries whose peer was edited or removed since they were armed are stale
+        and dropped.
+        @return: dict of interface name -> set of peer ids
+        """
+        violators = {}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            ends_at, config_name, peer_id = heapq.heappop(self.deadlines)
+            state = self.interfaces.get(config_name)
+            if state is not None and state.limits.get(peer_id, (None,))[0] == ends_at:
+                violators.setdefault(config_name, set()).add(peer_id)
+        return violators
+
+    def sample(self):
+        """
+        Read the transfer counters of interfaces with quota peers and lower their remaining quotas
+        @return: dict of interface name -> set of peer ids over quota
+        """
+        violators = {}
+        for config_name, state in self.interfaces.items():
+            if not state.remaining:
+                continue
+            try:
+                output = wg("show", config_name, "transfer").decode("UTF-8")
+            except subprocess.CalledProcessError:
+                continue
+            for line in output.splitlines():
+                peer_id, _, sent = line.split("\t")
+                if peer_id not in state.remaining:
+                    continue
+                sent = int(sent)
+                last = state.counters.get(peer_id)
+                state.counters[peer_id] = sent
+                if last is None or sent < last:
+                    # First sample or the counter was reset by an interface restart
+                    state.remaining[peer_id] = state.limits[peer_id][1] - sent
+                else:
+                    state.remaining[peer_id] -= sent - last
+                if state.remaining[peer_id] < 0:
+                    violators.setdefault(config_name, set()).add(peer_id)
+        return violators
+
+    def enforce(self, db, config_name, peer_ids):
+        """
+        Remove violators from the interface with one kernel call and mark them inactive
+        @param db: sqlite3.Connection
+        @param config_name: Name of WG interface
+        @param peer_ids: Peer ids
+        @return: None
+        """
+        peer_ids = sorted(peer_ids)
+        try:
+            wg_set_peers(config_name, [{"public_key": peer_id, "remove": True} for peer_id in peer_ids])
+        except subprocess.CalledProcessError:
+            # Interface is down: nothing to remove from the kernel
+            pass
+        db.executemany(f"UPDATE {config_name} SET end_active = 0, status = 'stopped', timer_on = 0 WHERE id = ?",
+                       [(peer_id,) for peer_id in peer_ids])
+        db.commit()
+        state = self.interfaces[config_name]
+        for peer_id in peer_ids:
+            state.limits.pop(peer_id, None)
+            state.remaining.pop(peer_id, None)
+            state.counters.pop(peer_id, None)
+        try:
+            wg_quick("save", config_name, wait=None)
+        except subprocess.CalledProcessError:
+            pass
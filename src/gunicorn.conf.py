@@ -1,4 +1,5 @@
 import multiprocessing
+import signal
 import dashboard
 
 app_host, app_port = dashboard.get_host_bind()
@@ -9,3 +10,13 @@ threads = 4
 bind = f"{app_host}:{app_port}"
 daemon = True
 pidfile = './gunicorn.pid'
+
+
+def on_starting(server):
+    # SIGHUP to the master re-reads this file, so a new bind address is picked up with rolling worker replacement
+    dashboard.SERVER_PID = server.pid
+
+
+def post_worker_init(worker):
+    # SIGHUP to a worker reloads the settings in place
+    signal.signal(signal.SIGHUP, dashboard.handle_sighup)
@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+
+SYS_CLASS_NET = "/sys/class/net"
+# Seconds a listing of the network interfaces is reused
+STATUS_TTL = 2.0
+
+
+class InterfaceStatus:
+    """
+    Running status of WireGuard interfaces, read from /sys/class/net: an interface is running while the kernel
+    has it. One listing of the directory answers for every interface until it expires or is invalidated.
+    """
+
+    def __init__(self, ttl=STATUS_TTL, root=SYS_CLASS_NET):
+        """
+        @param ttl: Seconds a listing is reused
+        @param root: Directory listing the network interfaces
+        """
+        self.ttl = ttl
+        self.root = root
+        self._names = None
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, config_name):
+        """
+        @param config_name: Name of WG interface
+        @return: "running" or "stopped"
+        """
+        with self._lock:
+            if self._names is None or time.monotonic() - self._read_at > self.ttl:
+                try:
+                    self._names = frozenset(os.listdir(self.root))
+                except OSError:
+                    self._names = frozenset()
+                self._read_at = time.monotonic()
+            return "running" if config_name in self._names else "stopped"
+
+    def invalidate(self):
+        """
+        Forget the listing, after an interface was brought up or down
+        @return: None
+        """
+        with self._lock:
+            self._names = None
@@ -0,0 +1,99 @@
+import os
+import threading
+
+import peer_changes
+
+_summaries = {}
+_prepared = set()
+_lock = threading.Lock()
+
+
+def file_key(path):
+    """
+    Identity of a file's content: it changes whenever the file is written or replaced
+    @return: tuple, or None when there is no such file
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def unprepared(config_names):
+    """
+    Interfaces whose tables and triggers this process has not created yet
+    @param config_names: list of str
+    @return: list of str
+    """
+    with _lock:
+        return [config_name for config_name in config_names if config_name not in _prepared]
+
+
+def mark_prepared(config_names):
+    """
+    @param config_names: Interfaces whose tables and triggers were created
+    @return: None
+    """
+    with _lock:
+        _prepared.update(config_names)
+
+
+def get_summary(cur, config_name, conf_file, status, read_interface):
+    """
+    Get the summary of an interface. Its public key and listen port are read again only after the configuration
+    file changed or the interface went up or down, its peer counts and totals after its peers changed.
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param conf_file: Path of the interface's configuration file
+    @param status: "running" or "stopped"
+    @param read_interface: Function taking the interface name and returning (public key, listen port)
+    @return: dict of public_key, listen_port, peers, running_peers, active_peers, total_data, upload_total and
+             download_total
+    """
+    source = (file_key(conf_file), status)
+    generation = peer_changes.get_generation(cur, config_name)[0]
+    with _lock:
+        cached = _summaries.get(config_name)
+    if cached is not None and cached['source'] == source and cached['generation'] == generation:
+        return cached['summary']
+    if cached is not None and cached['source'] == source:
+        public_key, listen_port = cached['summary']['public_key'], cached['summary']['listen_port']
+    else:
+        public_key, listen_port = read_interface(config_name)
+    peers, running, active, upload, download = cur.execute(
+        f"SELECT COUNT(*), COALESCE(SUM(status = 'running'), 0), COALESCE(SUM(end_active), 0), "
+        f"COALESCE(SUM(total_sent + cumu_sent), 0), COALESCE(SUM(total_receive + cumu_receive), 0) "
+        f"FROM {config_name}").fetchone()
+    summary = {
+        "public_key": public_key,
+        "listen_port": listen_port,
+        "peers": peers,
+        "running_peers": running,
+        "active_peers": active,
+        "total_data": round(upload + download, 4),
+        "upload_total": round(upload, 4),
+        "download_total": round(download, 4)
+    }
+    with _lock:
+        _summaries[config_name] = {"source": source, "generation": generation, "summary": summary}
+    return summary
+
+
+def invalidate(config_name):
+    """
+    Forget the summary of an interface
+    @return: None
+    """
+    with _lock:
+        _summaries.pop(config_name, None)
+
+
+def clear_cache():
+    """
+    Drop the cached summaries and the interfaces known to be prepared, e.g. after the database was restored
+    @return: None
+    """
+    with _lock:
+        _summaries.clear()
+        _prepared.clear()
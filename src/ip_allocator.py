@@ -0,0 +1,463 @@
+import bisect
+import ipaddress
+import threading
+import time
+
+# Seconds an unassigned reservation is held before it is returned to the pool
+RESERVATION_TTL = 300
+
+
+def create_allocation_tables(cur):
+    """
+    Create the tables backing the allocator
+    @param cur: sqlite3.Cursor
+    @return: None
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS address_revision (config_name VARCHAR NOT NULL, "
+                "revision INTEGER DEFAULT 0, PRIMARY KEY (config_name))")
+    cur.execute("CREATE TABLE IF NOT EXISTS ip_reservations (config_name VARCHAR NOT NULL, address VARCHAR NOT NULL, "
+                "peer_id VARCHAR NULL, expires_at BIGINT NULL, PRIMARY KEY (config_name, address))")
+    cur.execute("CREATE INDEX IF NOT EXISTS ip_reservations_peer ON ip_reservations (config_name, peer_id)")
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS ip_reservations_{event.lower()}_revision
+            AFTER {event} ON ip_reservations BEGIN
+                INSERT INTO address_revision VALUES ({row}.config_name, 1)
+                    ON CONFLICT(config_name) DO UPDATE SET revision = revision + 1;
+            END""")
+
+
+def install_revision_triggers(cur, config_name):
+    """
+    Bump the address revision of an interface whenever its peers' allowed IPs change, so every worker
+    notices that its cached allocator is stale, and drop the reservations of addresses a peer moved away from
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    bump = f"""INSERT INTO address_revision VALUES ('{config_name}', 1)
+                    ON CONFLICT(config_name) DO UPDATE SET revision = revision + 1;"""
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_insert_revision AFTER INSERT ON {config_name} "
+                f"BEGIN {bump} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_delete_revision AFTER DELETE ON {config_name} "
+                f"BEGIN {bump} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_allowed_ip_revision "
+                f"AFTER UPDATE OF allowed_ip ON {config_name} WHEN OLD.allowed_ip IS NOT NEW.allowed_ip "
+                f"BEGIN {bump} END")
+    # A peer moved to other addresses gives up the reservations it no longer uses
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_allowed_ip_reservation "
+                f"AFTER UPDATE OF allowed_ip ON {config_name} WHEN OLD.allowed_ip IS NOT NEW.allowed_ip "
+                f"BEGIN DELETE FROM ip_reservations WHERE config_name = '{config_name}' AND peer_id = NEW.id "
+                f"AND instr(',' || replace(COALESCE(NEW.allowed_ip, ''), ' ', '') || ',', ',' || address || '/') = 0; "
+                f"END")
+
+
+def get_revision(cur, config_name):
+    """
+    Get the address revision of an interface
+    @return: int
+    """
+    row = cur.execute("SELECT revision FROM address_revision WHERE config_name = ?", (config_name,)).fetchone()
+    return row[0] if row else 0
+
+
+def parse_networks(value):
+    """
+    Parse a comma separated list of addresses or networks, skipping anything invalid such as "(None)" or "N/A"
+    @param value: e.g. "10.0.0.2/32, fd00::2/128"
+    @return: list of ipaddress networks
+    """
+    networks = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            pass
+    return networks
+
+
+class AddressPool:
+    """
+    Used host offsets inside one subnet. The first BITMAP_WINDOW offsets live in a bitmap (a Python int),
+    anything above that, which only happens in large IPv6 subnets, lives in a sorted set of intervals.
+    """
+
+    BITMAP_WINDOW = 1 << 20
+
+    def __init__(self, network):
+        self.network = network
+        self.base = int(network.network_address)
+        size = network.num_addresses
+        if size <= 2:
+            # /31, /32, /127 and /128 have no network or broadcast address
+            self.first, self.last = 0, size - 1
+        elif network.version == 4:
+            self.first, self.last = 1, size - 2
+        else:
+            self.first, self.last = 1, size - 1
+        self.window_end = min(self.last, self.first + self.BITMAP_WINDOW - 1)
+        self.used = 0
+        self.extra = []
+        self.used_count = 0
+        self.cursor = self.first
+
+    @property
+    def capacity(self):
+        return self.last - self.first + 1
+
+    @property
+    def free_count(self):
+        return self.capacity - self.used_count
+
+    def address(self, offset):
+        return ipaddress.ip_address(self.base + offset)
+
+    def offset(self, address):
+        """
+        Get the host offset of an address, or None when it is outside the usable range
+        @return: int, None
+        """
+        if address.version != self.network.version:
+            return None
+        offset = int(address) - self.base
+        return offset if self.first <= offset <= self.last else None
+
+    def _find_interval(self, offset):
+        i = bisect.bisect_right(self.extra, (offset, float("inf"))) - 1
+        return i if i >= 0 and self.extra[i][1] >= offset else None
+
+    def _add_interval(self, lo, hi):
+        i = bisect.bisect_left(self.extra, (lo,))
+        if i > 0 and self.extra[i - 1][1] >= lo - 1:
+            i -= 1
+            lo = self.extra[i][0]
+        j = i
+        while j < len(self.extra) and self.extra[j][0] <= hi + 1:
+            hi = max(hi, self.extra[j][1])
+            j += 1
+        merged = sum(h - l + 1 for l, h in self.extra[i:j])
+        self.extra[i:j] = [(lo, hi)]
+        self.used_count += (hi - lo + 1) - merged
+
+    def is_used(self, offset):
+        if offset <= self.window_end:
+            return (self.used >> offset) & 1 == 1
+        return self._find_interval(offset) is not None
+
+    def mark(self, offset):
+        if self.is_used(offset):
+            return
+        if offset <= self.window_end:
+            self.used |= 1 << offset
+            self.used_count += 1
+        else:
+            self._add_interval(offset, offset)
+
+    def release(self, offset):
+        if offset <= self.window_end:
+            if not self.is_used(offset):
+                return
+            self.used &= ~(1 << offset)
+        else:
+            i = self._find_interval(offset)
+            if i is None:
+                return
+            lo, hi = self.extra[i]
+            self.extra[i:i + 1] = [piece for piece in ((lo, offset - 1), (offset + 1, hi)) if piece[0] <= piece[1]]
+        self.used_count -= 1
+        self.cursor = min(self.cursor, offset)
+
+    def mark_network(self, network):
+        """
+        Mark every usable offset covered by a network (a peer routing a whole range uses all of it)
+        @return: None
+        """
+        if network.version != self.network.version or not network.overlaps(self.network):
+            return
+        lo = max(int(network.network_address) - self.base, self.first)
+        hi = min(int(network.broadcast_address) - self.base, self.last)
+        if hi > self.window_end:
+            self._add_interval(max(lo, self.window_end + 1), hi)
+            hi = self.window_end
+        if lo > hi:
+            return
+        if hi - lo < 64:
+            for offset in range(lo, hi + 1):
+                self.mark(offset)
+        else:
+            before = bin(self.used).count("1")
+            self.used |= ((1 << (hi - lo + 1)) - 1) << lo
+            self.used_count += bin(self.used).count("1") - before
+
+    def next_free(self, start):
+        """
+        Lowest free offset >= start
+        @return: int, None
+        """
+        start = max(start, self.first)
+        if start <= self.window_end:
+            rest = self.used >> start
+            offset = start + ((~rest & (rest + 1)).bit_length() - 1)
+            if offset <= self.window_end:
+                return offset
+            start = self.window_end + 1
+        # Intervals are merged, so the offset after one interval is always free
+        i = self._find_interval(start)
+        if i is not None:
+            start = self.extra[i][1] + 1
+        return start if start <= self.last else None
+
+    def allocate(self):
+        """
+        Take the lowest free offset. Every offset below the cursor is in use, so this is a single word scan.
+        @return: ipaddress address, None when the pool is full
+        """
+        offset = self.next_free(self.cursor)
+        if offset is None:
+            self.cursor = self.last + 1
+            return None
+        self.mark(offset)
+        self.cursor = offset + 1
+        return self.address(offset)
+
+    def iter_free(self, start, stop):
+        """
+        Yield free addresses with offsets in [start, stop]
+        """
+        stop = min(stop, self.last)
+        offset = self.next_free(start)
+        while offset is not None and offset <= stop:
+            yield self.address(offset)
+            offset = self.next_free(offset + 1)
+
+
+class Allocator:
+    """
+    Address allocator of one interface, with one pool per network of its `Address`. A peer gets one address
+    of every IP version the interface has, e.g. 10.0.0.2 and fd00::2 on a dual-stack interface, each taken
+    from the first network of that version with room left. A network overlapping an earlier one adds no pool.
+    """
+
+    def __init__(self, conf_address, revision):
+        self.conf_address = conf_address
+        self.revision = revision
+        self.lock = threading.Lock()
+        self.pools = []
+        for network in parse_networks(conf_address):
+            if not any(pool.network.version == network.version and pool.network.overlaps(network)
+                       for pool in self.pools):
+                self.pools.append(AddressPool(network))
+        # The interface's own addresses are taken too
+        for item in conf_address.split(","):
+            try:
+                self.mark(ipaddress.ip_interface(item.strip()).ip)
+            except ValueError:
+                continue
+
+    @property
+    def versions(self):
+        """
+        IP versions a peer gets an address of, in the order of the interface's `Address`
+        @return: list of int
+        """
+        return list(dict.fromkeys(pool.network.version for pool in self.pools))
+
+    def mark(self, address):
+        for pool in self.pools:
+            offset = pool.offset(address)
+            if offset is not None:
+                pool.mark(offset)
+
+    def release(self, address):
+        for pool in self.pools:
+            offset = pool.offset(address)
+            if offset is not None:
+                pool.release(offset)
+
+    def allocate(self, version):
+        """
+        Take the lowest free address of an IP version
+        @return: ipaddress address, None when every network of that version is full
+        """
+        for pool in self.pools:
+            if pool.network.version == version:
+                address = pool.allocate()
+                if address is not None:
+                    return address
+        return None
+
+    def load(self, cur, config_name):
+        """
+        Mark peers' allowed IPs and active reservations as used
+        @return: None
+        """
+        if not self.pools:
+            return
+        for (allowed_ip,) in cur.execute(f"SELECT allowed_ip FROM {config_name}"):
+            for network in parse_networks(allowed_ip):
+                for pool in self.pools:
+                    pool.mark_network(network)
+        cur.execute("DELETE FROM ip_reservations WHERE config_name = ? AND expires_at IS NOT NULL "
+                    "AND expires_at < ?", (config_name, int(time.time())))
+        for (address,) in cur.execute("SELECT address FROM ip_reservations WHERE config_name = ?", (config_name,)):
+            self.mark(ipaddress.ip_address(address))
+
+    def page(self, after=None, limit=256, prefix=None):
+        """
+        List free addresses, network by network in the order of the interface's `Address`
+        @param after: Continue after this address
+        @param limit: Page size
+        @param prefix: Only list addresses inside this network (e.g. "10.0.5.0/24")
+        @return: dict with "ips", "next" cursor and "total" free addresses
+        """
+        with self.lock:
+            total = sum(pool.free_count for pool in self.pools)
+            if limit <= 0:
+                return {"ips": [], "next": None, "total": total}
+            network = ipaddress.ip_network(prefix, strict=False) if prefix else None
+            after = ipaddress.ip_address(after) if after else None
+            pools = self.pools
+            if after is not None:
+                # Skip the networks listed before the one the cursor is in
+                for i, pool in enumerate(pools):
+                    if after.version == pool.network.version and after in pool.network:
+                        pools = pools[i:]
+                        break
+            ips = []
+            for pool in pools:
+                start, stop = pool.first, pool.last
+                if network is not None:
+                    if network.version != pool.network.version or not network.overlaps(pool.network):
+                        continue
+                    start = max(start, int(network.network_address) - pool.base)
+                    stop = min(stop, int(network.broadcast_address) - pool.base)
+                if after is not None and after.version == pool.network.version and after in pool.network:
+                    start = max(start, int(after) - pool.base + 1)
+                for address in pool.iter_free(start, stop):
+                    if len(ips) == limit:
+                        return {"ips": ips, "next": ips[-1], "total": total}
+                    ips.append(str(address))
+            return {"ips": ips, "next": None, "total": total}
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(cur, config_name, conf_address):
+    """
+    Get the cached allocator of an interface, rebuilding it when another request or worker changed
+    the interface's addresses
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param conf_address: `Address` of the interface
+    @return: Allocator
+    """
+    revision = get_revision(cur, config_name)
+    with _allocators_lock:
+        allocator = _allocators.get(config_name)
+        if allocator is not None and allocator.revision == revision and allocator.conf_address == conf_address:
+            return allocator
+    allocator = Allocator(conf_address, revision)
+    allocator.load(cur, config_name)
+    allocator.revision = get_revision(cur, config_name)
+    with _allocators_lock:
+        _allocators[config_name] = allocator
+    return allocator
+
+
+def clear_cache():
+    """
+    Drop the cached allocators, e.g. after the database was restored
+    @return: None
+    """
+    with _allocators_lock:
+        _allocators.clear()
+
+
+def adopt_revision(cur, config_name):
+    """
+    Accept the current revision in the cached allocator after inserting peers whose addresses it reserved
+    itself, so the revision bump of the insert triggers does not force a reload from the database
+    @param cur: sqlite3.Cursor (inside the transaction that inserted the peers)
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    with _allocators_lock:
+        allocator = _allocators.get(config_name)
+    if allocator is not None:
+        with allocator.lock:
+            allocator.revision = get_revision(cur, config_name)
+
+
+def reserve(cur, config_name, conf_address, count, peer_ids=None, ttl=RESERVATION_TTL):
+    """
+    Allocate and persist free addresses, one of every IP version of the interface per peer. Reservations
+    are shared by all workers through the database; an address another worker reserved first is skipped.
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param conf_address: `Address` of the interface
+    @param count: Number of peers
+    @param peer_ids: Peers the addresses belong to; their reservations do not expire
+    @param ttl: Seconds anonymous reservations are held
+    @return: list of lists of address strings, one list per peer, shorter than count when a version runs out
+    """
+    allocator = get_allocator(cur, config_name, conf_address)
+    versions = allocator.versions
+    if not versions:
+        return []
+    expires_at = None if peer_ids else int(time.time()) + ttl
+    allocations = []
+    with allocator.lock:
+        while len(allocations) < count:
+            peer_id = peer_ids[len(allocations)] if peer_ids else None
+            addresses = []
+            for version in versions:
+                address = allocator.allocate(version)
+                while address is not None:
+                    cur.execute("INSERT OR IGNORE INTO ip_reservations VALUES (?, ?, ?, ?)",
+                                (config_name, str(address), peer_id, expires_at))
+                    if cur.rowcount == 1:
+                        break
+                    address = allocator.allocate(version)
+                if address is None:
+                    break
+                addresses.append(str(address))
+            if len(addresses) < len(versions):
+                # One version ran out: give back what this peer already took
+                cur.executemany("DELETE FROM ip_reservations WHERE config_name = ? AND address = ?",
+                                [(config_name, address) for address in addresses])
+                for address in addresses:
+                    allocator.release(ipaddress.ip_address(address))
+                break
+            allocations.append(addresses)
+        # This transaction now holds the write lock, so the revision only reflects our own changes
+        allocator.revision = get_revision(cur, config_name)
+    return allocations
+
+
+def assign(cur, config_name, addresses, peer_id):
+    """
+    Give anonymous reservations to a peer, so they no longer expire
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param addresses: Reserved addresses
+    @param peer_id: Peer id
+    @return: None
+    """
+    cur.executemany("UPDATE ip_reservations SET peer_id = ?, expires_at = NULL WHERE config_name = ? AND address = ?",
+                    [(peer_id, config_name, address) for address in addresses])
+
+
+def release(cur, config_name, peer_ids):
+    """
+    Drop the reservations of removed peers
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param peer_ids: List of peer ids
+    @return: None
+    """
+    cur.executemany("DELETE FROM ip_reservations WHERE config_name = ? AND peer_id = ?",
+                    [(config_name, peer_id) for peer_id in peer_ids])
@@ -0,0 +1,369 @@
+import contextlib
+import json
+import os
+import secrets
+import sqlite3
+import subprocess
+import threading
+import time
+
+import database
+
+# Job threads per dashboard process
+JOB_WORKERS = int(os.getenv('WGD_JOB_WORKERS', '2'))
+# Seconds finished jobs (and their results) are kept
+JOB_RETENTION = int(os.getenv('WGD_JOB_RETENTION', str(24 * 3600)))
+# Seconds an idle job thread sleeps before checking the queue for jobs submitted by other processes
+JOB_POLL_INTERVAL = 1.0
+# Minimum seconds between two progress writes of a job
+PROGRESS_INTERVAL = 0.5
+
+FINISHED = ("done", "failed", "cancelled")
+
+JOB_COLUMNS = ("id", "kind", "config_name", "params", "status", "progress", "total", "message", "result", "error",
+               "cancel_requested", "owner", "created_at", "started_at", "finished_at")
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when its cancellation was requested
+    """
+
+
+class JobError(Exception):
+    """
+    Raised by handlers to fail a job with a message for the user
+    """
+
+
+def create_jobs_table(cur):
+    """
+    Create the persistent job queue
+    @param cur: sqlite3.Cursor
+    @return: None
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id VARCHAR NOT NULL PRIMARY KEY, kind VARCHAR NOT NULL, config_name VARCHAR NULL,
+            params TEXT NOT NULL, status VARCHAR NOT NULL, progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NULL, message TEXT NOT NULL DEFAULT '', result TEXT NULL, error TEXT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0, owner INTEGER NULL,
+            created_at REAL NOT NULL, started_at REAL NULL, finished_at REAL NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+
+def job_to_dict(row):
+    """
+    Public representation of a job row
+    @param row: Row in JOB_COLUMNS order
+    @return: dict
+    """
+    job = dict(zip(JOB_COLUMNS, row))
+    del job["params"], job["owner"]
+    job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+class Job:
+    """
+    Handle given to a job handler. `db` and `cur` belong to the job; progress is written through a
+    separate connection so it never commits the handler's own transaction.
+    """
+
+    def __init__(self, row, db, status_db):
+        self.row = dict(zip(JOB_COLUMNS, row))
+        self.id = self.row["id"]
+        self.kind = self.row["kind"]
+        self.config_name = self.row["config_name"]
+        self.params = json.loads(self.row["params"])
+        self.db = db
+        self.cur = db.cursor()
+        self._status_db = status_db
+        self._last_write = 0
+
+    @property
+    def cancelled(self):
+        row = self._status_db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.id,)).fetchone()
+        return bool(row and row[0])
+
+    def progress(self, done, total=None, message=None):
+        """
+        Record progress (throttled) and stop the job if it was cancelled
+        @param done: Units of work finished
+        @param total: Units of work in total, if known
+        @param message: Short description of the current step
+        @return: None
+        @raise JobCancelled: Cancellation was requested
+        """
+        now = time.monotonic()
+        if now - self._last_write >= PROGRESS_INTERVAL or (total is not None and done >= total):
+            self._last_write = now
+            try:
+                self._status_db.execute(
+                    "UPDATE jobs SET progress = ?, total = COALESCE(?, total), message = COALESCE(?, message) "
+                    "WHERE id = ?", (done, total, message, self.id))
+            except sqlite3.OperationalError:
+                # Database busy: the next update will catch up
+                pass
+        if self.cancelled:
+            raise JobCancelled()
+
+
+class JobRunner:
+    """
+    Persistent job queue in the dashboard database, worked by a small pool of threads in every dashboard
+    process. Any process can pick up a queued job; jobs of the same interface run one at a time.
+    """
+
+    def __init__(self, connect, workers=JOB_WORKERS, context=None):
+        """
+        @param connect: Function returning a new sqlite3.Connection to the dashboard database
+        @param workers: Job threads in this process
+        @param context: Function taking a Job and returning the context manager a handler runs in
+        """
+        self.connect = connect
+        self.workers = workers
+        self.context = context or (lambda job: contextlib.nullcontext())
+        self.handlers = {}
+        self.cleanups = {}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self._last_purge = 0
+
+    def handler(self, kind, cleanup=None):
+        """
+        Register the function running jobs of a kind. It takes the Job and returns a JSON serializable result.
+        @param kind: Job kind
+        @param cleanup: Function called with the result when a finished job is purged
+        """
+        def register(func):
+            self.handlers[kind] = func
+            if cleanup is not None:
+                self.cleanups[kind] = cleanup
+            return func
+        return register
+
+    def _connect(self):
+        db = self.connect()
+        db.isolation_level = None
+        return db
+
+    def _open(self):
+        """
+        Connection of a job thread, and the identity of its database file
+        @return: (sqlite3.Connection, file id)
+        """
+        db = self._connect()
+        create_jobs_table(db.cursor())
+        return db, database.file_id(db)
+
+    def start(self):
+        """
+        Start the job threads of this process (after gunicorn forked the worker) and fail jobs whose
+        process died while running them
+        @return: None
+        """
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        db = self._connect()
+        try:
+            create_jobs_table(db.cursor())
+            for job_id, owner in db.execute("SELECT id, owner FROM jobs WHERE status = 'running'").fetchall():
+                if not self._alive(owner):
+                    db.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                               ("Interrupted by a restart.", time.time(), job_id))
+        finally:
+            db.close()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    @staticmethod
+    def _alive(pid):
+        if pid is None:
+            return False
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def submit(self, cur, kind, config_name=None, params=None, total=None):
+        """
+        Queue a job and commit
+        @param cur: sqlite3.Cursor of the request
+        @param kind: Registered job kind
+        @param config_name: Interface the job works on; jobs of one interface run one at a time
+        @param params: JSON serializable parameters for the handler
+        @param total: Units of work, if known upfront
+        @return: str job id
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        self.start()
+        job_id = secrets.token_hex(8)
+        cur.execute("INSERT INTO jobs (id, kind, config_name, params, status, total, created_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, kind, config_name, json.dumps(params or {}), total, time.time()))
+        cur.connection.commit()
+        self._wake.set()
+        return job_id
+
+    def get(self, cur, job_id):
+        """
+        Status of a job
+        @return: dict or None
+        """
+        row = cur.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return job_to_dict(row) if row else None
+
+    def recent(self, cur, limit=50):
+        """
+        Most recent jobs
+        @return: list of dict
+        """
+        return [job_to_dict(row) for row in cur.execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))]
+
+    def cancel(self, cur, job_id):
+        """
+        Cancel a queued job right away, or ask a running job to stop at its next progress update
+        @return: bool, False if the job does not exist or already finished
+        """
+        cur.execute("UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ? "
+                    "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        if cur.rowcount == 0:
+            cur.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        cur.connection.commit()
+        return cur.rowcount == 1
+
+    def _claim(self, db):
+        """
+        Atomically take the oldest queued job whose interface has no running job
+        @return: row or None
+        """
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(f"""
+                SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status = 'queued' AND (config_name IS NULL OR
+                config_name NOT IN (SELECT config_name FROM jobs WHERE status = 'running'
+                                    AND config_name IS NOT NULL))
+                ORDER BY created_at LIMIT 1
+            """).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = 'running', owner = ?, started_at = ? WHERE id = ?",
+                           (os.getpid(), time.time(), row[0]))
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+        return row
+
+    def _purge(self, db):
+        """
+        Delete finished jobs past retention
+        @return: None
+        """
+        cutoff = time.time() - JOB_RETENTION
+        rows = db.execute("SELECT id, kind, result FROM jobs WHERE status IN ('done', 'failed', 'cancelled') "
+                          "AND finished_at < ?", (cutoff,)).fetchall()
+        for job_id, kind, result in rows:
+            cleanup = self.cleanups.get(kind)
+            if cleanup is not None and result is not None:
+                try:
+                    cleanup(json.loads(result))
+                except OSError:
+                    pass
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _work(self):
+        db, opened = self._open()
+        # Outcomes of finished jobs not recorded yet, e.g. while the database was locked
+        unrecorded = []
+        while True:
+            try:
+                if database.file_id(db) != opened:
+                    # The database was replaced (restore): continue on the new file
+                    db.close()
+                    db, opened = self._open()
+                while unrecorded:
+                    self._record(db, *unrecorded[0])
+                    unrecorded.pop(0)
+                if time.monotonic() - self._last_purge > 60:
+                    self._last_purge = time.monotonic()
+                    self._purge(db)
+                row = self._claim(db)
+            except sqlite3.Error as exc:
+                if not isinstance(exc, sqlite3.OperationalError):
+                    print(f"Job worker database error: {exc!r}")
+                row = None
+            if row is None:
+                self._wake.wait(JOB_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            unrecorded.append(self._execute(row, db))
+
+    def _execute(self, row, status_db):
+        """
+        Run the handler of a claimed job
+        @return: (Job, status, result, error)
+        """
+        job = Job(row, self.connect(), status_db)
+        status, result, error = "done", None, None
+        try:
+            with self.context(job):
+                result = self.handlers[job.kind](job)
+            job.db.commit()
+        except JobCancelled:
+            job.db.commit()
+            status = "cancelled"
+        except JobError as exc:
+            job.db.commit()
+            status, error = "failed", str(exc)
+        except subprocess.CalledProcessError as exc:
+            job.db.rollback()
+            status, error = "failed", exc.output.decode("UTF-8", "replace").strip() if exc.output else str(exc)
+        except Exception as exc:
+            job.db.rollback()
+            status, error = "failed", str(exc)
+        finally:
+            job.db.close()
+        return job, status, result, error
+
+    def _record(self, db, job, status, result, error):
+        """
+        Record the outcome of a job. OperationalError (e.g. database is locked) is raised so the worker retries;
+        after any other database error the job is failed with that error instead.
+        @return: None
+        """
+        try:
+            self._finish(db, job, status, result, error)
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.Error as exc:
+            db.execute("UPDATE jobs SET status = 'failed', result = NULL, error = ?, finished_at = ? WHERE id = ?",
+                       (f"The outcome of the job could not be recorded: {exc}", time.time(), job.id))
+
+    def _finish(self, db, job, status, result, error):
+        try:
+            encoded = json.dumps(result) if result is not None else None
+        except (TypeError, ValueError) as exc:
+            status, encoded, error = "failed", None, f"The result of the job could not be stored: {exc}"
+        values = (status, encoded, error, time.time())
+        cur = db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                         values + (job.id,))
+        if cur.rowcount == 0:
+            # The job replaced the database it was queued in (restore): record it in the new one
+            db.execute("INSERT INTO jobs (id, kind, config_name, params, status, result, error, finished_at, "
+                       "created_at, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (job.id, job.kind, job.config_name, job.row["params"]) + values +
+                       (job.row["created_at"], job.row["started_at"] or time.time()))
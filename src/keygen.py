@@ -0,0 +1,92 @@
+import base64
+import os
+import subprocess
+import sys
+from collections import deque
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+# Processes generating keys for bulk operations
+KEYGEN_PROCESSES = int(os.getenv('WGD_KEYGEN_PROCESSES', str(os.cpu_count() or 1)))
+# Keypairs generated per process
+KEYGEN_BATCH = 4096
+
+
+def generate_keypair(preshared_key=True):
+    """
+    Generate a WireGuard keypair and optionally a preshared key, in the format the dashboard uses
+    @param preshared_key: Also generate a preshared key
+    @return: dict with "privateKey", "publicKey" and "presharedKey" (base64)
+    """
+    private_key = X25519PrivateKey.generate()
+    return {
+        "privateKey": base64.b64encode(private_key.private_bytes_raw()).decode(),
+        "publicKey": base64.b64encode(private_key.public_key().public_bytes_raw()).decode(),
+        "presharedKey": base64.b64encode(os.urandom(32)).decode() if preshared_key else ""
+    }
+
+
+def start_batch(count, preshared_key=True):
+    """
+    Generate keypairs in a new process running this module as its main module, so the process imports
+    nothing of the dashboard. Processes are started rather than forked, since the gunicorn worker already
+    runs threads.
+    @param count: Number of keypairs
+    @param preshared_key: Also generate preshared keys
+    @return: subprocess.Popen writing one "private<TAB>public<TAB>preshared" line per keypair
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), str(count), str(int(preshared_key))],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+
+
+def read_batch(process):
+    """
+    Read the keypairs of a process from start_batch. The process is killed when the reader stops early.
+    @return: Iterator of keypairs
+    @raise subprocess.CalledProcessError: The process failed
+    """
+    with process:
+        try:
+            for line in process.stdout:
+                private_key, public_key, preshared_key = line.rstrip("\n").split("\t")
+                yield {"privateKey": private_key, "publicKey": public_key, "presharedKey": preshared_key}
+        finally:
+            if process.poll() is None:
+                process.kill()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def generate_keys(amount, preshared_key=True):
+    """
+    Lazily generate keypairs across worker processes. At most one batch per process is in flight and the
+    workers block on their pipes until read, so memory stays bounded however many keys are consumed.
+    @param amount: Number of keypairs
+    @param preshared_key: Also generate preshared keys
+    @return: Iterator of keypairs
+    """
+    if amount <= KEYGEN_BATCH or KEYGEN_PROCESSES <= 1:
+        for _ in range(amount):
+            yield generate_keypair(preshared_key)
+        return
+    pending = deque()
+    remaining = amount
+    try:
+        while remaining or pending:
+            while remaining and len(pending) < KEYGEN_PROCESSES:
+                count = min(KEYGEN_BATCH, remaining)
+                pending.append(start_batch(count, preshared_key))
+                remaining -= count
+            yield from read_batch(pending.popleft())
+    finally:
+        for process in pending:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+
+
+if __name__ == "__main__":
+    # Worker started by start_batch: keygen.py <count> <1 to generate preshared keys, else 0>
+    for _ in range(int(sys.argv[1])):
+        keypair = generate_keypair(sys.argv[2] == "1")
+        sys.stdout.write(f"{keypair['privateKey']}\t{keypair['publicKey']}\t{keypair['presharedKey']}\n")
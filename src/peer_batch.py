@@ -0,0 +1,275 @@
+import base64
+import binascii
+import ipaddress
+import sqlite3
+import subprocess
+import time
+
+import bulk
+import ip_allocator
+import prefix_trie
+from command import wg_set_peers
+from command_runner import wg_quick
+from util import check_DNS, check_Allowed_IPs
+
+OPERATIONS = ("create", "update", "disable", "delete")
+# Largest batch accepted in one request
+MAX_OPERATIONS = 5000
+# Ids per SELECT ... IN (...), below SQLite's variable limit
+LOOKUP_CHUNK = 500
+
+# Request field -> column, for the fields an update may change
+UPDATE_FIELDS = {
+    "name": "name",
+    "private_key": "private_key",
+    "DNS": "DNS",
+    "endpoint_allowed_ip": "endpoint_allowed_ip",
+    "MTU": "mtu",
+    "keep_alive": "keepalive",
+    "preshared_key": "preshared_key",
+    "allowed_ips": "allowed_ip",
+    "bandwidth": "bandwidth",
+    "ends_at": "ends_at"
+}
+# Fields stored as given, which must be strings
+STRING_FIELDS = ("name", "private_key", "preshared_key", "DNS", "endpoint_allowed_ip", "allowed_ips")
+
+
+def check_key(key):
+    """
+    Check that a key is a base64 encoded 32 byte WireGuard key
+    @return: bool
+    """
+    try:
+        return isinstance(key, str) and len(base64.b64decode(key, validate=True)) == 32
+    except (binascii.Error, ValueError):
+        return False
+
+
+def check_fields(op):
+    """
+    Validate the peer fields present in an operation
+    @param op: Operation dict
+    @return: Error message, or None
+    """
+    for field in STRING_FIELDS:
+        if field in op and not isinstance(op[field], str):
+            return f"{field} must be a string."
+    for field in ("MTU", "keep_alive", "bandwidth", "ends_at"):
+        if op.get(field) is not None and (isinstance(op[field], bool) or
+                                          not isinstance(op[field], (int, float, str))):
+            return f"{field} must be a number."
+    if "DNS" in op and not check_DNS(str(op["DNS"])):
+        return "DNS format is incorrect. Example: 1.1.1.1"
+    if "endpoint_allowed_ip" in op and not check_Allowed_IPs(str(op["endpoint_allowed_ip"])):
+        return "Endpoint Allowed IPs format is incorrect."
+    if "MTU" in op and not str(op["MTU"]).isdigit():
+        return "MTU format is not correct."
+    if "keep_alive" in op and not str(op["keep_alive"]).isdigit():
+        return "Persistent Keepalive format is not correct."
+    if "allowed_ips" in op:
+        items = [item.strip() for item in str(op["allowed_ips"]).split(",") if item.strip()]
+        if not items:
+            return "Allowed IPs can not be empty."
+        for item in items:
+            try:
+                ipaddress.ip_network(item, strict=False)
+            except ValueError:
+                return f"Allowed IPs format is incorrect: {item}"
+    for field in ("private_key", "preshared_key"):
+        if op.get(field) and not check_key(op[field]):
+            return f"{field} is not a valid key."
+    try:
+        if float(op.get("bandwidth") or 0) < 0:
+            return "Bandwidth can not be negative."
+        if op.get("ends_at") is not None:
+            float(op["ends_at"])
+    except (TypeError, ValueError):
+        return "Bandwidth and ends_at must be numbers."
+    return None
+
+
+def load_peers(cur, config_name, peer_ids):
+    """
+    Current state of the peers an operation refers to
+    @return: dict of peer id -> (end_active, allowed_ip)
+    """
+    peer_ids = list(peer_ids)
+    peers = {}
+    for start in range(0, len(peer_ids), LOOKUP_CHUNK):
+        chunk = peer_ids[start:start + LOOKUP_CHUNK]
+        for peer_id, end_active, allowed_ip in cur.execute(
+                f"SELECT id, end_active, allowed_ip FROM {config_name} WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk):
+            peers[peer_id] = (end_active, allowed_ip)
+    return peers
+
+
+def apply_batch(cur, config_name, conf_address, operations, defaults, atomic=False):
+    """
+    Validate a list of create / update / disable / delete operations together, then apply the valid ones
+    with one database transaction, a single `wg set` call and one `wg-quick save`. The transaction is only
+    committed once the kernel accepted the change, and is rolled back otherwise.
+
+    Create: "id" (public key) and optionally "private_key", "preshared_key", "allowed_ips" (allocated when
+    missing), "name", "DNS", "endpoint_allowed_ip", "MTU", "keep_alive", "bandwidth" (GB) and "ends_at".
+    Update: "id" and any of those fields. Disable: "id"; the peer leaves the interface but is kept.
+    Delete: "id".
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param conf_address: `Address` of the interface
+    @param operations: List of operation dicts with an "op" key
+    @param defaults: dict with the default "DNS", "endpoint_allowed_ip", "MTU", "keep_alive" and "remote_endpoint"
+    @param atomic: Apply nothing if any operation is invalid
+    @return: list of {"index", "op", "id", "status", "msg"} in the order of the operations. When the
+             configuration file could not be saved, the applied operations keep their "success" status and
+             report the error in "msg".
+    """
+    results = []
+    for i, op in enumerate(operations):
+        op = op if isinstance(op, dict) else {}
+        results.append({"index": i, "op": op.get("op"), "id": op.get("id"), "status": "failed", "msg": ""})
+    peers = load_peers(cur, config_name, {op["id"] for op in operations
+                                          if isinstance(op, dict) and isinstance(op.get("id"), str)})
+
+    valid = []
+    touched = set()
+    for i, op in enumerate(operations):
+        result = results[i]
+        if result["op"] not in OPERATIONS:
+            result["msg"] = f"Unknown operation. Use one of: {', '.join(OPERATIONS)}."
+        elif not check_key(result["id"]):
+            result["msg"] = "id must be the public key of the peer."
+        elif result["id"] in touched:
+            result["msg"] = "Peer appears in more than one operation."
+        elif result["op"] == "create" and result["id"] in peers:
+            result["msg"] = "Public key already exists."
+        elif result["op"] != "create" and result["id"] not in peers:
+            result["msg"] = "Peer does not exist."
+        else:
+            result["msg"] = check_fields(op) or ""
+            if "allowed_ips" in op:
+                op["allowed_ips"] = str(op["allowed_ips"]).replace(" ", "")
+        touched.add(result["id"])
+        if not result["msg"]:
+            valid.append(i)
+
+    # A failed update or delete keeps its peer's current ranges, which may make other operations conflict:
+    # check again without it until no more operations fail
+    index = prefix_trie.get_index(cur, config_name)
+    ranges = [(i, str(operations[i]["allowed_ips"]), operations[i]["id"] if operations[i]["op"] == "update" else None)
+              for i in valid if operations[i]["op"] in ("create", "update") and "allowed_ips" in operations[i]]
+    conflicts = set()
+    while True:
+        released = {operations[i]["id"] for i in valid if i not in conflicts and (
+            operations[i]["op"] == "delete" or (operations[i]["op"] == "update" and "allowed_ips" in operations[i]))}
+        batch = prefix_trie.AllowedIPIndex()
+        failed = index.validate([item for item in ranges if item[0] not in conflicts], released, batch)
+        if not failed:
+            break
+        conflicts.update(failed)
+    for i in conflicts:
+        results[i]["msg"] = "Allowed IPs already used by another peer."
+    valid = [i for i in valid if i not in conflicts]
+
+    # Allocate addresses for creates without allowed IPs. An address taken by this batch stays reserved
+    # anonymously until it expires, by which time the peer using it exists.
+    allocated = {}
+    for i in valid:
+        op = operations[i]
+        if op["op"] != "create" or "allowed_ips" in op:
+            continue
+        while True:
+            ips = ip_allocator.reserve(cur, config_name, conf_address, 1)
+            if not ips:
+                results[i]["msg"] = "No more available IPs."
+                break
+            allowed_ip = bulk.host_routes(ips[0])
+            if not batch.conflicts(allowed_ip):
+                ip_allocator.assign(cur, config_name, ips[0], op["id"])
+                batch.add(op["id"], allowed_ip)
+                allocated[i] = allowed_ip
+                break
+    valid = [i for i in valid if not results[i]["msg"]]
+
+    def abort(msg):
+        ip_allocator.release(cur, config_name, [operations[i]["id"] for i in allocated])
+        cur.connection.commit()
+        for i in valid:
+            results[i]["msg"] = msg
+            results[i].pop("allowed_ips", None)
+        return results
+
+    if atomic and len(valid) < len(operations):
+        return abort("Not applied: another operation in the batch is invalid.")
+
+    kernel = []
+    for i in valid:
+        op = operations[i]
+        if op["op"] == "create":
+            kernel.append({"public_key": op["id"], "allowed_ips": allocated.get(i) or str(op["allowed_ips"]),
+                           "preshared_key": op.get("preshared_key") or ""})
+        elif op["op"] == "update":
+            if peers[op["id"]][0] and ("allowed_ips" in op or op.get("preshared_key")):
+                kernel.append({"public_key": op["id"],
+                               "allowed_ips": str(op.get("allowed_ips") or peers[op["id"]][1]),
+                               "preshared_key": op.get("preshared_key") or ""})
+        else:
+            kernel.append({"public_key": op["id"], "remove": True})
+    # Write the rows first: a change the database refuses never reaches the kernel
+    try:
+        now = time.time()
+        created, disabled, deleted = [], [], []
+        for i in valid:
+            op = operations[i]
+            if op["op"] == "create":
+                ends_at = op.get("ends_at")
+                created.append((
+                    op["id"], op.get("private_key", ""), op.get("DNS", defaults["DNS"]),
+                    op.get("endpoint_allowed_ip", defaults["endpoint_allowed_ip"]), op.get("name", ""), 0, 0, 0,
+                    "N/A", "stopped", "N/A", allocated.get(i) or str(op["allowed_ips"]), 0, 0, 0,
+                    op.get("MTU", defaults["MTU"]), op.get("keep_alive", defaults["keep_alive"]),
+                    defaults["remote_endpoint"], op.get("preshared_key", ""), 1, ends_at,
+                    float(op.get("bandwidth") or 0) * pow(1024, 3), int(ends_at is not None), now))
+                results[i]["allowed_ips"] = created[-1][11]
+            elif op["op"] == "update":
+                fields = [field for field in UPDATE_FIELDS if field in op]
+                if fields:
+                    values = [float(op[field] or 0) * pow(1024, 3) if field == "bandwidth" else op[field]
+                              for field in fields]
+                    cur.execute(f"UPDATE {config_name} SET {', '.join(UPDATE_FIELDS[f] + ' = ?' for f in fields)} "
+                                f"WHERE id = ?", values + [op["id"]])
+            elif op["op"] == "disable":
+                disabled.append((op["id"],))
+            else:
+                deleted.append(op["id"])
+        if created:
+            cur.executemany(bulk.insert_peers_sql(config_name), created)
+        if disabled:
+            cur.executemany(f"UPDATE {config_name} SET end_active = 0, status = 'stopped', timer_on = 0 "
+                            f"WHERE id = ?", disabled)
+        if deleted:
+            cur.executemany(f"DELETE FROM {config_name} WHERE id = ?", [(peer_id,) for peer_id in deleted])
+        moved = [operations[i]["id"] for i in valid
+                 if operations[i]["op"] == "update" and "allowed_ips" in operations[i]]
+        ip_allocator.release(cur, config_name, deleted + moved)
+    except sqlite3.Error as exc:
+        cur.connection.rollback()
+        return abort(f"Database error: {exc}")
+    if kernel:
+        try:
+            wg_set_peers(config_name, kernel)
+        except subprocess.CalledProcessError as exc:
+            cur.connection.rollback()
+            return abort(exc.output.decode("UTF-8", "replace").strip())
+    cur.connection.commit()
+    for i in valid:
+        results[i]["status"] = "success"
+    if kernel:
+        try:
+            wg_quick("save", config_name, wait=None)
+        except subprocess.CalledProcessError as exc:
+            msg = exc.output.decode("UTF-8", "replace").strip() if exc.output else str(exc)
+            for i in valid:
+                results[i]["msg"] = f"Applied, but the configuration file could not be saved: {msg}"
+    return results
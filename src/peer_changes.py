@@ -0,0 +1,88 @@
+import bulk
+
+# Removed peers remembered per interface before they are forgotten
+MAX_REMOVED = 5000
+# Columns whose changes are not reported: the age of the latest handshake changes on every poll of an active peer
+IGNORED_COLUMNS = ("latest_handshake",)
+
+
+def create_change_tables(cur):
+    """
+    Create the tables versioning the peers of every interface. Each change to a peer bumps the generation of
+    its interface and records the generation the peer last changed in.
+    @param cur: sqlite3.Cursor
+    @return: None
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS peer_generation (config_name VARCHAR NOT NULL PRIMARY KEY, "
+                "generation INTEGER NOT NULL DEFAULT 0, floor INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TABLE IF NOT EXISTS peer_changes (config_name VARCHAR NOT NULL, id VARCHAR NOT NULL, "
+                "generation INTEGER NOT NULL, removed TINYINT(1) DEFAULT 0, PRIMARY KEY (config_name, id))")
+    cur.execute("CREATE INDEX IF NOT EXISTS peer_changes_generation ON peer_changes (config_name, generation)")
+
+
+def install_change_triggers(cur, config_name):
+    """
+    Version the peers of an interface: record every peer that is added, removed or changed
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    def record(row, removed):
+        return (f"INSERT INTO peer_generation (config_name, generation) VALUES ('{config_name}', 1) "
+                f"ON CONFLICT(config_name) DO UPDATE SET generation = generation + 1; "
+                f"INSERT INTO peer_changes VALUES ('{config_name}', {row}.id, "
+                f"(SELECT generation FROM peer_generation WHERE config_name = '{config_name}'), {removed}) "
+                f"ON CONFLICT(config_name, id) DO UPDATE SET generation = excluded.generation, "
+                f"removed = excluded.removed;")
+
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in bulk.PEER_COLUMNS
+                          if column not in IGNORED_COLUMNS)
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_insert_change AFTER INSERT ON {config_name} "
+                f"BEGIN {record('NEW', 0)} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_delete_change AFTER DELETE ON {config_name} "
+                f"BEGIN {record('OLD', 1)} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_update_change AFTER UPDATE ON {config_name} "
+                f"WHEN {changed} BEGIN {record('NEW', 0)} END")
+
+
+def get_generation(cur, config_name):
+    """
+    Get the generation of an interface's peers, and the oldest generation changes can still be listed from
+    @return: (generation, floor)
+    """
+    row = cur.execute("SELECT generation, floor FROM peer_generation WHERE config_name = ?",
+                      (config_name,)).fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def changes_since(cur, config_name, since):
+    """
+    Peers changed and removed after a generation
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param since: Generation the caller has
+    @return: (list of changed peer ids, list of removed peer ids), or None when the changes since that generation
+             are not known any more and the caller needs every peer
+    """
+    generation, floor = get_generation(cur, config_name)
+    if since < floor or since > generation:
+        return None
+    changed, removed = [], []
+    for peer_id, is_removed in cur.execute("SELECT id, removed FROM peer_changes "
+                                           "WHERE config_name = ? AND generation > ?", (config_name, since)):
+        (removed if is_removed else changed).append(peer_id)
+    return changed, removed
+
+
+def forget_removed(cur, config_name, keep=MAX_REMOVED):
+    """
+    Forget the removed peers of an interface once there are more than `keep` of them. Callers holding an older
+    generation get every peer on their next request.
+    @return: None
+    """
+    count = cur.execute("SELECT COUNT(*) FROM peer_changes WHERE config_name = ? AND removed = 1",
+                        (config_name,)).fetchone()[0]
+    if count <= keep:
+        return
+    cur.execute("UPDATE peer_generation SET floor = generation WHERE config_name = ?", (config_name,))
+    cur.execute("DELETE FROM peer_changes WHERE config_name = ? AND removed = 1", (config_name,))
@@ -0,0 +1,217 @@
+import csv
+import io
+import itertools
+import json
+import subprocess
+import time
+
+import bulk
+import peer_batch
+import prefix_trie
+from command import wg_set_peers
+from command_runner import wg_quick
+
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+# Rows per yielded export block
+EXPORT_BATCH = 500
+# Rows per import transaction and kernel call
+IMPORT_CHUNK = 500
+# Row errors kept in the import summary
+MAX_REPORTED_ERRORS = 100
+
+# Positions in a peer row
+ID, ALLOWED_IP, PRESHARED_KEY, END_ACTIVE = (bulk.PEER_COLUMNS.index(column) for column in
+                                            ("id", "allowed_ip", "preshared_key", "end_active"))
+
+FLOAT_COLUMNS = ("total_receive", "total_sent", "total_data", "cumu_receive", "cumu_sent", "cumu_data", "bandwidth")
+
+
+def export_peers(cur, config_name, fmt="csv"):
+    """
+    Stream every peer of an interface straight from the cursor, with its configuration, quota, expiry and usage
+    @param cur: sqlite3.Cursor used only by this export
+    @param config_name: Name of WG interface
+    @param fmt: csv or jsonl
+    @return: Iterator of str blocks
+    """
+    rows = cur.execute(f"SELECT {', '.join(bulk.PEER_COLUMNS)} FROM {config_name}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(bulk.PEER_COLUMNS)
+    while True:
+        block = rows.fetchmany(EXPORT_BATCH)
+        if not block:
+            break
+        for row in block:
+            if fmt == "csv":
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(bulk.PEER_COLUMNS, row))) + "\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def read_records(stream, fmt):
+    """
+    Parse an import stream lazily
+    @param stream: Text stream
+    @param fmt: csv or jsonl
+    @return: Iterator of (line number, dict or None when the line is not valid JSON)
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def to_row(record, defaults, now, existing=False):
+    """
+    Build a peer row in bulk.PEER_COLUMNS order from an imported record. Traffic of another node is folded into
+    the cumulative counters, since the kernel counters start again from zero. A peer that already exists here
+    keeps its kernel counters, so its usage is restored as exported instead of being counted twice.
+    @param existing: The peer is already on this interface
+    @return: tuple
+    @raise ValueError: A number can not be parsed
+    """
+    value = {column: record.get(column) for column in bulk.PEER_COLUMNS}
+    for column in FLOAT_COLUMNS:
+        value[column] = float(value[column] or 0)
+    for column, default in (("DNS", defaults["DNS"]), ("endpoint_allowed_ip", defaults["endpoint_allowed_ip"]),
+                            ("mtu", defaults["MTU"]), ("keepalive", defaults["keep_alive"]),
+                            ("remote_endpoint", defaults["remote_endpoint"])):
+        if value[column] in (None, ""):
+            value[column] = default
+    value["ends_at"] = float(value["ends_at"]) if value["ends_at"] not in (None, "") else None
+    value["end_active"] = int(str(value["end_active"]) not in ("0", "False", "false"))
+    if not existing:
+        value["cumu_receive"] += value["total_receive"]
+        value["cumu_sent"] += value["total_sent"]
+        value.update(total_receive=0, total_sent=0)
+    value["cumu_data"] = value["cumu_receive"] + value["cumu_sent"]
+    value["total_data"] = value["total_receive"] + value["total_sent"]
+    value.update({
+        "name": value["name"] or "", "private_key": value["private_key"] or "",
+        "preshared_key": value["preshared_key"] or "", "allowed_ip": str(value["allowed_ip"]).replace(" ", ""),
+        "endpoint": "N/A", "status": "stopped",
+        "latest_handshake": "N/A", "timer_on": int(value["ends_at"] is not None),
+        "created_at": float(value["created_at"]) if value["created_at"] not in (None, "") else now
+    })
+    return tuple(value[column] for column in bulk.PEER_COLUMNS)
+
+
+def check_record(record):
+    """
+    Validate an imported record
+    @return: Error message, or None
+    """
+    if record is None:
+        return "Line is not a JSON object."
+    if not peer_batch.check_key(record.get("id")):
+        return "id must be the public key of the peer."
+    if not record.get("allowed_ip"):
+        return "allowed_ip is required."
+    fields = {"allowed_ips": record["allowed_ip"]}
+    for field, column in (("DNS", "DNS"), ("endpoint_allowed_ip", "endpoint_allowed_ip"), ("MTU", "mtu"),
+                          ("keep_alive", "keepalive"), ("private_key", "private_key"),
+                          ("preshared_key", "preshared_key"), ("bandwidth", "bandwidth"), ("ends_at", "ends_at")):
+        if record.get(column) not in (None, ""):
+            fields[field] = record[column]
+    return peer_batch.check_fields(fields)
+
+
+def upsert_sql(config_name):
+    """
+    INSERT of one peer row that overwrites an existing peer with the same id
+    @return: str
+    """
+    updates = ", ".join(f"{column} = excluded.{column}" for column in bulk.PEER_COLUMNS if column != "id")
+    return f"{bulk.insert_peers_sql(config_name)} ON CONFLICT(id) DO UPDATE SET {updates}"
+
+
+def import_peers(cur, config_name, records, defaults, chunk_size=IMPORT_CHUNK):
+    """
+    Import peers in chunks with upsert semantics. Each chunk is validated (formats and AllowedIPs overlaps with
+    other peers), applied to the kernel with one `wg set` call and written with one executemany, then committed.
+    The configuration file is saved once at the end. Memory does not grow with the number of records.
+
+    Generator: yields {"imported", "failed"} after every chunk, then a final dict that also has "status",
+    "msg" and "errors" (the first MAX_REPORTED_ERRORS rejected lines).
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @param records: Iterator of (line number, record) from read_records
+    @param defaults: dict with the default "DNS", "endpoint_allowed_ip", "MTU", "keep_alive" and "remote_endpoint"
+    @param chunk_size: Records per transaction
+    """
+    sql = upsert_sql(config_name)
+    index = prefix_trie.get_index(cur, config_name)
+    imported = failed = 0
+    errors = []
+    error = None
+
+    def reject(number, record, msg):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"line": number, "id": record.get("id") if record else None, "msg": msg})
+
+    try:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            now = time.time()
+            accepted = []
+            seen = set()
+            existing = peer_batch.load_peers(cur, config_name, {
+                record["id"] for _, record in chunk if record is not None and isinstance(record.get("id"), str)})
+            for number, record in chunk:
+                msg = check_record(record)
+                if msg is None and record["id"] in seen:
+                    msg = "Peer appears more than once in the same chunk."
+                if msg is None:
+                    try:
+                        accepted.append((number, record, to_row(record, defaults, now, record["id"] in existing)))
+                        seen.add(record["id"])
+                        continue
+                    except (TypeError, ValueError):
+                        msg = "A numeric column can not be parsed."
+                reject(number, record, msg)
+            conflicts = index.validate([(row[ID], row[ALLOWED_IP], row[ID]) for _, _, row in accepted])
+            for number, record, row in accepted:
+                if row[ID] in conflicts:
+                    reject(number, record, "Allowed IPs already used by another peer.")
+            accepted = [row for _, _, row in accepted if row[ID] not in conflicts]
+            if not accepted:
+                yield {"imported": imported, "failed": failed}
+                continue
+            try:
+                wg_set_peers(config_name, [
+                    {"public_key": row[ID], "allowed_ips": row[ALLOWED_IP], "preshared_key": row[PRESHARED_KEY]}
+                    if row[END_ACTIVE] else {"public_key": row[ID], "remove": True} for row in accepted])
+            except subprocess.CalledProcessError as exc:
+                error = exc.output.decode("UTF-8", "replace").strip()
+                failed += len(accepted)
+                break
+            cur.executemany(sql, accepted)
+            cur.connection.commit()
+            for row in accepted:
+                index.add(row[ID], row[ALLOWED_IP])
+            imported += len(accepted)
+            yield {"imported": imported, "failed": failed}
+    finally:
+        if imported:
+            wg_quick("save", config_name, wait=None)
+    yield {"imported": imported, "failed": failed, "status": error is None, "msg": error or "", "errors": errors}
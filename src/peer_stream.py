@@ -0,0 +1,357 @@
+import os
+import selectors
+import socket
+import threading
+import time
+import urllib.parse
+
+import columnar
+
+# Seconds without an event after which a comment is sent to keep proxies from closing the stream
+HEARTBEAT_INTERVAL = 15.0
+# Bytes waiting for a slow client before it is dropped; it reconnects with Last-Event-ID
+MAX_PENDING = 16 * 1024 * 1024
+# Largest request head accepted from a client, and the seconds it has to send it
+MAX_REQUEST_HEAD = 16 * 1024
+REQUEST_TIMEOUT = 10.0
+# Seconds a process waits before trying again to listen on the stream port, e.g. while another process has it
+LISTEN_RETRY_INTERVAL = 30.0
+
+
+def format_event(generation, payload, retry=None):
+    """
+    Encode a Server-Sent Event carrying peer changes
+    @param generation: Generation of the peers, used as the event id
+    @param payload: JSON serializable dict
+    @param retry: Milliseconds the browser waits before reconnecting
+    @return: bytes
+    """
+    head = "" if retry is None else f"retry: {int(retry)}\n"
+    return f"{head}id: {generation}\nevent: peers\ndata: ".encode() + columnar.dumps(payload) + b"\n\n"
+
+
+def parse_request(data):
+    """
+    Parse the head of an HTTP request
+    @param data: Request head without the blank line ending it
+    @return: (method, path, dict of query parameters, dict of headers with lower case names)
+    @raise ValueError: Malformed request
+    """
+    lines = data.decode("latin-1").split("\r\n")
+    method, target, version = lines[0].split(" ")
+    if not version.startswith("HTTP/1."):
+        raise ValueError(f"Unsupported protocol: {version}")
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if not separator:
+            raise ValueError(f"Malformed header: {line}")
+        headers[name.strip().lower()] = value.strip()
+    url = urllib.parse.urlsplit(target)
+    return method, urllib.parse.unquote(url.path), dict(urllib.parse.parse_qsl(url.query)), headers
+
+
+def cors_headers(headers):
+    """
+    Headers letting the dashboard's pages, served from another port of the same host, read a stream with their
+    cookies. Pages of other hosts get none, so their browsers refuse them the stream.
+    @param headers: Request headers with lower case names
+    @return: str of header lines
+    """
+    origin = headers.get("origin")
+    if not origin:
+        return ""
+    try:
+        origin_host = urllib.parse.urlsplit(origin).hostname
+        host = urllib.parse.urlsplit("//" + headers.get("host", "")).hostname
+    except ValueError:
+        return ""
+    if origin_host is None or origin_host != host:
+        return ""
+    return (f"Access-Control-Allow-Origin: {origin}\r\nAccess-Control-Allow-Credentials: true\r\n"
+            f"Access-Control-Allow-Headers: Last-Event-ID\r\nVary: Origin\r\n")
+
+
+class Request:
+    """
+    Connection whose request head is still being read
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.data = b""
+        self.started_at = time.monotonic()
+
+
+class Subscriber:
+    """
+    One open stream
+    """
+
+    def __init__(self, sock, config_name, search, generation):
+        self.sock = sock
+        self.config_name = config_name
+        self.search = search
+        # Generation and ETag of the last event sent; None until the first one
+        self.generation = generation
+        self.etag = None
+        self.pending = b""
+        self.sent_at = time.monotonic()
+
+
+class StreamHub:
+    """
+    Small HTTP server of the Server-Sent Events streams, listening on a port of its own so that open streams
+    never hold a thread or a connection of the web server. One event loop thread serves every stream. With
+    several processes, the first one listening on the port serves them and the others take over if it exits.
+    Every `interval` seconds, the interfaces somebody watches are collected once and each client gets the
+    changes since the generation it last received.
+    """
+
+    def __init__(self, collect, interval, admit, address):
+        """
+        @param collect: Function taking {config name: set of (search, generation)} and returning
+                        {(config name, search, generation): (new generation, ETag, payload)}; a generation of
+                        None asks for every peer
+        @param interval: Function returning the seconds between two collections
+        @param admit: Function taking the config name and the request headers, returning None to accept the
+                      stream or the HTTP status to refuse it with, e.g. "401 Unauthorized"
+        @param address: Function returning the (host, port) to listen on; port 0 turns the streams off
+        """
+        self.collect = collect
+        self.interval = interval
+        self.admit = admit
+        self.address = address
+        self._lock = threading.Lock()
+        self._started_pid = None
+
+    def start(self):
+        """
+        Start the event loop of this process (after gunicorn forked the worker)
+        @return: None
+        """
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._run, name="peer-stream", daemon=True).start()
+
+    def _run(self):
+        while True:
+            address = self.address()
+            listener = None
+            if address[1]:
+                try:
+                    family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+                    listener = socket.create_server(address, family=family)
+                except OSError:
+                    # Another process serves the streams
+                    pass
+            if listener is None:
+                time.sleep(LISTEN_RETRY_INTERVAL)
+                continue
+            try:
+                self._serve(listener, address)
+            except Exception as exc:
+                print(f"Peer stream server failed: {exc!r}")
+                time.sleep(LISTEN_RETRY_INTERVAL)
+
+    def _serve(self, listener, address):
+        """
+        Serve the streams until the address in the settings changes
+        """
+        listener.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        requests = set()
+        subscribers = set()
+        next_collect = time.monotonic()
+        try:
+            while self.address() == address:
+                now = time.monotonic()
+                deadlines = [now + LISTEN_RETRY_INTERVAL]
+                deadlines.extend(request.started_at + REQUEST_TIMEOUT for request in requests)
+                if subscribers:
+                    deadlines.append(next_collect)
+                admitted = set()
+                for key, events in selector.select(max(0.0, min(deadlines) - now)):
+                    if key.fileobj is listener:
+                        self._accept(selector, listener, requests)
+                    elif isinstance(key.data, Request):
+                        subscriber = self._read_request(selector, requests, subscribers, key.data)
+                        if subscriber is not None:
+                            admitted.add(subscriber)
+                    elif key.data in subscribers:
+                        subscriber = key.data
+                        if events & selectors.EVENT_READ and not self._readable(subscriber):
+                            self._drop(selector, subscribers, subscriber)
+                        elif events & selectors.EVENT_WRITE:
+                            self._send(selector, subscribers, subscriber, b"")
+                for request in [request for request in requests
+                                if time.monotonic() - request.started_at > REQUEST_TIMEOUT]:
+                    self._close(selector, requests, request)
+                if admitted:
+                    # A new stream gets its first event right away
+                    self._push(selector, subscribers, admitted)
+                if subscribers and time.monotonic() >= next_collect:
+                    next_collect = time.monotonic() + self.interval()
+                    self._push(selector, subscribers, subscribers)
+        finally:
+            for request in list(requests):
+                self._close(selector, requests, request)
+            for subscriber in list(subscribers):
+                self._drop(selector, subscribers, subscriber)
+            selector.close()
+            listener.close()
+
+    @staticmethod
+    def _accept(selector, listener, requests):
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        request = Request(sock)
+        requests.add(request)
+        selector.register(sock, selectors.EVENT_READ, request)
+
+    def _read_request(self, selector, requests, subscribers, request):
+        """
+        Read a request head and, once it is complete, answer it or open its stream
+        @return: Subscriber of the new stream, or None
+        """
+        try:
+            data = request.sock.recv(4096)
+        except BlockingIOError:
+            return None
+        except OSError:
+            data = b""
+        if not data:
+            self._close(selector, requests, request)
+            return None
+        request.data += data
+        end = request.data.find(b"\r\n\r\n")
+        if end < 0:
+            if len(request.data) > MAX_REQUEST_HEAD:
+                self._close(selector, requests, request, "431 Request Header Fields Too Large")
+            return None
+        try:
+            method, path, query, headers = parse_request(request.data[:end])
+        except ValueError:
+            self._close(selector, requests, request, "400 Bad Request")
+            return None
+        cors = cors_headers(headers)
+        if headers.get("origin") and not cors:
+            # A page of another site, which must not read the peers with the user's cookies
+            self._close(selector, requests, request, "403 Forbidden")
+            return None
+        if method == "OPTIONS":
+            self._close(selector, requests, request, "204 No Content", cors + "Access-Control-Allow-Methods: GET\r\n")
+            return None
+        if method != "GET" or not path.startswith("/stream/"):
+            self._close(selector, requests, request, "404 Not Found", cors)
+            return None
+        config_name = path[len("/stream/"):]
+        try:
+            refused = self.admit(config_name, headers)
+        except Exception as exc:
+            print(f"Peer stream request failed: {exc!r}")
+            refused = "500 Internal Server Error"
+        if refused:
+            self._close(selector, requests, request, refused, cors)
+            return None
+        since = headers.get("last-event-id") or query.get("since")
+        try:
+            since = int(since) if since else None
+        except ValueError:
+            since = None
+        requests.discard(request)
+        subscriber = Subscriber(request.sock, config_name, query.get("search", ""), since)
+        subscribers.add(subscriber)
+        selector.modify(request.sock, selectors.EVENT_READ, subscriber)
+        # No Content-Length: the body of the response is everything until the connection closes
+        self._send(selector, subscribers, subscriber, (
+            f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-store\r\n"
+            f"X-Accel-Buffering: no\r\nConnection: close\r\n{cors}\r\n").encode("latin-1"))
+        return subscriber if subscriber in subscribers else None
+
+    @staticmethod
+    def _close(selector, requests, request, status=None, headers=""):
+        """
+        Close a connection whose stream was not opened, answering it with status when given
+        """
+        requests.discard(request)
+        try:
+            selector.unregister(request.sock)
+        except (KeyError, ValueError):
+            pass
+        if status is not None:
+            try:
+                request.sock.send(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n{headers}\r\n"
+                                  .encode("latin-1"))
+            except OSError:
+                pass
+        request.sock.close()
+
+    def _push(self, selector, subscribers, targets):
+        channels = {}
+        for subscriber in targets:
+            channels.setdefault(subscriber.config_name, set()).add((subscriber.search, subscriber.generation))
+        try:
+            snapshots = self.collect(channels)
+        except Exception as exc:
+            print(f"Peer stream collection failed: {exc}")
+            return
+        events = {}
+        now = time.monotonic()
+        for subscriber in list(targets):
+            if subscriber not in subscribers:
+                continue
+            key = (subscriber.config_name, subscriber.search, subscriber.generation)
+            generation, etag, payload = snapshots.get(key, (None, subscriber.etag, None))
+            if etag != subscriber.etag:
+                # The first event tells the browser how long to wait before reconnecting
+                first = subscriber.etag is None
+                if (key, first) not in events:
+                    events[(key, first)] = format_event(generation, payload,
+                                                        self.interval() * 1000 if first else None)
+                subscriber.generation, subscriber.etag = generation, etag
+                self._send(selector, subscribers, subscriber, events[(key, first)])
+            elif now - subscriber.sent_at >= HEARTBEAT_INTERVAL:
+                self._send(selector, subscribers, subscriber, b": ping\n\n")
+
+    @staticmethod
+    def _readable(subscriber):
+        # Clients send nothing on a stream: readable means closed
+        try:
+            return bool(subscriber.sock.recv(4096))
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _send(self, selector, subscribers, subscriber, data):
+        subscriber.pending += data
+        subscriber.sent_at = time.monotonic()
+        try:
+            sent = subscriber.sock.send(subscriber.pending) if subscriber.pending else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(selector, subscribers, subscriber)
+            return
+        subscriber.pending = subscriber.pending[sent:]
+        if len(subscriber.pending) > MAX_PENDING:
+            self._drop(selector, subscribers, subscriber)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.pending else 0)
+        selector.modify(subscriber.sock, events, subscriber)
+
+    @staticmethod
+    def _drop(selector, subscribers, subscriber):
+        subscribers.discard(subscriber)
+        try:
+            selector.unregister(subscriber.sock)
+        except (KeyError, ValueError):
+            pass
+        subscriber.sock.close()
@@ -0,0 +1,324 @@
+import ipaddress
+import threading
+
+from ip_allocator import parse_networks
+
+# Allowed IPs changes remembered per interface; past that the log is cleared and older indexes are rebuilt
+MAX_CHANGES = 10000
+
+
+def create_index_tables(cur):
+    """
+    Create the tables logging the allowed IPs changes of every interface, from which cached indexes catch up
+    @param cur: sqlite3.Cursor
+    @return: None
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS allowed_ip_revision (config_name VARCHAR NOT NULL PRIMARY KEY, "
+                "revision INTEGER NOT NULL DEFAULT 0, floor INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TABLE IF NOT EXISTS allowed_ip_changes (config_name VARCHAR NOT NULL, id VARCHAR NOT NULL, "
+                "revision INTEGER NOT NULL, PRIMARY KEY (config_name, id))")
+    cur.execute("CREATE INDEX IF NOT EXISTS allowed_ip_changes_revision ON allowed_ip_changes (config_name, revision)")
+
+
+def install_index_triggers(cur, config_name):
+    """
+    Log every peer of an interface that is added, removed or moved to other allowed IPs
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: None
+    """
+    def record(row):
+        return (f"INSERT INTO allowed_ip_revision (config_name, revision) VALUES ('{config_name}', 1) "
+                f"ON CONFLICT(config_name) DO UPDATE SET revision = revision + 1; "
+                f"INSERT INTO allowed_ip_changes VALUES ('{config_name}', {row}.id, "
+                f"(SELECT revision FROM allowed_ip_revision WHERE config_name = '{config_name}')) "
+                f"ON CONFLICT(config_name, id) DO UPDATE SET revision = excluded.revision;")
+
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_insert_allowed_ip AFTER INSERT ON {config_name} "
+                f"BEGIN {record('NEW')} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_delete_allowed_ip AFTER DELETE ON {config_name} "
+                f"BEGIN {record('OLD')} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS {config_name}_update_allowed_ip "
+                f"AFTER UPDATE OF allowed_ip ON {config_name} WHEN OLD.allowed_ip IS NOT NEW.allowed_ip "
+                f"BEGIN {record('NEW')} END")
+
+
+def get_index_revision(cur, config_name):
+    """
+    Get the allowed IPs revision of an interface, and the oldest revision its changes are logged from
+    @return: (revision, floor)
+    """
+    row = cur.execute("SELECT revision, floor FROM allowed_ip_revision WHERE config_name = ?",
+                      (config_name,)).fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def forget_changes(cur, config_name, keep=MAX_CHANGES):
+    """
+    Clear the change log of an interface once it holds more than `keep` peers. Indexes older than that are
+    rebuilt on their next use.
+    @return: None
+    """
+    count = cur.execute("SELECT COUNT(*) FROM allowed_ip_changes WHERE config_name = ?", (config_name,)).fetchone()[0]
+    if count <= keep:
+        return
+    cur.execute("UPDATE allowed_ip_revision SET floor = revision WHERE config_name = ?", (config_name,))
+    cur.execute("DELETE FROM allowed_ip_changes WHERE config_name = ?", (config_name,))
+
+
+class _Node:
+    __slots__ = ("value", "length", "children", "owners")
+
+    def __init__(self, value, length, owner=None):
+        self.value = value
+        self.length = length
+        self.children = [None, None]
+        self.owners = {owner} if owner is not None else set()
+
+
+class PrefixTrie:
+    """
+    Path-compressed binary (Patricia) trie of network prefixes of one address family. Every prefix keeps the
+    set of owners (peer ids) that use it. Lookups walk at most one node per prefix bit.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.root = _Node(0, 0)
+
+    def _bit(self, value, index):
+        return (value >> (self.width - 1 - index)) & 1
+
+    def _mask(self, value, length):
+        return value & ~((1 << (self.width - length)) - 1) if length else 0
+
+    def _common(self, node, value, length):
+        diff = node.value ^ value
+        common = self.width - diff.bit_length() if diff else self.width
+        return min(common, node.length, length)
+
+    def insert(self, value, length, owner):
+        """
+        Add an owner of the prefix value/length
+        @return: None
+        """
+        node = self.root
+        while True:
+            if node.length == length:
+                node.owners.add(owner)
+                return
+            bit = self._bit(value, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(value, length, owner)
+                return
+            common = self._common(child, value, length)
+            if common == child.length:
+                node = child
+                continue
+            middle = _Node(self._mask(value, common), common)
+            node.children[bit] = middle
+            middle.children[self._bit(child.value, common)] = child
+            if common == length:
+                middle.owners.add(owner)
+            else:
+                middle.children[self._bit(value, common)] = _Node(value, length, owner)
+            return
+
+    def remove(self, value, length, owner):
+        """
+        Remove an owner of the prefix value/length, pruning nodes that became empty
+        @return: None
+        """
+        path = []
+        node = self.root
+        while node is not None and node.length < length:
+            if self._common(node, value, length) < node.length:
+                return
+            path.append(node)
+            node = node.children[self._bit(value, node.length)]
+        if node is None or node.length != length or node.value != value:
+            return
+        node.owners.discard(owner)
+        while path and not node.owners:
+            parent = path.pop()
+            children = [child for child in node.children if child is not None]
+            slot = parent.children.index(node)
+            if len(children) == 2:
+                break
+            parent.children[slot] = children[0] if children else None
+            node = parent
+            if node is self.root:
+                break
+
+    def _subtree_owners(self, node, exclude):
+        stack = [node]
+        found = set()
+        while stack:
+            node = stack.pop()
+            found.update(node.owners - exclude)
+            stack.extend(child for child in node.children if child is not None)
+        return found
+
+    def overlapping(self, value, length, exclude=frozenset()):
+        """
+        Owners of every prefix that contains or is contained in value/length
+        @return: set
+        """
+        found = set()
+        node = self.root
+        while node is not None:
+            common = self._common(node, value, length)
+            if common < node.length:
+                # The query is a prefix of this node: everything below overlaps
+                if common == length:
+                    found.update(self._subtree_owners(node, exclude))
+                break
+            found.update(node.owners - exclude)
+            if node.length == length:
+                for child in node.children:
+                    if child is not None:
+                        found.update(self._subtree_owners(child, exclude))
+                break
+            node = node.children[self._bit(value, node.length)]
+        return found
+
+    def longest_match(self, value, length=None):
+        """
+        Deepest prefix containing value/length
+        @return: (value, length, owners) or None
+        """
+        length = self.width if length is None else length
+        best = None
+        node = self.root
+        while node is not None and node.length <= length:
+            if self._common(node, value, length) < node.length:
+                break
+            if node.owners:
+                best = (node.value, node.length, set(node.owners))
+            if node.length == length:
+                break
+            node = node.children[self._bit(value, node.length)]
+        return best
+
+
+class AllowedIPIndex:
+    """
+    AllowedIPs of every peer of one interface. It is updated in place, so every method holds its lock.
+    """
+
+    def __init__(self, revision=0):
+        self.revision = revision
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.peers = {}
+        self.lock = threading.RLock()
+
+    def add(self, peer_id, allowed_ip):
+        """
+        Index the allowed IPs of a peer, replacing what was indexed for it before
+        @return: None
+        """
+        with self.lock:
+            self.remove(peer_id)
+            networks = parse_networks(allowed_ip)
+            for network in networks:
+                self.tries[network.version].insert(int(network.network_address), network.prefixlen, peer_id)
+            self.peers[peer_id] = networks
+
+    def remove(self, peer_id):
+        with self.lock:
+            for network in self.peers.pop(peer_id, []):
+                self.tries[network.version].remove(int(network.network_address), network.prefixlen, peer_id)
+
+    def conflicts(self, allowed_ip, exclude=None):
+        """
+        Peers whose allowed IPs overlap any of the given ranges (duplicates, supernets and subnets)
+        @param allowed_ip: Comma separated addresses or networks
+        @param exclude: Peer id to ignore, e.g. the peer being edited
+        @return: set of peer ids
+        """
+        exclude = frozenset([exclude]) if exclude is not None else frozenset()
+        found = set()
+        with self.lock:
+            for network in parse_networks(allowed_ip):
+                found |= self.tries[network.version].overlapping(int(network.network_address), network.prefixlen,
+                                                                 exclude)
+        return found
+
+    def longest_match(self, address):
+        """
+        Peer routing an address, like the kernel's cryptokey routing
+        @return: set of peer ids
+        """
+        address = ipaddress.ip_address(address)
+        with self.lock:
+            match = self.tries[address.version].longest_match(int(address))
+        return match[2] if match else set()
+
+    def validate(self, ranges, released=frozenset(), batch=None):
+        """
+        Check many new ranges in one pass against the index and against each other
+        @param ranges: Iterable of (key, allowed_ip, exclude_peer_id)
+        @param released: Peer ids whose current ranges are given up in the same change
+        @param batch: AllowedIPIndex collecting the accepted ranges, e.g. to check later additions against
+        @return: dict mapping each conflicting key to the set of peer ids or keys it overlaps
+        """
+        batch = AllowedIPIndex() if batch is None else batch
+        failed = {}
+        with self.lock:
+            for key, allowed_ip, exclude in ranges:
+                found = (self.conflicts(allowed_ip, exclude) - released) | batch.conflicts(allowed_ip)
+                if found:
+                    failed[key] = found
+                else:
+                    batch.add(key, allowed_ip)
+        return failed
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(cur, config_name):
+    """
+    Get the AllowedIPs index of an interface. The peers added, removed or moved since the index was built or
+    last updated, by this or any other worker, are applied to it from the change log; it is only rebuilt from
+    the whole table when it is older than the log.
+    @param cur: sqlite3.Cursor
+    @param config_name: Name of WG interface
+    @return: AllowedIPIndex
+    """
+    revision, floor = get_index_revision(cur, config_name)
+    with _indexes_lock:
+        index = _indexes.get(config_name)
+    if index is not None:
+        with index.lock:
+            if index.revision == revision:
+                return index
+            if floor <= index.revision < revision:
+                for peer_id, allowed_ip, present in cur.execute(
+                        f"SELECT c.id, p.allowed_ip, p.id IS NOT NULL FROM allowed_ip_changes c "
+                        f"LEFT JOIN {config_name} p ON p.id = c.id WHERE c.config_name = ? AND c.revision > ?",
+                        (config_name, index.revision)).fetchall():
+                    if present:
+                        index.add(peer_id, allowed_ip)
+                    else:
+                        index.remove(peer_id)
+                index.revision = revision
+                return index
+    forget_changes(cur, config_name)
+    index = AllowedIPIndex(get_index_revision(cur, config_name)[0])
+    for peer_id, allowed_ip in cur.execute(f"SELECT id, allowed_ip FROM {config_name}").fetchall():
+        index.add(peer_id, allowed_ip)
+    with _indexes_lock:
+        _indexes[config_name] = index
+    return index
+
+
+def clear_cache():
+    """
+    Drop the cached indexes, e.g. after the database was restored
+    @return: None
+    """
+    with _indexes_lock:
+        _indexes.clear()
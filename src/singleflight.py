@@ -0,0 +1,186 @@
+import threading
+import time
+
+# Seconds a result is served to identical calls after it was computed
+RESULT_TTL = 1.0
+# Cached results kept before expired ones are pruned
+MAX_RESULTS = 256
+
+
+class _Call:
+    """
+    One computation in flight, waited on by the identical calls that arrived meanwhile
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _Stream:
+    """
+    One streamed result being produced, read by the identical calls that arrived meanwhile
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.changed = threading.Condition()
+
+    def add(self, chunk):
+        with self.changed:
+            self.chunks.append(chunk)
+            self.changed.notify_all()
+
+    def finish(self, error=None):
+        with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+
+class Group:
+    """
+    Coalesces identical calls made at the same time by different threads: the first one computes, the others
+    wait for it and get the same result, which is also served for `ttl` seconds afterwards. Streamed results
+    are shared chunk by chunk while they are produced. Errors are shared with the waiting calls but not kept.
+    """
+
+    def __init__(self, ttl=RESULT_TTL, max_results=MAX_RESULTS):
+        """
+        @param ttl: Seconds a result is kept
+        @param max_results: Results kept before expired ones are pruned
+        """
+        self.ttl = ttl
+        self.max_results = max_results
+        self._calls = {}
+        self._streams = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        """
+        Get the result of a computation, shared with every identical call in flight or made within the TTL
+        @param key: Hashable identifying the computation and everything its result depends on
+        @param compute: Function without arguments
+        @return: The result of compute
+        """
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = compute()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None:
+                    self._store(key, call.value)
+            call.done.set()
+        return call.value
+
+    def stream(self, key, produce):
+        """
+        Get a streamed result, shared with every identical call in flight or made within the TTL: the first call
+        produces the chunks while it sends them, the calls that arrive meanwhile are sent the same chunks as they
+        are produced. When the first caller goes away early, it still produces the rest for the others.
+        @param key: Hashable identifying the result and everything it depends on
+        @param produce: Function without arguments returning an iterator of bytes
+        @return: Iterator of bytes
+        """
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                yield cached[0]
+                return
+            stream = self._streams.get(key)
+            leader = stream is None
+            if leader:
+                stream = self._streams[key] = _Stream()
+            else:
+                stream.readers += 1
+        if not leader:
+            try:
+                yield from self._follow(stream)
+            finally:
+                with self._lock:
+                    stream.readers -= 1
+            return
+        chunks = produce()
+        error = None
+        complete = False
+        try:
+            for chunk in chunks:
+                stream.add(chunk)
+                yield chunk
+            complete = True
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            if not complete and error is None:
+                with self._lock:
+                    readers = stream.readers
+                    if not readers:
+                        # Nobody else reads it: stop here
+                        del self._streams[key]
+                if readers:
+                    try:
+                        for chunk in chunks:
+                            stream.add(chunk)
+                        complete = True
+                    except Exception as exc:
+                        error = exc
+            if hasattr(chunks, "close"):
+                chunks.close()
+            with self._lock:
+                self._streams.pop(key, None)
+                if complete:
+                    self._store(key, b"".join(stream.chunks))
+            stream.finish(None if complete else error or RuntimeError("The streamed result was not completed"))
+
+    @staticmethod
+    def _follow(stream):
+        index = 0
+        while True:
+            with stream.changed:
+                while index == len(stream.chunks) and not stream.done:
+                    stream.changed.wait()
+                chunks = stream.chunks[index:]
+                done, error = stream.done, stream.error
+            index += len(chunks)
+            yield from chunks
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    def forget(self):
+        """
+        Drop every kept result, after a change the keys do not capture
+        @return: None
+        """
+        with self._lock:
+            self._results.clear()
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        if len(self._results) >= self.max_results:
+            self._results = {k: v for k, v in self._results.items() if v[1] > now}
+        if len(self._results) < self.max_results:
+            self._results[key] = (value, now + self.ttl)
@@ -174,14 +174,10 @@
     if ($new_add_amount.val() > 0 && !$new_add_amount.hasClass("is-invalid")) {
         if ($new_add_DNS.val() !== "" && $new_add_endpoint_allowed_ip.val() !== "") {
             const conf = $add_peer.getAttribute('conf_id');
-            const keys = [];
-            for (let i = 0; i < $new_add_amount.val(); i++) {
-                keys.push(window.wireguard.generateKeypair());
-            }
 
             $.ajax({
                 method: "POST",
-                url: "/add_peer_bulk/" + conf,
+                url: "/add_peer_bulk/" + conf + "?job=true",
                 headers: {
                     "Content-Type": "application/json"
                 },
@@ -191,15 +187,23 @@
                     "MTU": $new_add_MTU.val(),
                     "keep_alive": $new_add_keep_alive.val(),
                     "enable_preshared_key": $enable_preshare_key.prop("checked"),
-                    "keys": keys,
                     "amount": $new_add_amount.val()
                 }),
-                success: function (response) {
-                    if (response !== "true") {
+                success: async function (response) {
+                    const job = response.job ? await window.jobs.wait(response.job, function (job) {
+                        $add_peer.innerHTML = `Adding peers... ${job.progress}/${job.total}`;
+                    }) : null;
+                    if (!job) {
                         $("#add_peer_alert").html(response).removeClass("d-none");
                         data_list.forEach((ele) => ele.prop("disabled", false));
                         $add_peer.removeAttribute("disabled");
                             $add_peer.innerHTML = "ذخیره کردن";
+                    } else if (job.status !== "done") {
+                        window.configurations.loadPeers("");
+                        $("#add_peer_alert").html(`${job.progress}/${job.total}: ${job.error || job.status}`).removeClass("d-none");
+                        data_list.forEach((ele) => ele.prop("disabled", false));
+                        $add_peer.removeAttribute("disabled");
+                            $add_peer.innerHTML = "ذخیره کردن";
                     } else {
                         window.configurations.loadPeers("");
                         data_list.forEach((ele) => ele.prop("disabled", false));
@@ -225,12 +229,16 @@
         function deletePeers(config, peer_ids) {
         $.ajax({
             method: "POST",
-            url: "/remove_peer/" + config,
+            url: "/remove_peer/" + config + "?job=true",
             headers: {
                 "Content-Type": "application/json"
             },
             data: JSON.stringify({"action": "delete", "peer_ids": peer_ids}),
-            success: function (response) {
+            success: async function (response) {
+                if (response.job) {
+                    const job = await window.jobs.wait(response.job);
+                    response = job && job.status === "done" ? "true" : (job ? job.error || job.status : "Job not found");
+                }
                 if (response !== "true") {
                     if (window.configurations.deleteModal()._isShown) {
                         $("#remove_peer_alert").html(response + $("#add_peer_alert").html())
@@ -281,6 +289,9 @@
     }
 
         function setConfigurationInterval() {
+        if (peerStreamAvailable()) {
+            return;
+        }
         configuration_interval = setInterval(function () {
             loadPeers($('#search_peer_textbox').val());
         }, configuration_timeout);
@@ -322,22 +333,157 @@
     let time = 0;
     let count = 0;
 
+    // Peers of the last /get_config response, merged with the deltas that follow it
+    let peerSnapshot = {search: null, generation: null, etag: null, peers: new Map()};
+
+    function networkSortKey(allowed_ip) {
+        let network = allowed_ip.split(",")[0].trim();
+        if (network === "(None)") network = "0.0.0.0/0";
+        let [address, prefix] = network.split("/");
+        if (address.includes(":")) {
+            let [head, tail] = address.toLowerCase().split("::");
+            let groups = head ? head.split(":") : [];
+            if (tail !== undefined) {
+                let rest = tail ? tail.split(":") : [];
+                groups = groups.concat(Array(8 - groups.length - rest.length).fill("0"), rest);
+            }
+            return "6" + groups.map(group => group.padStart(4, "0")).join("") + (prefix || "128").padStart(3, "0");
+        }
+        return "4" + address.split(".").map(part => parseInt(part).toString(16).padStart(2, "0")).join("") +
+            (prefix || "32").padStart(3, "0");
+    }
+
+    function sortPeers(list, sort_tag) {
+        let key = sort_tag === "allowed_ip" ? (peer => networkSortKey(peer.allowed_ip)) : (peer => peer[sort_tag]);
+        return list.map(peer => [key(peer), peer])
+            .sort((a, b) => a[0] < b[0] ? -1 : (a[0] > b[0] ? 1 : 0))
+            .map(pair => pair[1]);
+    }
+
+    // Peers from the columnar form of /get_config?format=columns and /stream; streamed lists have "rows"
+    // instead of "columns"
+    function decodePeers(data) {
+        let list = [];
+        for (let row = 0; row < data.count; row++) {
+            list.push({});
+        }
+        data.fields.forEach(function (field, i) {
+            let column = data.columns ? data.columns[i] : null;
+            let dictionary = data.dictionaries[field];
+            for (let row = 0; row < data.count; row++) {
+                let value = column ? column[row] : data.rows[row][i];
+                if (dictionary) {
+                    value = dictionary[value];
+                }
+                if (field === "ends_at") {
+                    value = value === null ? null : value * 1000;
+                } else if (field === "end_active") {
+                    value = !!value;
+                }
+                list[row][field] = value;
+            }
+        });
+        return list;
+    }
+
+    function mergePeers(response, searchString) {
+        if (response.peer_columns) {
+            response.peer_data = decodePeers(response.peer_columns);
+            delete response.peer_columns;
+        }
+        if (response.delta && response.generation < peerSnapshot.generation) {
+            return false;
+        }
+        if (!response.delta) {
+            peerSnapshot.peers = new Map(response.peer_data.map(peer => [peer.id, peer]));
+        } else {
+            response.removed.forEach(id => peerSnapshot.peers.delete(id));
+            response.peer_data.forEach(peer => peerSnapshot.peers.set(peer.id, peer));
+            response.peer_data = sortPeers(Array.from(peerSnapshot.peers.values()), response.sort_tag);
+        }
+        peerSnapshot.search = searchString;
+        peerSnapshot.generation = response.generation;
+        return true;
+    }
+
+    function renderPeers(response) {
+        peers = response.peer_data;
+        configurationAlert(response);
+        configurationHeader(response);
+        configurationPeers(response);
+        $(".dot.dot-running").attr("title","کاربر متصل است").tooltip();
+        $(".dot.dot-stopped").attr("title","کاربر متصل نیست").tooltip();
+        $("i[data-toggle='tooltip']").tooltip();
+    }
+
+    // Server-Sent Events of the peer changes, served on the stream port of the same host; replace polling
+    // unless the browser does not support them or the stream port can not be reached
+    let peerStream = null;
+    let peerStreamSearch = null;
+    let peerStreamOpened = false;
+
+    function peerStreamAvailable() {
+        return Boolean(window.EventSource) && stream_port > 0;
+    }
+
+    function openPeerStream(searchString) {
+        if (peerStream !== null) {
+            peerStream.close();
+        }
+        peerStreamSearch = searchString;
+        peerStream = new EventSource(`${location.protocol}//${location.hostname}:${stream_port}/stream/${conf_name}?search=${encodeURIComponent(searchString)}&since=${peerSnapshot.generation}`,
+            {withCredentials: true});
+        peerStream.addEventListener("peers", function (event) {
+            let response = JSON.parse(event.data);
+            if (peerSnapshot.search !== searchString) {
+                return;
+            }
+            if (mergePeers(response, searchString)) {
+                peerSnapshot.etag = null;
+                renderPeers(response);
+            }
+        });
+        peerStream.onopen = function () {
+            peerStreamOpened = true;
+            removeNoResponding();
+        };
+        peerStream.onerror = function () {
+            if (peerStreamOpened) {
+                noResponding();
+                return;
+            }
+            // Never reached the stream port: poll instead
+            peerStream.close();
+            peerStream = null;
+            stream_port = 0;
+            setConfigurationInterval();
+        };
+    }
+
     function loadPeers(searchString) {
         startProgressBar();
         d1 = new Date();
+        let url = `/get_config/${conf_name}?format=columns&stream=1&search=${encodeURIComponent(searchString)}`;
+        let headers = {"Content-Type": "application/json"};
+        if (peerSnapshot.search === searchString && peerSnapshot.generation !== null) {
+            url += `&since=${peerSnapshot.generation}`;
+            if (peerSnapshot.etag) {
+                headers["If-None-Match"] = peerSnapshot.etag;
+            }
+        }
         $.ajax({
             method: "GET",
-            url: `/get_config/${conf_name}?search=${encodeURIComponent(searchString)}`,
-            headers: {"Content-Type": "application/json"}
-        }).done(function (response) {
+            url: url,
+            headers: headers
+        }).done(function (response, textStatus, jqXHR) {
             removeNoResponding();
-            peers = response.peer_data;
-            configurationAlert(response);
-            configurationHeader(response);
-            configurationPeers(response);
-            $(".dot.dot-running").attr("title","کاربر متصل است").tooltip();
-            $(".dot.dot-stopped").attr("title","کاربر متصل نیست").tooltip();
-            $("i[data-toggle='tooltip']").tooltip();
+            if (jqXHR.status !== 304 && mergePeers(response, searchString)) {
+                peerSnapshot.etag = jqXHR.getResponseHeader("ETag");
+                renderPeers(response);
+            }
+            if (peerStreamAvailable() && peerStreamSearch !== searchString) {
+                openPeerStream(searchString);
+            }
             endProgressBar();
             let d2 = new Date();
             let seconds = (d2 - d1);
@@ -427,17 +573,22 @@
         $temp.remove();
     }
 
-    function getAvailableIps() {
+    function getAvailableIps(after) {
   $.ajax({
-    url: `/available_ips/${$add_peer.getAttribute("conf_id")}`,
+    url: `/available_ips/${$add_peer.getAttribute("conf_id")}` + (after ? `?after=${encodeURIComponent(after)}` : ""),
     method: "GET",
   }).done(function (res) {
-    const available_ips = res;
     const $list_group = $("#available_ip_modal .modal-body .list-group");
-    $list_group.empty();
-    $("#allowed_ips").val(available_ips[0]);
+    if (!after) {
+      $list_group.empty();
+      available_ips = [];
+      $("#allowed_ips").val(res.ips[0]);
+    }
+    $list_group.find(".available-ip-more").remove();
+    available_ip_count = res.total;
 
-    available_ips.forEach((ip) => {
+    res.ips.forEach((ip) => {
+      available_ips.push(ip);
       const $ipItem = $("<a>", {
         class: "list-group-item list-group-item-action available-ip-item",
         style: "cursor: pointer",
@@ -446,6 +597,14 @@
       });
       $list_group.append($ipItem);
     });
+    if (res.next) {
+      $list_group.append($("<a>", {
+        class: "list-group-item list-group-item-action text-center text-primary available-ip-more",
+        style: "cursor: pointer",
+        "data-after": res.next,
+        text: "...",
+      }));
+    }
   });
 }
     window.configurations = {
@@ -476,8 +635,8 @@
         deletePeers: (config, peers_ids) => {
             deletePeers(config, peers_ids);
         },
-        getAvailableIps: () => {
-            getAvailableIps();
+        getAvailableIps: (after) => {
+            getAvailableIps(after);
         },
         generateKeyPair: () => {
             generate_key();
@@ -517,6 +676,7 @@
 
 let $body = $("body");
 let available_ips = [];
+let available_ip_count = 0;
 let $add_peer = document.getElementById("save_peer");
 
 document.querySelector(".add_btn").addEventListener("click", () => {
@@ -528,7 +688,12 @@ document.querySelector(".info").addEventListener("click", (event) => {
     if (selector.contains(event.target)) {
         selector.style.display = "none";
         document.querySelector('div[role=status]').style.display = "inline-block";
-        location.replace(`/switch/${selector.getAttribute("id")}`);
+        $.get(`/switch/${selector.getAttribute("id")}?job=true`, function (res) {
+            window.jobs.wait(res.job).then(function (job) {
+                if (job && job.status === "failed") alert(job.error);
+                location.reload();
+            });
+        });
     }
 });
 
@@ -650,9 +815,9 @@ $("#new_add_amount").on("keyup", function () {
         if (isNaN($(this).val())) {
             $(this).removeClass("is-valid").addClass("is-invalid");
             $bulk_amount_validation.html("Please enter a valid integer");
-        } else if ($(this).val() > available_ips.length) {
+        } else if ($(this).val() > available_ip_count) {
             $(this).removeClass("is-valid").addClass("is-invalid");
-            $bulk_amount_validation.html(`Cannot create more than ${available_ips.length} peers.`);
+            $bulk_amount_validation.html(`Cannot create more than ${available_ip_count} peers.`);
         } else if ($(this).val() < 1) {
             $(this).removeClass("is-valid").addClass("is-invalid");
             $bulk_amount_validation.html("Please enter at least 1 or more.");
@@ -703,6 +868,10 @@ $body.on("click", ".available-ip-item", function () {
     window.configurations.triggerIp($(this).data("ip"));
 });
 
+$body.on("click", ".available-ip-more", function () {
+    window.configurations.getAvailableIps($(this).data("after"));
+});
+
 $("#search_available_ip").on("click", function () {
     window.configurations.ipModal().toggle();
     let $allowed_ips = document.querySelector("#allowed_ips");
@@ -0,0 +1,29 @@
+/**
+ * jobs.js - Follow background jobs started by the dashboard
+ */
+
+window.jobs = {
+    finished: ["done", "failed", "cancelled"],
+    /**
+     * Poll /jobs/<id> until the job finished
+     * @param id Job id
+     * @param onProgress Called with the job on every poll
+     * @returns Promise resolving to the finished job, or null if it disappeared
+     */
+    wait: function (id, onProgress) {
+        return new Promise(function (resolve) {
+            (function poll() {
+                $.get("/jobs/" + id, function (job) {
+                    if (onProgress) onProgress(job);
+                    if (window.jobs.finished.includes(job.status)) resolve(job);
+                    else setTimeout(poll, 1000);
+                }).fail(function () {
+                    resolve(null);
+                });
+            })();
+        });
+    },
+    cancel: function (id) {
+        return $.post("/jobs/" + id + "/cancel");
+    }
+};
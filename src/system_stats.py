@@ -0,0 +1,120 @@
+import collections
+import os
+import threading
+import time
+
+import psutil
+
+# Seconds between two samples
+SAMPLE_INTERVAL = 5.0
+# Samples kept, 10 minutes at the default interval
+HISTORY = 120
+
+
+def read_cpu_times():
+    """
+    Busy and total CPU time since boot, from /proc/stat
+    @return: (busy, total) in clock ticks
+    """
+    with open('/proc/stat') as stat_file:
+        fields = [int(value) for value in stat_file.readline().split()[1:9]]
+    # user nice system idle iowait irq softirq steal
+    idle = fields[3] + fields[4]
+    return sum(fields) - idle, sum(fields)
+
+
+def read_memory():
+    """
+    Total and used RAM, from /proc/meminfo. Used excludes buffers and page cache.
+    @return: (total, used) in bytes
+    """
+    values = {}
+    with open('/proc/meminfo') as meminfo_file:
+        for line in meminfo_file:
+            key, value = line.split(":", 1)
+            if key in ("MemTotal", "MemFree", "Buffers", "Cached"):
+                values[key] = int(value.split()[0]) * 1024
+    used = values["MemTotal"] - values["MemFree"] - values["Buffers"] - values["Cached"]
+    return values["MemTotal"], used
+
+
+class SystemSampler:
+    """
+    Samples CPU load over each interval, RAM and disk usage in a background thread, keeping a short history in a
+    ring buffer. Readers never touch /proc.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history=HISTORY):
+        """
+        @param interval: Seconds between two samples
+        @param history: Samples kept
+        """
+        self.interval = interval
+        self.samples = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self._cpu_times = None
+        self._mountpoint = None
+
+    def start(self):
+        """
+        Start the sampler thread of this process (after gunicorn forked the worker)
+        @return: None
+        """
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self.samples.clear()
+        self.sample()
+        threading.Thread(target=self._serve, name="system-stats", daemon=True).start()
+
+    def _serve(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except (OSError, ValueError, KeyError) as exc:
+                print(f"System stats sample failed: {exc}")
+
+    def sample(self):
+        """
+        Take a sample. CPU usage is the load since the previous sample; the first one has none.
+        @return: dict
+        """
+        busy, total = read_cpu_times()
+        cpu_percent = None
+        if self._cpu_times is not None and total > self._cpu_times[1]:
+            cpu_percent = round(100.0 * (busy - self._cpu_times[0]) / (total - self._cpu_times[1]), 2)
+        self._cpu_times = (busy, total)
+        if self._mountpoint is None:
+            partitions = psutil.disk_partitions()
+            self._mountpoint = partitions[0].mountpoint if partitions else "/"
+        disk = psutil.disk_usage(self._mountpoint)
+        ram_total, ram_used = read_memory()
+        sample = {
+            "time": time.time(),
+            "cpu_percent": cpu_percent,
+            "cpu_count": os.cpu_count(),
+            "ram_total": ram_total,
+            "ram_used": ram_used,
+            "disk_total": disk.total,
+            "disk_used": disk.used
+        }
+        with self._lock:
+            self.samples.append(sample)
+        return sample
+
+    def latest(self):
+        """
+        @return: dict, the newest sample, or None before the sampler started
+        """
+        with self._lock:
+            return self.samples[-1] if self.samples else None
+
+    def history(self):
+        """
+        @return: list of samples, oldest first
+        """
+        with self._lock:
+            return list(self.samples)
@@ -60,7 +60,17 @@ help() {
   printf "${YELLOW}|    ${GREEN}start${NC}: To start Wireguard Panel.                                           ${YELLOW}|\n"
   printf "${YELLOW}|    ${GREEN}stop${NC}: To stop Wireguard Panel.                                             ${YELLOW}|\n"
   printf "${YELLOW}|    ${GREEN}debug${NC}: To start Wireguard Panel in debug mode (i.e., run in foreground).   ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}reload${NC}: To reload the settings without restarting.                         ${YELLOW}|\n"
   printf "${YELLOW}|    ${GREEN}install${NC}: To install Wireguard Panel                                        ${YELLOW}|\n"
+  printf "${YELLOW}|                                                                               ${YELLOW}|\n"
+  printf "${YELLOW}| Peer commands (work without the web server, see ${GREEN}./wgd.sh <command> -h${YELLOW}):       |\n"
+  printf "${YELLOW}|    ${GREEN}list${NC} [conf]: List configurations, or the peers of one.                     ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}add-bulk${NC} <conf> <amount>: Create peers.                                    ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}remove${NC} <conf> <keys...|--expired>: Remove peers.                           ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}set-quota${NC} <conf> <keys...|--all>: Set data quota and expiry.               ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}export${NC} / ${GREEN}import${NC} <conf>: Peers as CSV or JSON lines.                        ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}recalc-usage${NC} [conf...]: Update data usage from the interfaces.             ${YELLOW}|\n"
+  printf "${YELLOW}|    ${GREEN}reconcile${NC} [conf...]: Make the interfaces match the database.               ${YELLOW}|\n"
   printf "${YELLOW}=================================================================================${NC}\n"
 }
 
@@ -119,6 +129,9 @@ install_wgd() {
     print_box "Installing latest Python dependencies" "${CYAN}"
     python3 -m pip install -U -r requirements.txt > /dev/null 2>&1
 
+    print_box "Precompressing static files" "${CYAN}"
+    python3 compression.py static > /dev/null 2>&1
+
     print_box "Wireguard Panel installed successfully!" "${LIGHT_GREEN}"
 }
 
@@ -140,6 +153,8 @@ update_wgd() {
     python3 -m pip install -U pip > /dev/null 2>&1
     printf "| Installing latest Python dependencies                    |\n"
     python3 -m pip install -U -r requirements.txt > /dev/null 2>&1
+    printf "| Precompressing static files                              |\n"
+    python3 compression.py static > /dev/null 2>&1
     printf "| Update Successfully!                                     |\n"
     printf "%s\n" "$dashes"
     rm wgd.sh.old
@@ -185,6 +200,15 @@ stop_wgd() {
   fi
 }
 
+reload_wgd() {
+  if test -f "$PID_FILE"; then
+    # The workers reload in place; the master only needs SIGHUP when the bind address changed
+    pkill -HUP -P "$(cat ./gunicorn.pid)"
+  else
+    kill -HUP "$(ps aux | grep "[p]ython3 $app_name" | awk '{print $2}')"
+  fi
+}
+
 start_wgd_debug() {
   dashes=$(printf "%-${logo_width}s" "─" | tr ' ' "─")
 
@@ -194,7 +218,12 @@ start_wgd_debug() {
   printf "%s\n" "$dashes"
 }
 
-if [ "$#" != 1 ]; then
+cli_commands=" list add-bulk remove set-quota export import recalc-usage reconcile "
+
+if [ "$#" -ge 1 ] && [[ "$cli_commands" == *" $1 "* ]]; then
+  python3 cli.py "$@"
+  exit $?
+elif [ "$#" != 1 ]; then
   help
 else
   if [ "$1" = "start" ]; then
@@ -220,6 +249,13 @@ else
       printf "${YELLOW}| Wireguard Panel is not running.                              ${NC}|\n"
       printf "%s\n" "$dashes"
     fi
+  elif [ "$1" = "reload" ]; then
+    if check_wgd_status; then
+      reload_wgd
+      print_box "Wireguard Panel settings reloaded." "$GREEN"
+    else
+      print_box "Wireguard Panel is not running." "$YELLOW"
+    fi
   elif [ "$1" = "update" ]; then
     update_wgd
   elif [ "$1" = "install" ]; then